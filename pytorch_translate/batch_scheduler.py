@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+
+"""
+Schedulers that group timestamped translation requests into batches, and a
+discrete-event simulator to tune them offline against synthetic load.
+
+Both schedulers share one interface: add() requests, then call
+next_batch(now) to get a batch to decode (or None if no batch should be
+started yet), next_wakeup(now) to know when to ask again if no new request
+arrives, and observe() with the measured compute time of every batch.
+
+    python pytorch_translate/batch_scheduler.py --qps 300 --deadline-ms 200 \
+        --num-workers 2 --overhead-ms 5 --ms-per-token 0.05
+"""
+
+import argparse
+import collections
+import heapq
+import math
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+import numpy as np
+
+
+class ScheduledRequest(NamedTuple):
+    request_id: int
+    src_length: int
+    arrival_time: float
+    # time (in seconds, same clock as arrival_time) by which the translation
+    # should be returned
+    deadline: float
+    payload: Any = None
+
+
+def padded_tokens(batch: List[ScheduledRequest]) -> int:
+    return len(batch) * max(r.src_length for r in batch)
+
+
+class FifoScheduler:
+    """
+    First-come first-served batching, as done by serve.MicroBatcher: a batch
+    is started once it has max_batch_size requests or its oldest request has
+    waited max_wait_ms.
+    """
+
+    def __init__(self, max_batch_size=8, max_wait_ms=10.0):
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.pending = collections.deque()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, request: ScheduledRequest):
+        self.pending.append(request)
+
+    def next_wakeup(self, now) -> Optional[float]:
+        if not self.pending:
+            return None
+        if len(self.pending) >= self.max_batch_size:
+            return now
+        return self.pending[0].arrival_time + self.max_wait_ms / 1000
+
+    def next_batch(self, now) -> Optional[List[ScheduledRequest]]:
+        wakeup = self.next_wakeup(now)
+        if wakeup is None or wakeup > now:
+            return None
+        return [
+            self.pending.popleft()
+            for _ in range(min(self.max_batch_size, len(self.pending)))
+        ]
+
+    def observe(self, batch, compute_ms):
+        pass
+
+
+class DeadlineAwareScheduler:
+    """
+    Groups requests into source-length buckets of bucket_width tokens so that
+    batches waste little padding, and decides when to start a batch from the
+    deadlines of its requests.
+
+    A bucket's candidate batch holds its requests with the earliest deadlines,
+    up to max_batch_size sentences and max_tokens padded source tokens. The
+    batch is started as soon as it is full, when its oldest request has waited
+    max_wait_ms, or at the latest time that still lets its earliest deadline be
+    met given the estimated compute time, whichever comes first. When several
+    buckets are ready, the one with the earliest deadline goes first.
+
+    Compute time is estimated as overhead_ms + ms_per_token * padded tokens,
+    where ms_per_token is updated from observed batches by exponential
+    smoothing.
+    """
+
+    def __init__(
+        self,
+        bucket_width=8,
+        max_tokens=2048,
+        max_batch_size=64,
+        max_wait_ms=50.0,
+        overhead_ms=5.0,
+        ms_per_token=0.1,
+        smoothing=0.1,
+    ):
+        self.bucket_width = bucket_width
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.overhead_ms = overhead_ms
+        self.ms_per_token = ms_per_token
+        self.smoothing = smoothing
+        self.buckets: Dict[int, List[ScheduledRequest]] = collections.defaultdict(list)
+        self.num_pending = 0
+
+    def __len__(self):
+        return self.num_pending
+
+    def add(self, request: ScheduledRequest):
+        self.buckets[request.src_length // self.bucket_width].append(request)
+        self.num_pending += 1
+
+    def estimate_ms(self, batch_size, max_length):
+        return self.overhead_ms + self.ms_per_token * batch_size * max_length
+
+    def observe(self, batch, compute_ms):
+        tokens = padded_tokens(batch)
+        if tokens > 0:
+            observed = max(compute_ms - self.overhead_ms, 0.0) / tokens
+            self.ms_per_token += self.smoothing * (observed - self.ms_per_token)
+
+    def candidate_batch(self, requests):
+        """Returns (batch, is_full) for the requests of one bucket."""
+        batch = []
+        max_length = 0
+        for request in sorted(requests, key=lambda r: r.deadline):
+            new_max_length = max(max_length, request.src_length)
+            if batch and (
+                len(batch) >= self.max_batch_size
+                or (len(batch) + 1) * new_max_length > self.max_tokens
+            ):
+                return batch, True
+            batch.append(request)
+            max_length = new_max_length
+        return batch, len(batch) >= self.max_batch_size
+
+    def ready_time(self, requests):
+        batch, is_full = self.candidate_batch(requests)
+        if is_full:
+            return -math.inf
+        max_length = max(r.src_length for r in batch)
+        latest_start = (
+            min(r.deadline for r in batch)
+            - self.estimate_ms(len(batch), max_length) / 1000
+        )
+        max_wait = min(r.arrival_time for r in requests) + self.max_wait_ms / 1000
+        return min(latest_start, max_wait)
+
+    def next_wakeup(self, now) -> Optional[float]:
+        ready_times = [self.ready_time(r) for r in self.buckets.values() if r]
+        return max(min(ready_times), now) if ready_times else None
+
+    def next_batch(self, now) -> Optional[List[ScheduledRequest]]:
+        ready = [
+            (min(r.deadline for r in requests), key)
+            for key, requests in self.buckets.items()
+            if requests and self.ready_time(requests) <= now
+        ]
+        if not ready:
+            return None
+        _, key = min(ready)
+        batch, _ = self.candidate_batch(self.buckets[key])
+        selected = {id(r) for r in batch}
+        self.buckets[key] = [r for r in self.buckets[key] if id(r) not in selected]
+        if not self.buckets[key]:
+            del self.buckets[key]
+        self.num_pending -= len(batch)
+        return batch
+
+
+def build_scheduler(args):
+    if args.scheduler == "deadline":
+        return DeadlineAwareScheduler(
+            bucket_width=args.bucket_width,
+            max_tokens=args.max_tokens_per_batch,
+            max_batch_size=args.max_batch_size,
+            max_wait_ms=args.max_wait_ms,
+        )
+    return FifoScheduler(
+        max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms
+    )
+
+
+def add_scheduler_args(parser):
+    group = parser.add_argument_group("Batch scheduling")
+    group.add_argument(
+        "--scheduler",
+        default="micro-batch",
+        choices=["micro-batch", "deadline"],
+        help="micro-batch: first-come first-served batches of up to "
+        "--max-batch-size, started after --max-wait-ms at the latest. "
+        "deadline: length-bucketed batches within --max-tokens-per-batch, "
+        "started in time to meet --deadline-ms.",
+    )
+    group.add_argument(
+        "--max-batch-size",
+        default=8,
+        type=int,
+        metavar="N",
+        help="Maximum number of sentences in a dynamic batch.",
+    )
+    group.add_argument(
+        "--max-wait-ms",
+        default=10.0,
+        type=float,
+        metavar="MS",
+        help="Maximum time to wait for a batch to fill up after its first "
+        "sentence arrived. 0 decodes whatever is already queued.",
+    )
+    group.add_argument(
+        "--deadline-ms",
+        default=200.0,
+        type=float,
+        metavar="MS",
+        help="Latency target of every request, counted from its arrival.",
+    )
+    group.add_argument(
+        "--bucket-width",
+        default=8,
+        type=int,
+        metavar="N",
+        help="Width in source tokens of the length buckets of the deadline "
+        "scheduler.",
+    )
+    group.add_argument(
+        "--max-tokens-per-batch",
+        default=2048,
+        type=int,
+        metavar="N",
+        help="Maximum number of padded source tokens in a batch formed by the "
+        "deadline scheduler.",
+    )
+    return group
+
+
+def linear_service_time(overhead_ms=5.0, ms_per_token=0.05):
+    """Compute time of a batch as a function of its padded source tokens."""
+
+    def service_time_ms(batch: List[ScheduledRequest]) -> float:
+        return overhead_ms + ms_per_token * padded_tokens(batch)
+
+    return service_time_ms
+
+
+def synthetic_requests(
+    num_requests, qps, deadline_ms, mean_length=20, max_length=100, seed=1
+) -> List[ScheduledRequest]:
+    """Poisson arrivals with log-normally distributed source lengths."""
+    rng = np.random.RandomState(seed)
+    arrival_times = np.cumsum(rng.exponential(1.0 / qps, size=num_requests))
+    sigma = 0.5
+    lengths = rng.lognormal(np.log(mean_length) - sigma ** 2 / 2, sigma, num_requests)
+    lengths = np.clip(np.round(lengths), 1, max_length).astype(int)
+    return [
+        ScheduledRequest(
+            request_id=i,
+            src_length=int(length),
+            arrival_time=float(arrival),
+            deadline=float(arrival) + deadline_ms / 1000,
+        )
+        for i, (arrival, length) in enumerate(zip(arrival_times, lengths))
+    ]
+
+
+class SimulationResult(NamedTuple):
+    queue_ms: List[float]
+    compute_ms: List[float]
+    total_ms: List[float]
+    batch_sizes: List[int]
+    # fraction of the decoded source tokens that were padding
+    padding_fraction: float
+    deadline_miss_rate: float
+    sentences_per_sec: float
+
+    def summary(self) -> Dict[str, float]:
+        p50, p90, p99 = np.percentile(self.total_ms, [50, 90, 99])
+        return {
+            "p50_ms": float(p50),
+            "p90_ms": float(p90),
+            "p99_ms": float(p99),
+            "mean_queue_ms": float(np.mean(self.queue_ms)),
+            "mean_compute_ms": float(np.mean(self.compute_ms)),
+            "mean_batch_size": float(np.mean(self.batch_sizes)),
+            "padding_fraction": self.padding_fraction,
+            "deadline_miss_rate": self.deadline_miss_rate,
+            "sentences_per_sec": self.sentences_per_sec,
+        }
+
+
+def simulate(
+    scheduler,
+    requests: List[ScheduledRequest],
+    service_time_ms: Callable[[List[ScheduledRequest]], float],
+    num_workers=1,
+) -> SimulationResult:
+    """
+    Replays requests (sorted by arrival_time) through scheduler with
+    num_workers decoders whose batch compute time is given by service_time_ms.
+    Returns per-request latencies split into queueing and compute time.
+    """
+    requests = sorted(requests, key=lambda r: r.arrival_time)
+    # heap of times at which each worker becomes free
+    free_at = [0.0] * num_workers
+    heapq.heapify(free_at)
+    queue_ms, compute_ms, total_ms, batch_sizes = [], [], [], []
+    real_tokens = 0
+    decoded_tokens = 0
+    missed = 0
+    next_request = 0
+    now = 0.0
+    while next_request < len(requests) or len(scheduler) > 0:
+        while (
+            next_request < len(requests) and requests[next_request].arrival_time <= now
+        ):
+            scheduler.add(requests[next_request])
+            next_request += 1
+
+        batch = scheduler.next_batch(now) if free_at[0] <= now else None
+        if batch:
+            worker_free_at = heapq.heappop(free_at)
+            start = max(now, worker_free_at)
+            batch_ms = service_time_ms(batch)
+            end = start + batch_ms / 1000
+            heapq.heappush(free_at, end)
+            scheduler.observe(batch, batch_ms)
+            batch_sizes.append(len(batch))
+            real_tokens += sum(r.src_length for r in batch)
+            decoded_tokens += padded_tokens(batch)
+            for request in batch:
+                queue_ms.append((start - request.arrival_time) * 1000)
+                compute_ms.append(batch_ms)
+                total_ms.append((end - request.arrival_time) * 1000)
+                missed += end > request.deadline
+            continue
+
+        # Nothing to start now: advance to the next event
+        events = []
+        if next_request < len(requests):
+            events.append(requests[next_request].arrival_time)
+        wakeup = scheduler.next_wakeup(now)
+        if wakeup is not None:
+            # a batch is pending, it can start once a worker is free
+            events.append(max(wakeup, free_at[0]))
+        now = max(min(events), now)
+
+    elapsed = max(free_at) - requests[0].arrival_time if requests else 0.0
+    return SimulationResult(
+        queue_ms=queue_ms,
+        compute_ms=compute_ms,
+        total_ms=total_ms,
+        batch_sizes=batch_sizes,
+        padding_fraction=1 - real_tokens / decoded_tokens if decoded_tokens else 0.0,
+        deadline_miss_rate=missed / len(requests) if requests else 0.0,
+        sentences_per_sec=len(requests) / elapsed if elapsed > 0 else 0.0,
+    )
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Simulate batch scheduling policies on synthetic load."
+    )
+    add_scheduler_args(parser)
+    parser.add_argument("--num-requests", default=5000, type=int)
+    parser.add_argument("--qps", default=200.0, type=float, help="Arrival rate.")
+    parser.add_argument(
+        "--mean-length", default=20, type=int, help="Mean source length."
+    )
+    parser.add_argument(
+        "--max-length", default=100, type=int, help="Maximum source length."
+    )
+    parser.add_argument("--num-workers", default=1, type=int)
+    parser.add_argument(
+        "--overhead-ms",
+        default=5.0,
+        type=float,
+        help="Fixed compute cost of a batch in the simulated service time.",
+    )
+    parser.add_argument(
+        "--ms-per-token",
+        default=0.05,
+        type=float,
+        help="Compute cost per padded source token in the simulated service "
+        "time. Calibrate both from benchmark.py --batch-sizes runs.",
+    )
+    parser.add_argument("--seed", default=1, type=int)
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    requests = synthetic_requests(
+        num_requests=args.num_requests,
+        qps=args.qps,
+        deadline_ms=args.deadline_ms,
+        mean_length=args.mean_length,
+        max_length=args.max_length,
+        seed=args.seed,
+    )
+    service_time_ms = linear_service_time(args.overhead_ms, args.ms_per_token)
+    print(
+        f"| {'scheduler':<12} {'p50 ms':>8} {'p99 ms':>8} {'queue ms':>9} "
+        f"{'compute ms':>10} {'bsz':>6} {'padding':>8} {'missed':>7} {'sent/s':>8}"
+    )
+    for scheduler_name in ["micro-batch", "deadline"]:
+        args.scheduler = scheduler_name
+        result = simulate(
+            build_scheduler(args), requests, service_time_ms, args.num_workers
+        ).summary()
+        print(
+            f"| {scheduler_name:<12} {result['p50_ms']:>8.1f} "
+            f"{result['p99_ms']:>8.1f} {result['mean_queue_ms']:>9.1f} "
+            f"{result['mean_compute_ms']:>10.1f} {result['mean_batch_size']:>6.1f} "
+            f"{result['padding_fraction']:>8.1%} {result['deadline_miss_rate']:>7.1%} "
+            f"{result['sentences_per_sec']:>8.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -106,6 +106,7 @@ class SequenceGenerator(object):
         cuda=False,
         timer=None,
         prefix_size=0,
+        memory_profiler=None,
     ):
         """Iterate over a batched dataset and yield individual translations.
 
@@ -114,6 +115,8 @@ class SequenceGenerator(object):
                 where x is the source sentence length.
             cuda: use GPU for generation
             timer: StopwatchMeter for timing generations.
+            memory_profiler: MemoryProfiler recording memory per batch,
+                bucketed by (bsz, srclen, beam).
         """
         if maxlen_b is None:
             maxlen_b = self.maxlen
@@ -135,6 +138,8 @@ class SequenceGenerator(object):
                 encoder_input = {
                     k: v for k, v in input.items() if k in ["src_tokens", "src_lengths"]
                 }
+            if memory_profiler is not None:
+                memory_profiler.start()
             if timer is not None:
                 timer.start()
             with torch.no_grad():
@@ -148,18 +153,160 @@ class SequenceGenerator(object):
                 )
             if timer is not None:
                 timer.stop(s["ntokens"])
+            if memory_profiler is not None:
+                memory_profiler.stop(
+                    key=(
+                        input["src_tokens"].size(0),
+                        srclen,
+                        beam_size or self.beam_size,
+                    ),
+                    name="decode batch",
+                )
             for i, id in enumerate(s["id"]):
                 # remove padding
                 src = utils.strip_pad(input["src_tokens"][i, :], self.pad)
                 ref = utils.strip_pad(s["target"][i, :], self.pad)
                 yield id, src, ref, hypos[i]
 
-    def generate(self, encoder_input, beam_size=None, maxlen=None, prefix_tokens=None):
-        """Generate a batch of translations."""
+    def generate(
+        self,
+        encoder_input,
+        beam_size=None,
+        maxlen=None,
+        prefix_tokens=None,
+        encoder_outs=None,
+    ):
+        """Generate a batch of translations.
+
+        encoder_outs optionally holds the output of every model's encoder for
+        encoder_input, e.g. from a training forward pass over the same batch.
+        They are expanded for the beam instead of running the encoders again.
+        """
         with torch.no_grad():
-            return self._generate(encoder_input, beam_size, maxlen, prefix_tokens)
+            return self._generate(
+                encoder_input, beam_size, maxlen, prefix_tokens, encoder_outs
+            )
 
-    def _generate(self, encoder_input, beam_size=None, maxlen=None, prefix_tokens=None):
+    def sample(
+        self,
+        encoder_input,
+        maxlen=None,
+        greedy=False,
+        sampling_topk=-1,
+        sampling_temperature=1.0,
+    ):
+        """
+        Generates a single translation per sentence, either greedily or by
+        sampling every token from the model distribution (restricted to the
+        sampling_topk most likely tokens if > 0). Unlike generate() with
+        beam_size=1 or search.Sampling, there are no candidate buffers, no
+        reordering of decoder states and no finalization bookkeeping; every
+        step is one batched decoder call and one argmax or multinomial draw.
+        unk_reward, word_reward and lexicon_reward are not applied.
+
+        Returns hypotheses in the format of generate(), with one hypothesis
+        per sentence.
+        """
+        with torch.no_grad():
+            return self._sample(
+                encoder_input, maxlen, greedy, sampling_topk, sampling_temperature
+            )
+
+    def _sample(
+        self, encoder_input, maxlen, greedy, sampling_topk, sampling_temperature
+    ):
+        src_tokens = encoder_input["src_tokens"]
+        bsz = src_tokens.size(0)
+        maxlen = min(maxlen, self.maxlen) if maxlen is not None else self.maxlen
+        if self.use_char_source:
+            encoder_inputs = (
+                encoder_input["src_tokens"],
+                encoder_input["src_lengths"],
+                encoder_input["char_inds"],
+                encoder_input["word_lengths"],
+            )
+        else:
+            encoder_inputs = (encoder_input["src_tokens"], encoder_input["src_lengths"])
+        encoder_outs, incremental_states = self._encode(
+            encoder_input=encoder_inputs,
+            reorder_indices=torch.arange(bsz).type_as(src_tokens),
+        )
+
+        tokens = src_tokens.new(bsz, maxlen + 2).fill_(self.pad)
+        tokens[:, 0] = self.eos
+        scores = src_tokens.new(bsz, maxlen + 1).float().fill_(0)
+        attn = None
+        finished = tokens.new_zeros(bsz).ne(0)
+        for step in range(maxlen + 1):  # one extra step for EOS marker
+            logprobs, avg_attn, possible_translation_tokens = self._decode(
+                tokens[:, : step + 1], encoder_outs, incremental_states
+            )
+            if possible_translation_tokens is None:
+                eos_index = self.eos
+                pad_index = self.pad
+            else:
+                eos_index = torch.nonzero(possible_translation_tokens == self.eos)
+                pad_index = torch.nonzero(possible_translation_tokens == self.pad)
+            logprobs[:, pad_index] = -math.inf  # never select pad
+            if step < self.minlen:
+                logprobs[:, eos_index] = -math.inf
+
+            if step == maxlen:
+                indices = tokens.new_full((bsz,), int(eos_index))
+            elif greedy:
+                _, indices = logprobs.max(dim=1)
+            else:
+                candidates = logprobs
+                if sampling_topk > 0:
+                    candidates, topk_indices = logprobs.topk(
+                        min(sampling_topk, logprobs.size(1))
+                    )
+                probs = torch.softmax(candidates / sampling_temperature, dim=1)
+                indices = torch.multinomial(probs, 1).squeeze(1)
+                if sampling_topk > 0:
+                    indices = topk_indices.gather(1, indices.unsqueeze(1)).squeeze(1)
+            step_scores = logprobs.gather(1, indices.unsqueeze(1)).squeeze(1)
+            if possible_translation_tokens is not None:
+                indices = possible_translation_tokens[indices]
+
+            # Sentences which already produced EOS are padded
+            indices.masked_fill_(finished, self.pad)
+            step_scores.masked_fill_(finished, 0)
+            tokens[:, step + 1] = indices
+            scores[:, step] = step_scores
+            if avg_attn is not None:
+                if attn is None:
+                    attn = avg_attn.new(bsz, avg_attn.size(1), maxlen + 2).fill_(0)
+                attn[:, :, step + 1] = avg_attn
+            finished = finished | indices.eq(self.eos)
+            if finished.all():
+                break
+
+        lengths = tokens[:, 1:].ne(self.pad).long().sum(dim=1).tolist()
+        finalized = []
+        for i, length in enumerate(lengths):
+            score = scores[i, :length].sum().item()
+            if self.normalize_scores:
+                score /= length ** self.len_penalty
+            hypo = {
+                "tokens": tokens[i, 1 : length + 1],
+                "score": score,
+                "positional_scores": scores[i, :length],
+            }
+            if attn is not None:
+                hypo["attention"] = attn[i, :, 1 : length + 1]
+                _, hypo["alignment"] = hypo["attention"].max(dim=0)
+            finalized.append([hypo])
+        return finalized
+
+    def _generate(
+        self,
+        encoder_input,
+        beam_size=None,
+        maxlen=None,
+        prefix_tokens=None,
+        encoder_outs=None,
+    ):
 
         src_tokens = encoder_input["src_tokens"]
 
@@ -186,6 +333,7 @@ class SequenceGenerator(object):
         encoder_outs, incremental_states = self._encode(
             encoder_input=encoder_inputs,
             reorder_indices=reorder_indices.type_as(src_tokens),
+            encoder_outs=encoder_outs,
         )
 
         # initialize buffers
@@ -534,10 +682,11 @@ class SequenceGenerator(object):
 
         return finalized
 
-    def _encode(self, encoder_input, reorder_indices):
+    def _encode(self, encoder_input, reorder_indices, encoder_outs=None):
+        precomputed_encoder_outs = encoder_outs
         encoder_outs = []
         incremental_states = {}
-        for model in self.models:
+        for i, model in enumerate(self.models):
             if not self.retain_dropout:
                 model.eval()
             if isinstance(model.decoder, FairseqIncrementalDecoder):
@@ -545,7 +694,10 @@ class SequenceGenerator(object):
             else:
                 incremental_states[model] = None
 
-            encoder_out = model.encoder(*encoder_input)
+            if precomputed_encoder_outs is not None:
+                encoder_out = precomputed_encoder_outs[i]
+            else:
+                encoder_out = model.encoder(*encoder_input)
 
             # expand outputs for each example beam_size times
             encoder_out = model.encoder.reorder_encoder_out(
@@ -606,25 +758,10 @@ class SequenceGenerator(object):
             f"all_translation_tokens: {all_translation_tokens}\n"
             f"all_probs: {all_probs}"
         )
-        possible_translation_tokens = None
-        inv_indices_per_model = [None] * len(all_translation_tokens)
-        if all_translation_tokens[0] is not None:
-            # Get unique translation tokens out of all the
-            # possible_translation_tokens for every model.
-            # inverse indices for the example above: [5, 4, 2, 1, 3, 5, 0]
-            possible_translation_tokens, inverse_indices = torch.unique(
-                torch.cat(all_translation_tokens, dim=0),
-                sorted=False,
-                return_inverse=True,
-            )
-            # softmax_sizes for the example above: [4, 3]
-            softmax_sizes = [
-                translation_tokens.size(0)
-                for translation_tokens in all_translation_tokens
-            ]
-            inv_indices_per_model = torch.split(
-                inverse_indices, split_size_or_sections=softmax_sizes
-            )
+        (
+            possible_translation_tokens,
+            inv_indices_per_model,
+        ) = SequenceGenerator.merge_translation_tokens(all_translation_tokens)
 
         avg_probs = None
         for inv_ind, probs in zip(inv_indices_per_model, all_probs):
@@ -644,10 +781,64 @@ class SequenceGenerator(object):
                 avg_probs.add_(mapped_probs)
         return avg_probs, possible_translation_tokens
 
+    @staticmethod
+    def gather_log_probs(all_translation_tokens, all_log_probs):
+        """
+        Same as gather_probs, but takes and returns log probs. The sum is
+        computed with logsumexp, so that probabilities which are too small to
+        be represented don't underflow to 0 (and their log to -inf). Tokens
+        outside of a model's possible_translation_tokens get log prob -inf
+        from that model.
+        """
+        if len(all_log_probs) == 1:
+            return all_log_probs[0], all_translation_tokens[0]
+        (
+            possible_translation_tokens,
+            inv_indices_per_model,
+        ) = SequenceGenerator.merge_translation_tokens(all_translation_tokens)
+        mapped_log_probs = all_log_probs
+        if possible_translation_tokens is not None:
+            mapped_log_probs = []
+            for inv_ind, log_probs in zip(inv_indices_per_model, all_log_probs):
+                mapped = log_probs.new_full(
+                    (log_probs.size(0), possible_translation_tokens.size(0)),
+                    float("-inf"),
+                )
+                mapped[:, inv_ind] = log_probs
+                mapped_log_probs.append(mapped)
+        return (
+            torch.logsumexp(torch.stack(mapped_log_probs, dim=0), dim=0),
+            possible_translation_tokens,
+        )
+
+    @staticmethod
+    def merge_translation_tokens(all_translation_tokens):
+        """
+        Returns the union of the possible_translation_tokens of all models, and
+        for every model the indices of its tokens in that union. Both are None
+        if vocab reduction was not used.
+        """
+        if all_translation_tokens[0] is None:
+            return None, [None] * len(all_translation_tokens)
+        # Get unique translation tokens out of all the
+        # possible_translation_tokens for every model.
+        # inverse indices for the example above: [5, 4, 2, 1, 3, 5, 0]
+        possible_translation_tokens, inverse_indices = torch.unique(
+            torch.cat(all_translation_tokens, dim=0), sorted=False, return_inverse=True
+        )
+        # softmax_sizes for the example above: [4, 3]
+        softmax_sizes = [
+            translation_tokens.size(0) for translation_tokens in all_translation_tokens
+        ]
+        inv_indices_per_model = torch.split(
+            inverse_indices, split_size_or_sections=softmax_sizes
+        )
+        return possible_translation_tokens, inv_indices_per_model
+
     def _decode(self, tokens, encoder_outs, incremental_states):
         avg_attn = None
         all_translation_tokens = []
-        all_probs = []
+        all_log_probs = []
         for model_weight, model, encoder_out in zip(
             self.model_weights, self.models, encoder_outs
         ):
@@ -665,35 +856,45 @@ class SequenceGenerator(object):
                     hasattr(model.decoder, "adaptive_softmax")
                     and model.decoder.adaptive_softmax is not None
                 ):
-                    decoder_out[0] = decoder_out[0].unsqueeze(1)
+                    # the adaptive softmax is kept in fp32 by
+                    # cast_model_for_inference, so it normalizes in fp32
+                    decoder_out[0] = decoder_out[0].float().unsqueeze(1)
                     # to use get_normalized_probs in adaptive softmax decoder
                     # the sample object is needed. During inference, the target
                     # should be set to None
-                    probs = model_weight * model.get_normalized_probs(
-                        decoder_out, log_probs=False, sample={"target": None}
+                    log_probs = model.get_normalized_probs(
+                        decoder_out, log_probs=True, sample={"target": None}
                     )
-                    probs = probs[:, -1, :]
+                    log_probs = log_probs[:, -1, :]
                 else:
-                    probs = model_weight * model.get_normalized_probs(
-                        decoder_out, log_probs=False
+                    # Normalize in fp32 even if the model runs in fp16/bf16
+                    decoder_out[0] = decoder_out[0].float()
+                    log_probs = model.get_normalized_probs(decoder_out, log_probs=True)
+                if model_weight != 1.0:
+                    log_probs = log_probs + (
+                        math.log(model_weight) if model_weight > 0 else float("-inf")
                     )
                 all_translation_tokens.append(possible_translation_tokens)
-                all_probs.append(probs)
+                all_log_probs.append(log_probs)
 
             if attn is not None:
-                attn = attn[:, -1, :]
+                attn = attn[:, -1, :].float()
                 if avg_attn is None:
                     avg_attn = attn
                 else:
                     avg_attn.add_(attn)
-        avg_probs, possible_translation_tokens = SequenceGenerator.gather_probs(
-            all_translation_tokens=all_translation_tokens, all_probs=all_probs
+        # Interpolate the models in log space, which can't underflow like the
+        # mean of their probabilities
+        (
+            avg_log_probs,
+            possible_translation_tokens,
+        ) = SequenceGenerator.gather_log_probs(
+            all_translation_tokens=all_translation_tokens, all_log_probs=all_log_probs
         )
-        avg_probs.log_()
         if avg_attn is not None:
             avg_attn.div_(len(self.models))
 
-        return avg_probs, avg_attn, possible_translation_tokens
+        return avg_log_probs, avg_attn, possible_translation_tokens
 
     def diversity_sibling_rank(self, logprobs, gamma):
         """
@@ -1,19 +1,34 @@
 #!/usr/bin/env python3
 
+import bisect
+import copy
+import json
 import os
 import random
 import tempfile
 
+import numpy as np
+import torch
 from fairseq import options, tasks
 from pytorch_translate import (
+    data as pytorch_translate_data,
     generate as pytorch_translate_generate,
+    memory_profiling,
     options as pytorch_translate_options,
+    quantization_report,
     utils as pytorch_translate_utils,
 )
 
 
 from pytorch_translate import rnn  # noqa; noqa
 
+EXPORTED_MODEL_TYPES = ["pytorch", "pytorch-batched", "caffe2", "caffe2-components"]
+CAFFE2_EXPORTED_MODEL_TYPES = ["caffe2", "caffe2-components"]
+
+
+def comma_separated_ints(value):
+    return [int(v) for v in value.split(",")]
+
 
 def get_parser_with_args():
     parser = options.get_parser("Generation", default_task="pytorch_translate")
@@ -74,7 +89,96 @@ def get_parser_with_args():
         "--examples-per-length",
         default=1,
         type=int,
-        help="Sentences of each length to include in each eval (batched if >1).",
+        help=(
+            "Sentences of each length to include in each eval (batched if >1). "
+            "Used when --batch-sizes is not given."
+        ),
+    )
+    group.add_argument(
+        "--lengths",
+        default=[6, 10, 20],
+        type=comma_separated_ints,
+        help="Comma-separated source lengths (in tokens) to benchmark.",
+    )
+    group.add_argument(
+        "--batch-sizes",
+        default=None,
+        type=comma_separated_ints,
+        help="Comma-separated numbers of sentences per eval to sweep over.",
+    )
+    group.add_argument(
+        "--beam-sizes",
+        default=None,
+        type=comma_separated_ints,
+        help="Comma-separated beam sizes to sweep over (default: --beam).",
+    )
+    group.add_argument(
+        "--from-corpus",
+        default="",
+        metavar="FILE",
+        help=(
+            "Sample real source sentences from this text or binarized (.npz) "
+            "file instead of synthetic ones. A sentence of n tokens goes to "
+            "the bucket of the largest value in --lengths that is <= n, if n "
+            "is below the next value. The largest value gets sentences up to "
+            "the spacing of the last two values (or twice itself) above it."
+        ),
+    )
+    group.add_argument(
+        "--reference-file",
+        default="",
+        metavar="FILE",
+        help=(
+            "Reference translations of the whole --from-corpus file, one per "
+            "line. If set, the corpus is translated once and scored with "
+            "BLEU; with an --inference-dtype other than fp32, fp32 copies of "
+            "the models translate it too, and the hypotheses are compared."
+        ),
+    )
+    group.add_argument(
+        "--warmup-runs",
+        default=1,
+        type=int,
+        help="Untimed runs before timing each configuration.",
+    )
+    group.add_argument(
+        "--exported-model",
+        default="",
+        metavar="FILE",
+        help=(
+            "Exported artifact to benchmark on the same inputs as the eager "
+            "model: a TorchScript file from BeamSearch.save_to_pytorch or "
+            "BatchBeamSearch.save_to_pytorch, a Caffe2 beam search from "
+            "onnx_full_export.py, or the encoder from onnx_component_export.py."
+        ),
+    )
+    group.add_argument(
+        "--exported-model-type",
+        default="pytorch",
+        choices=EXPORTED_MODEL_TYPES,
+        help="Kind of artifact given by --exported-model.",
+    )
+    group.add_argument(
+        "--exported-decoder-model",
+        default="",
+        metavar="FILE",
+        help="Decoder step from onnx_component_export.py (caffe2-components).",
+    )
+    group.add_argument(
+        "--num-threads",
+        default=[1],
+        type=comma_separated_ints,
+        help=(
+            "Comma-separated thread counts to benchmark exported models with. "
+            "Caffe2 reads its thread count once per process, so Caffe2 "
+            "artifacts take a single value."
+        ),
+    )
+    group.add_argument(
+        "--benchmark-output-file",
+        default="",
+        metavar="FILE",
+        help="If set, eager and exported results are also written there as JSON.",
     )
 
     return parser
@@ -89,16 +193,526 @@ def main():
     benchmark(args)
 
 
-def generate_synthetic_text(dialect, dialect_symbols, length, examples):
+def synthetic_sentence(dictionary, length):
+    """
+    Samples regular (non-special) symbols in proportion to their frequency in
+    the dictionary, so that inputs look more like real traffic.
+    """
+    symbols = dictionary.symbols[dictionary.nspecial :]
+    weights = dictionary.count[dictionary.nspecial :]
+    if sum(weights) == 0:
+        weights = None
+    return " ".join(random.choices(symbols, weights=weights, k=length))
+
+
+def write_text_file(lines):
     temp_file = tempfile.NamedTemporaryFile(mode="w", delete=False, dir="/tmp")
     temp_file_name = temp_file.name
     temp_file.close()
     with open(temp_file_name, "w") as temp_file:
-        for _ in range(examples):
-            temp_file.write(" ".join(random.sample(dialect_symbols, length)) + "\n")
+        for line in lines:
+            temp_file.write(line + "\n")
     return temp_file_name
 
 
+def read_corpus_sentences(path, dictionary, append_eos=False, reverse_source=False):
+    """
+    Returns the source sentences of a text file, or of a binarized file (as
+    written by preprocess.py) converted back to text.
+    """
+    if not path.endswith(".npz"):
+        with open(path, "r") as f:
+            return [line.strip() for line in f if line.strip()]
+
+    dataset = pytorch_translate_data.InMemoryNumpyDataset.create_from_file(path)
+    sentences = []
+    for i in range(len(dataset)):
+        inds = dataset[i].tolist()
+        if append_eos and inds and inds[-1] == dictionary.eos():
+            inds = inds[:-1]
+        if reverse_source:
+            inds.reverse()
+        sentences.append(" ".join(dictionary[ind] for ind in inds))
+    return sentences
+
+
+def bin_sentences_by_length(sentences, lengths):
+    """
+    Puts each sentence of n tokens into the bucket of the largest length
+    <= n, if n is below the next length. The last bucket is as wide as the
+    one before it (or as its length, when it is the only one). Other
+    sentences are dropped.
+    """
+    sorted_lengths = sorted(lengths)
+    if len(sorted_lengths) > 1:
+        last_width = sorted_lengths[-1] - sorted_lengths[-2]
+    else:
+        last_width = sorted_lengths[-1]
+    upper_bounds = sorted_lengths[1:] + [sorted_lengths[-1] + last_width]
+    bins = {length: [] for length in lengths}
+    for sentence in sentences:
+        n = len(sentence.split())
+        i = bisect.bisect_right(sorted_lengths, n) - 1
+        if i >= 0 and n < upper_bounds[i]:
+            bins[sorted_lengths[i]].append(sentence)
+    return bins
+
+
+def sample_bucket_sentences(args, task, append_eos, reverse_source, num_sentences):
+    """
+    Returns num_sentences source sentences for each of args.lengths, either
+    synthetic or sampled from args.from_corpus.
+    """
+    if not args.from_corpus:
+        return {
+            length: [
+                synthetic_sentence(task.source_dictionary, length)
+                for _ in range(num_sentences)
+            ]
+            for length in args.lengths
+        }
+
+    bins = bin_sentences_by_length(
+        read_corpus_sentences(
+            args.from_corpus, task.source_dictionary, append_eos, reverse_source
+        ),
+        args.lengths,
+    )
+    buckets = {}
+    for length, sentences in bins.items():
+        if not sentences:
+            print(f"No sentences in {args.from_corpus} for length {length}")
+        elif len(sentences) >= num_sentences:
+            buckets[length] = random.sample(sentences, num_sentences)
+        else:
+            buckets[length] = random.choices(sentences, k=num_sentences)
+    return buckets
+
+
+def translate_corpus(
+    models, args, task, source_sentences, target_sentences, append_eos, reverse_source
+):
+    """
+    Translates source_sentences in one pass. Returns the BLEU score against
+    target_sentences and the hypothesis of each sentence, in order.
+    """
+    source_text_file = write_text_file(source_sentences)
+    target_text_file = write_text_file(target_sentences)
+    task.load_dataset_from_text(
+        args.gen_subset,
+        source_text_file=source_text_file,
+        target_text_file=target_text_file,
+        append_eos=append_eos,
+        reverse_source=reverse_source,
+    )
+    os.remove(source_text_file)
+    os.remove(target_text_file)
+
+    scorer, _, _, translation_samples = pytorch_translate_generate.generate_score(
+        models=models, args=args, task=task, dataset=task.dataset(args.gen_subset)
+    )
+    hypos = [None] * len(source_sentences)
+    for sample in translation_samples:
+        hypos[sample["sample_id"]] = sample["hypo_str"]
+    return scorer.score(), hypos
+
+
+def inference_dtype_parity(args, task, models, append_eos, reverse_source):
+    """
+    Translates the whole --from-corpus file, with the models in
+    --inference-dtype and (unless that is fp32) with fp32 copies of them.
+    Returns the BLEU of each against --reference-file and, for reduced
+    precision, how often its hypotheses are identical to the fp32 ones.
+    """
+    assert (
+        args.from_corpus
+    ), "--reference-file holds the references of --from-corpus, which is required"
+    sources = read_corpus_sentences(
+        args.from_corpus, task.source_dictionary, append_eos, reverse_source
+    )
+    with open(args.reference_file, "r") as f:
+        references = [line.strip() for line in f]
+    assert len(references) == len(
+        sources
+    ), f"{args.reference_file} and {args.from_corpus} differ in length"
+
+    parity = {}
+    bleu, hypos = translate_corpus(
+        models, args, task, sources, references, append_eos, reverse_source
+    )
+    parity[f"bleu_{args.inference_dtype}"] = bleu
+    if args.inference_dtype != "fp32":
+        fp32_models, _, _ = pytorch_translate_utils.load_diverse_ensemble_for_inference(
+            args.path.split(":"), inference_dtype="fp32"
+        )
+        fp32_bleu, fp32_hypos = translate_corpus(
+            fp32_models, args, task, sources, references, append_eos, reverse_source
+        )
+        parity["bleu_fp32"] = fp32_bleu
+        parity["exact_match_with_fp32"] = float(
+            np.mean([h == f for h, f in zip(hypos, fp32_hypos)])
+        )
+    return parity
+
+
+def latency_stats(latencies, peak_rss_mb, num_sentences=None, prefix=""):
+    """
+    Summarizes the latencies (in seconds) of calls which translate
+    num_sentences sentences in total, one per call by default. Latency keys
+    start with prefix.
+    """
+    latencies_ms = 1000 * np.array(latencies)
+    if num_sentences is None:
+        num_sentences = len(latencies)
+    return {
+        f"{prefix}latency_p50_ms": float(np.percentile(latencies_ms, 50)),
+        f"{prefix}latency_p90_ms": float(np.percentile(latencies_ms, 90)),
+        f"{prefix}latency_p99_ms": float(np.percentile(latencies_ms, 99)),
+        "sentences_per_sec": num_sentences / float(np.sum(latencies)),
+        "peak_rss_mb": peak_rss_mb,
+    }
+
+
+def peak_rss_since(reset):
+    """
+    Peak RSS in MB since memory_profiling.reset_peak_rss() returned reset. When
+    it could not reset the peak, this is the peak of the whole process so far.
+    """
+    if reset:
+        return memory_profiling.region_peak_rss_mb()
+    return memory_profiling.peak_rss_mb()
+
+
+def best_hypothesis(all_tokens, all_scores, all_prev_indices, eos):
+    """
+    Backtracks the best hypothesis through the step outputs of a beam search,
+    laid out as the outputs of BeamSearch: one row per step, the first row
+    being the initial EOS. A hypothesis ends at its first EOS, or at the last
+    step. Returns its tokens (without EOS) and its score.
+    """
+    num_rows, beam_size = all_tokens.shape
+    finished = np.zeros(beam_size, dtype=bool)
+    best_score, best_step, best_index = -np.inf, 0, 0
+    for step in range(1, num_rows):
+        finished = finished[all_prev_indices[step]]
+        is_eos = all_tokens[step] == eos
+        ends = ~finished & (is_eos | (step == num_rows - 1))
+        for i in np.flatnonzero(ends):
+            if all_scores[step, i] > best_score:
+                best_score, best_step, best_index = all_scores[step, i], step, i
+        finished |= is_eos
+
+    tokens = []
+    i = best_index
+    for step in range(best_step, 0, -1):
+        tokens.append(int(all_tokens[step, i]))
+        i = all_prev_indices[step, i]
+    tokens.reverse()
+    if tokens and tokens[-1] == eos:
+        tokens = tokens[:-1]
+    return tokens, float(best_score)
+
+
+class TorchScriptBeamSearchRunner(object):
+    """
+    Runs a BeamSearch saved with save_to_pytorch on one sentence. Returns the
+    best hypothesis and its score.
+    """
+
+    def __init__(self, path, beam_size, eos):
+        self.module = torch.jit.load(path)
+        self.beam_size = beam_size
+        self.eos = eos
+
+    def set_num_threads(self, num_threads):
+        torch.set_num_threads(num_threads)
+
+    def __call__(self, src_inds, num_steps):
+        length = len(src_inds)
+        all_tokens, all_scores, _, all_prev_indices = self.module(
+            torch.LongTensor(src_inds).view(-1, 1),
+            torch.IntTensor([length]),
+            torch.LongTensor([self.eos]),
+            torch.FloatTensor([0.0]),
+            torch.zeros(length),
+            torch.zeros(self.beam_size, dtype=torch.int64),
+            num_steps,
+        )
+        return best_hypothesis(
+            all_tokens.numpy(),
+            all_scores.detach().numpy(),
+            all_prev_indices.numpy(),
+            self.eos,
+        )
+
+
+class TorchScriptBatchBeamSearchRunner(object):
+    """
+    Runs a BatchBeamSearch saved with save_to_pytorch on one sentence. Returns
+    the best hypothesis and its score.
+    """
+
+    def __init__(self, path, eos):
+        self.module = torch.jit.load(path)
+        self.eos = eos
+
+    def set_num_threads(self, num_threads):
+        torch.set_num_threads(num_threads)
+
+    def __call__(self, src_inds, num_steps):
+        tokens, scores, lengths, _ = self.module(
+            torch.LongTensor(src_inds).view(-1, 1),
+            torch.IntTensor([len(src_inds)]),
+            num_steps,
+        )
+        hypo = tokens[0, 0, : int(lengths[0, 0])].tolist()
+        if hypo and hypo[-1] == self.eos:
+            hypo = hypo[:-1]
+        return hypo, float(scores[0, 0])
+
+
+def init_caffe2(num_threads):
+    """
+    Sets the number of threads of Caffe2 operators. Caffe2 reads it once per
+    process, when it is first initialized.
+    """
+    from caffe2.python import workspace
+
+    workspace.GlobalInit(["caffe2", f"--caffe2_omp_num_threads={num_threads}"])
+
+
+def load_caffe2_predictor(path):
+    """
+    Returns the predict net of a Caffe2 predictor database (with parameters
+    loaded into the workspace) and the names of its inputs and outputs.
+    """
+    from caffe2.python.predictor import predictor_exporter, predictor_py_utils
+    from caffe2.python.predictor_constants import predictor_constants
+
+    meta_net_def = predictor_exporter.load_from_db(path, "minidb")
+    input_names = [
+        str(blob)
+        for blob in predictor_py_utils.GetBlobs(
+            meta_net_def, predictor_constants.INPUTS_BLOB_TYPE
+        )
+    ]
+    output_names = [
+        str(blob)
+        for blob in predictor_py_utils.GetBlobs(
+            meta_net_def, predictor_constants.OUTPUTS_BLOB_TYPE
+        )
+    ]
+    predict_net = predictor_exporter.prepare_prediction_net(path, "minidb")
+    return predict_net, input_names, output_names
+
+
+class Caffe2Runner(object):
+    """
+    Base class of the runners of Caffe2 artifacts. Each runner loads its
+    artifact into a workspace of its own, so that artifacts with the same
+    blob names can be loaded side by side.
+    """
+
+    def __init__(self, num_threads):
+        from caffe2.python import workspace
+
+        init_caffe2(num_threads)
+        self.num_threads = num_threads
+        self.workspace_name = f"{type(self).__name__}_{id(self)}"
+        workspace.SwitchWorkspace(self.workspace_name, True)
+
+    def set_num_threads(self, num_threads):
+        assert num_threads == self.num_threads, (
+            f"Caffe2 was initialized with {self.num_threads} threads and cannot "
+            f"switch to {num_threads}"
+        )
+
+
+class Caffe2BeamSearchRunner(Caffe2Runner):
+    """
+    Runs a beam search exported by onnx_full_export.py on one sentence.
+    Returns the best hypothesis and its score.
+    """
+
+    def __init__(self, path, beam_size, eos, num_threads=1):
+        super().__init__(num_threads)
+        self.predict_net, _, _ = load_caffe2_predictor(path)
+        self.beam_size = beam_size
+        self.eos = eos
+
+    def __call__(self, src_inds, num_steps):
+        from caffe2.python import workspace
+
+        workspace.SwitchWorkspace(self.workspace_name)
+        length = len(src_inds)
+        inputs = {
+            "src_tokens": np.array(src_inds, dtype="int64").reshape(-1, 1),
+            "src_lengths": np.array([length], dtype="int32"),
+            "prev_token": np.array([self.eos], dtype="int64"),
+            "prev_scores": np.array([0.0], dtype="float32"),
+            "attn_weights": np.zeros(length, dtype="float32"),
+            "prev_hypos_indices": np.zeros(self.beam_size, dtype="int64"),
+            "num_steps": np.array([num_steps], dtype="int64"),
+        }
+        for name, value in inputs.items():
+            workspace.FeedBlob(name, value)
+        workspace.RunNet(self.predict_net)
+        return best_hypothesis(
+            workspace.FetchBlob("all_tokens"),
+            workspace.FetchBlob("all_scores"),
+            workspace.FetchBlob("all_prev_indices"),
+            self.eos,
+        )
+
+
+class Caffe2ComponentsRunner(Caffe2Runner):
+    """
+    Runs the encoder and decoder step exported by onnx_component_export.py
+    on one sentence, driving the beam from Python the same way the C++
+    BatchedBeamSearch does, and stopping once all hypotheses are finished.
+    Returns the best hypothesis and its score.
+    """
+
+    def __init__(self, encoder_path, decoder_path, beam_size, eos, num_threads=1):
+        super().__init__(num_threads)
+        self.encoder_net, _, self.encoder_outputs = load_caffe2_predictor(encoder_path)
+        (
+            self.decoder_net,
+            decoder_inputs,
+            self.decoder_outputs,
+        ) = load_caffe2_predictor(decoder_path)
+        self.fixed_inputs = [
+            name for name in decoder_inputs if name.startswith("fixed_input_")
+        ]
+        self.beam_size = beam_size
+        self.eos = eos
+
+    def __call__(self, src_inds, num_steps):
+        from caffe2.python import workspace
+
+        workspace.SwitchWorkspace(self.workspace_name)
+        workspace.FeedBlob(
+            "encoder_inputs", np.array(src_inds, dtype="int64").reshape(-1, 1)
+        )
+        workspace.FeedBlob("encoder_lengths", np.array([len(src_inds)], "int32"))
+        workspace.RunNet(self.encoder_net)
+        for name in self.encoder_outputs:
+            decoder_name = name.replace("encoder_output_", "fixed_input_").replace(
+                "initial_state_", "state_input_"
+            )
+            workspace.FeedBlob(decoder_name, workspace.FetchBlob(name))
+
+        tokens = np.array([self.eos], dtype="int64")
+        scores = np.array([0.0], dtype="float32")
+        finished = np.zeros(1, dtype=bool)
+        all_tokens = [np.full(self.beam_size, self.eos, dtype="int64")]
+        all_scores = [np.zeros(self.beam_size, dtype="float32")]
+        all_prev_indices = [np.zeros(self.beam_size, dtype="int64")]
+        for step in range(num_steps):
+            workspace.FeedBlob("prev_tokens", tokens)
+            workspace.FeedBlob("prev_scores", scores)
+            workspace.FeedBlob("timestep", np.array([step], dtype="int64"))
+            workspace.RunNet(self.decoder_net)
+
+            tokens = workspace.FetchBlob("best_tokens_indices")
+            scores = workspace.FetchBlob("best_scores")
+            prev_hypos = workspace.FetchBlob("prev_hypos_indices")
+            all_tokens.append(tokens)
+            all_scores.append(scores)
+            all_prev_indices.append(prev_hypos)
+            for name in self.decoder_outputs:
+                if name.startswith("state_output_"):
+                    workspace.FeedBlob(
+                        name.replace("state_output_", "state_input_"),
+                        workspace.FetchBlob(name),
+                    )
+            if step == 0:
+                # encoder outputs are tiled to the beam after the first step
+                for name in self.fixed_inputs:
+                    workspace.FeedBlob(
+                        name, np.tile(workspace.FetchBlob(name), (1, self.beam_size, 1))
+                    )
+
+            finished = finished[prev_hypos] | (tokens == self.eos)
+            if finished.all():
+                break
+
+        return best_hypothesis(
+            np.stack(all_tokens),
+            np.stack(all_scores),
+            np.stack(all_prev_indices),
+            self.eos,
+        )
+
+
+def build_exported_model_runner(args, eos):
+    if args.exported_model_type == "pytorch":
+        return TorchScriptBeamSearchRunner(args.exported_model, args.beam, eos)
+    elif args.exported_model_type == "pytorch-batched":
+        return TorchScriptBatchBeamSearchRunner(args.exported_model, eos)
+    elif args.exported_model_type == "caffe2":
+        return Caffe2BeamSearchRunner(
+            args.exported_model, args.beam, eos, num_threads=args.num_threads[0]
+        )
+    elif args.exported_model_type == "caffe2-components":
+        assert (
+            args.exported_decoder_model
+        ), "--exported-decoder-model is required for caffe2-components"
+        return Caffe2ComponentsRunner(
+            args.exported_model,
+            args.exported_decoder_model,
+            args.beam,
+            eos,
+            num_threads=args.num_threads[0],
+        )
+    raise ValueError(f"Unknown exported model type {args.exported_model_type}")
+
+
+def timed_run(meter, num_tokens, run_fn):
+    """
+    Times run_fn() with a utils.BucketStopwatchMeter, in the bucket of
+    num_tokens source tokens. Returns the elapsed time in seconds.
+    """
+    bucket_id = min(meter.n_buckets - 1, num_tokens // meter.increment)
+    elapsed = meter.sum[bucket_id]
+    meter.start()
+    run_fn()
+    meter.stop(num_tokens)
+    return meter.sum[bucket_id] - elapsed
+
+
+def benchmark_exported_model(runner, sentences, runs, num_threads, args):
+    """
+    Translates sentences one call at a time, so latencies are per sentence.
+    They compare with eager latencies at --batch-sizes 1.
+    """
+    runner.set_num_threads(num_threads)
+    reset = memory_profiling.reset_peak_rss()
+
+    def num_steps(inds):
+        return int(args.max_len_a * len(inds) + args.max_len_b)
+
+    # priming
+    runner(sentences[0], num_steps(sentences[0]))
+
+    meter = pytorch_translate_utils.BucketStopwatchMeter(
+        increment=1,
+        max_length=max(len(inds) for inds in sentences),
+        sentences_per_batch=1,
+    )
+    latencies = []
+    for _ in range(runs):
+        for inds in sentences:
+            latencies.append(
+                timed_run(meter, len(inds), lambda: runner(inds, num_steps(inds)))
+            )
+    stats = latency_stats(latencies, peak_rss_since(reset))
+    # per token of the numberized sentences
+    stats["ms_per_token"] = 1000 * meter.avg
+    stats["tokens_per_sec"] = 1 / meter.avg
+    return stats
+
+
 def benchmark(args):
     assert args.source_vocab_file and os.path.isfile(
         args.source_vocab_file
@@ -107,15 +721,20 @@ def benchmark(args):
         args.target_vocab_file
     ), "Please specify a valid file for --target-vocab_file"
     assert args.path is not None, "--path required for generation!"
+    assert (
+        args.exported_model_type not in CAFFE2_EXPORTED_MODEL_TYPES
+        or len(args.num_threads) == 1
+    ), "Caffe2 artifacts take a single --num-threads value"
 
     print(args)
 
     # Benchmarking should be language-agnostic
     args.source_lang = "src"
     args.target_lang = "tgt"
+    random.seed(args.seed)
 
     models, model_args, task = pytorch_translate_utils.load_diverse_ensemble_for_inference(
-        args.path.split(":")
+        args.path.split(":"), inference_dtype=args.inference_dtype
     )
 
     append_eos_to_source = model_args[0].append_eos_to_source
@@ -126,63 +745,142 @@ def benchmark(args):
         for a in model_args
     )
 
-    def benchmark_length(n):
-        # Generate synthetic raw text files
-        source_text_file = generate_synthetic_text(
-            dialect=args.source_lang,
-            dialect_symbols=task.source_dictionary.symbols,
-            length=n,
-            examples=args.examples_per_length,
-        )
-        target_text_file = generate_synthetic_text(
-            dialect=args.target_lang,
-            dialect_symbols=task.target_dictionary.symbols,
-            length=n,
-            examples=args.examples_per_length,
-        )
+    batch_sizes = args.batch_sizes or [args.examples_per_length]
+    beam_sizes = args.beam_sizes or [args.beam]
+    buckets = sample_bucket_sentences(
+        args, task, append_eos_to_source, reverse_source, max(batch_sizes)
+    )
+    lengths = sorted(buckets.keys())
+    results = {"inference_dtype": args.inference_dtype, "eager": {}, "exported": {}}
 
-        task.load_dataset_from_text(
-            args.gen_subset,
-            source_text_file=source_text_file,
-            target_text_file=target_text_file,
-            append_eos=append_eos_to_source,
-            reverse_source=reverse_source,
+    def run_generation(generation_args):
+        return pytorch_translate_generate.generate_score(
+            models=models,
+            args=generation_args,
+            task=task,
+            dataset=task.dataset(args.gen_subset),
         )
 
-        # Remove temporary text files
-        os.remove(source_text_file)
-        os.remove(target_text_file)
+    rows = []
+    for beam_size in beam_sizes:
+        for batch_size in batch_sizes:
+            # args keeps the command line values for the next configurations
+            # and the exported model
+            config_args = copy.copy(args)
+            config_args.beam = beam_size
+            config_args.nbest = min(args.nbest, beam_size)
+            config_args.max_sentences = batch_size
+            config = f"beam_{beam_size}_batch_{batch_size}"
+            results["eager"][config] = {}
+            # Bucketed by the number of source tokens of the timed batches
+            meter = pytorch_translate_utils.BucketStopwatchMeter(
+                increment=1,
+                max_length=batch_size * max(lengths),
+                sentences_per_batch=batch_size,
+            )
+            for length in lengths:
+                source_sentences = buckets[length][:batch_size]
+                num_tokens = sum(len(sentence.split()) for sentence in source_sentences)
+                source_text_file = write_text_file(source_sentences)
+                target_text_file = write_text_file(
+                    synthetic_sentence(task.target_dictionary, length)
+                    for _ in range(batch_size)
+                )
+                task.load_dataset_from_text(
+                    args.gen_subset,
+                    source_text_file=source_text_file,
+                    target_text_file=target_text_file,
+                    append_eos=append_eos_to_source,
+                    reverse_source=reverse_source,
+                )
+                os.remove(source_text_file)
+                os.remove(target_text_file)
+
+                reset = memory_profiling.reset_peak_rss()
+                for _ in range(args.warmup_runs):
+                    run_generation(config_args)
+
+                # Bins of different lengths can have as many source tokens
+                bucket_id = min(meter.n_buckets - 1, num_tokens)
+                meter.reset_bucket(bucket_id)
+                latencies = [
+                    timed_run(meter, num_tokens, lambda: run_generation(config_args))
+                    for _ in range(args.runs_per_length)
+                ]
 
-        # priming
-        scorer, num_sentences, gen_timer, _ = pytorch_translate_generate.generate_score(
-            models=models, args=args, task=task, dataset=task.dataset(args.gen_subset)
+                # latencies are of whole batches, unlike the per-sentence
+                # latencies of exported models
+                stats = latency_stats(
+                    latencies,
+                    peak_rss_since(reset),
+                    num_sentences=batch_size * args.runs_per_length,
+                    prefix="batch_",
+                )
+                # per source token of the sentences actually in the bucket
+                seconds_per_token = meter.avgs[bucket_id]
+                stats["ms_per_token"] = 1000 * seconds_per_token
+                stats["tokens_per_sec"] = 1 / seconds_per_token
+                results["eager"][config][length] = stats
+                rows.append((beam_size, batch_size, length, stats))
+
+    print(
+        "| beam | batch | length | ms/batch (p50/p90/p99) | sentences/s "
+        "| ms/token | tokens/s |"
+    )
+    for beam_size, batch_size, length, stats in rows:
+        print(
+            f"| {beam_size} | {batch_size} | {length} "
+            f"| {stats['batch_latency_p50_ms']:.1f}/"
+            f"{stats['batch_latency_p90_ms']:.1f}/"
+            f"{stats['batch_latency_p99_ms']:.1f} | {stats['sentences_per_sec']:.2f} "
+            f"| {stats['ms_per_token']:.2f} | {stats['tokens_per_sec']:.1f} |"
         )
 
-        total_time = 0.0
-        for _ in range(args.runs_per_length):
-            scorer, num_sentences, gen_timer, _ = pytorch_translate_generate.generate_score(
-                models=models,
-                args=args,
-                task=task,
-                dataset=task.dataset(args.gen_subset),
+    if args.reference_file:
+        parity = inference_dtype_parity(
+            args, task, models, append_eos_to_source, reverse_source
+        )
+        results["parity"] = parity
+        for key, value in parity.items():
+            print(f"| {key}: {value:.4f}")
+
+    if args.exported_model:
+        exported_model_runner = build_exported_model_runner(
+            args, eos=task.target_dictionary.eos()
+        )
+        for length in lengths:
+            source_text_file = write_text_file(buckets[length])
+            sentences = quantization_report.read_sentences(
+                source_text_file,
+                task.source_dictionary,
+                append_eos=append_eos_to_source,
+                reverse_order=reverse_source,
             )
-            total_time += gen_timer.sum
-            gen_timer.reset()
-
-        sentences_per_run = args.examples_per_length
-        runs = args.runs_per_length
-        total_sentences = sentences_per_run * runs
-        total_tokens = total_sentences * n
-
-        print(f"--- {n} tokens ---")
-        print(f"Generated {total_tokens} tokens ({runs} runs of {sentences_per_run})")
-        print(f"Total time: {total_time:.3f} seconds")
-        time_per_sentence = total_time / total_sentences
-        print(f"Time per sentence: {time_per_sentence:.3f} seconds\n")
-
-    benchmark_length(6)
-    benchmark_length(10)
-    benchmark_length(20)
+            os.remove(source_text_file)
+            results["exported"][length] = {}
+            for num_threads in args.num_threads:
+                stats = benchmark_exported_model(
+                    exported_model_runner,
+                    sentences,
+                    args.runs_per_length,
+                    num_threads,
+                    args,
+                )
+                results["exported"][length][num_threads] = stats
+                print(
+                    f"Exported ({args.exported_model_type}, length {length}, "
+                    f"{num_threads} threads, one sentence per call): "
+                    f"p50 {stats['latency_p50_ms']:.1f} ms, "
+                    f"p90 {stats['latency_p90_ms']:.1f} ms, "
+                    f"p99 {stats['latency_p99_ms']:.1f} ms, "
+                    f"{stats['sentences_per_sec']:.2f} sentences/sec, "
+                    f"peak RSS {stats['peak_rss_mb']:.0f} MB"
+                )
+
+    if args.benchmark_output_file:
+        with open(args.benchmark_output_file, "w") as f:
+            json.dump(results, f, indent=2)
+    return results
 
 
 if __name__ == "__main__":
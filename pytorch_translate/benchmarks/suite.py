@@ -0,0 +1,447 @@
+#!/usr/bin/env python3
+
+"""
+Regression-tracking benchmarks for preprocessing, collating, training steps,
+beam search and export, built from the tiny models in test/utils.py.
+
+    python -m pytorch_translate.benchmarks.suite run --output-file baseline.json
+    python -m pytorch_translate.benchmarks.suite run --output-file new.json
+    python -m pytorch_translate.benchmarks.suite compare baseline.json new.json
+
+Everything runs on CPU so that results are comparable between machines
+with and without GPUs.
+"""
+
+import argparse
+import json
+import os
+import platform
+import re
+import sys
+import time
+from typing import Callable, Dict, List, NamedTuple
+
+import numpy as np
+import torch
+from fairseq import data
+from fairseq.trainer import Trainer
+from pytorch_translate import char_source_model  # noqa
+from pytorch_translate import hybrid_transformer_rnn  # noqa
+from pytorch_translate import rnn  # noqa
+from pytorch_translate import transformer  # noqa
+from pytorch_translate import (
+    beam_decode,
+    char_data,
+    utils as pytorch_translate_utils,
+    weighted_data,
+)
+from pytorch_translate.data import InMemoryNumpyDataset
+from pytorch_translate.ensemble_export import BeamSearch
+from pytorch_translate.tasks import pytorch_translate_task as tasks
+from pytorch_translate.test import utils as test_utils
+
+
+ARCHS = ["rnn", "transformer", "hybrid_transformer_rnn", "char_source"]
+
+BATCH_SIZE = 8
+MAX_DECODE_LENGTH = 12
+CORPUS_NUM_LINES = 2000
+
+
+class Benchmark(NamedTuple):
+    name: str
+    # "micro" benchmarks time a single component, "macro" benchmarks time
+    # an end-to-end operation such as decoding or exporting a model
+    kind: str
+    # Called once, untimed. Returns the function to time.
+    setup: Callable[[], Callable[[], None]]
+
+
+def model_args(arch):
+    """ModelParamsDict for one of the tiny test models, forced onto CPU."""
+    if arch == "char_source":
+        args = test_utils.ModelParamsDict(sequence_lstm=True)
+        args.arch = "char_source"
+        args.char_source_dict_size = 126
+        args.char_embed_dim = 8
+        args.char_rnn_units = 12
+        args.char_rnn_layers = 2
+    elif arch == "rnn":
+        args = test_utils.ModelParamsDict(sequence_lstm=True)
+    else:
+        args = test_utils.ModelParamsDict(arch=arch)
+    args.batch_size = BATCH_SIZE
+    args.cpu = True
+    return args
+
+
+def build_task_and_sample(arch):
+    args = model_args(arch)
+    samples, src_dict, tgt_dict = test_utils.prepare_inputs(args)
+    task = tasks.DictionaryHolderTask(src_dict, tgt_dict)
+    return args, task, next(samples)
+
+
+def write_corpus(dictionary, num_lines=CORPUS_NUM_LINES, min_len=5, max_len=30):
+    """Writes random sentences over the non-special words of dictionary."""
+    rng = np.random.RandomState(0)
+    words = dictionary.symbols[dictionary.nspecial :]
+    lines = []
+    for _ in range(num_lines):
+        length = rng.randint(min_len, max_len + 1)
+        lines.append(" ".join(rng.choice(words, size=length)))
+    return test_utils.write_lines_to_temp_file(lines)
+
+
+def corpus_dictionary():
+    return test_utils.dummy_dictionary(dummy_tokens=50)
+
+
+def char_dictionary():
+    return test_utils.dummy_dictionary(
+        dummy_tokens=0, additional_token_list=list("token_0123456789")
+    )
+
+
+def setup_parse():
+    dictionary = corpus_dictionary()
+    path = write_corpus(dictionary)
+
+    def run():
+        dataset = InMemoryNumpyDataset()
+        dataset.parse(path, dictionary, append_eos=True)
+
+    return run
+
+
+def parsed_language_pair():
+    dictionary = corpus_dictionary()
+    src = InMemoryNumpyDataset()
+    src.parse(write_corpus(dictionary), dictionary, append_eos=True)
+    tgt = InMemoryNumpyDataset()
+    tgt.parse(write_corpus(dictionary), dictionary, append_eos=True)
+    return dictionary, src, tgt
+
+
+def setup_collate_language_pair():
+    dictionary, src, tgt = parsed_language_pair()
+    dataset = data.LanguagePairDataset(
+        src, src.sizes, dictionary, tgt, tgt.sizes, dictionary
+    )
+    samples = [dataset[i] for i in range(64)]
+    return lambda: dataset.collater(samples)
+
+
+def setup_collate_weighted():
+    dictionary, src, tgt = parsed_language_pair()
+    dataset = weighted_data.WeightedLanguagePairDataset(
+        src, src.sizes, dictionary, tgt, tgt.sizes, dictionary, weights=[0.5]
+    )
+    samples = [dataset[i] for i in range(64)]
+    return lambda: dataset.collater(samples)
+
+
+def setup_collate_char_source():
+    dictionary = corpus_dictionary()
+    src = char_data.InMemoryNumpyWordCharDataset()
+    src.parse(write_corpus(dictionary), dictionary, char_dictionary(), append_eos=True)
+    tgt = InMemoryNumpyDataset()
+    tgt.parse(write_corpus(dictionary), dictionary, append_eos=True)
+    dataset = char_data.LanguagePairSourceCharDataset(
+        src, src.sizes, dictionary, tgt, tgt.sizes, dictionary
+    )
+    samples = [dataset[i] for i in range(64)]
+    # collater sorts its input in place, so hand it a fresh list every time
+    return lambda: dataset.collater(list(samples))
+
+
+def setup_train_step(arch):
+    def setup():
+        args, task, sample = build_task_and_sample(arch)
+        model = task.build_model(args)
+        criterion = task.build_criterion(args)
+        trainer = Trainer(args, task, model, criterion, dummy_batch=sample)
+        return lambda: trainer.train_step([sample])
+
+    return setup
+
+
+def char_source_encoder_input(src_tokens, src_lengths, char_dict_size):
+    bsz, srclen = src_tokens.size()
+    word_length = 5
+    return {
+        "src_tokens": src_tokens,
+        "src_lengths": src_lengths,
+        "char_inds": torch.randint(
+            low=0, high=char_dict_size, size=(bsz, srclen, word_length)
+        ).long(),
+        "word_lengths": torch.LongTensor(bsz, srclen).fill_(word_length),
+    }
+
+
+def setup_generate(arch, beam_size=5, inference_dtype="fp32"):
+    def setup():
+        args, task, sample = build_task_and_sample(arch)
+        model = task.build_model(args)
+        model.eval()
+        pytorch_translate_utils.cast_model_for_inference(model, inference_dtype)
+        use_char_source = arch == "char_source"
+        translator = beam_decode.SequenceGenerator(
+            [model],
+            task.target_dictionary,
+            beam_size=beam_size,
+            use_char_source=use_char_source,
+        )
+        src_tokens = sample["net_input"]["src_tokens"]
+        src_lengths = sample["net_input"]["src_lengths"]
+        if use_char_source:
+            encoder_input = char_source_encoder_input(
+                src_tokens, src_lengths, args.char_source_dict_size
+            )
+        else:
+            encoder_input = {"src_tokens": src_tokens, "src_lengths": src_lengths}
+        return lambda: translator.generate(encoder_input, maxlen=MAX_DECODE_LENGTH)
+
+    return setup
+
+
+def setup_beam_search_export(arch, beam_size=5):
+    def setup():
+        args, task, sample = build_task_and_sample(arch)
+        src_tokens = sample["net_input"]["src_tokens"][0:1].t()
+        src_lengths = sample["net_input"]["src_lengths"][0:1].int()
+        output_path = test_utils.make_temp_file()
+
+        def run():
+            # Export prepares the models in place, so every run gets fresh ones.
+            models = [task.build_model(args) for _ in range(2)]
+            beam_search = BeamSearch(
+                models,
+                task.target_dictionary,
+                src_tokens,
+                src_lengths,
+                beam_size=beam_size,
+            )
+            beam_search.save_to_pytorch(output_path)
+
+        return run
+
+    return setup
+
+
+def all_benchmarks() -> List[Benchmark]:
+    benchmarks = [
+        Benchmark("parse.in_memory_numpy", "micro", setup_parse),
+        Benchmark("collate.language_pair", "micro", setup_collate_language_pair),
+        Benchmark("collate.weighted", "micro", setup_collate_weighted),
+        Benchmark("collate.char_source", "micro", setup_collate_char_source),
+    ]
+    for arch in ARCHS:
+        # char-source samples need char_inds, which the test fixtures don't make
+        if arch != "char_source":
+            benchmarks.append(
+                Benchmark(f"train_step.{arch}", "micro", setup_train_step(arch))
+            )
+    for arch in ARCHS:
+        benchmarks.append(Benchmark(f"generate.{arch}", "macro", setup_generate(arch)))
+    # Compare against generate.{arch} for the cost of reduced precision decoding.
+    # These only time decoding; benchmark.py --reference-file checks accuracy.
+    for arch in ["rnn", "transformer"]:
+        benchmarks.append(
+            Benchmark(
+                f"generate.{arch}.bf16",
+                "macro",
+                setup_generate(arch, inference_dtype="bf16"),
+            )
+        )
+    for arch in ARCHS:
+        if arch != "char_source":
+            benchmarks.append(
+                Benchmark(
+                    f"export.beam_search.{arch}",
+                    "macro",
+                    setup_beam_search_export(arch),
+                )
+            )
+    return benchmarks
+
+
+def time_function(fn, repeats, warmup):
+    for _ in range(warmup):
+        fn()
+    timings_ms = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings_ms.append((time.perf_counter() - start) * 1000)
+    return {
+        "median_ms": float(np.median(timings_ms)),
+        "min_ms": float(np.min(timings_ms)),
+        "max_ms": float(np.max(timings_ms)),
+        "repeats": repeats,
+    }
+
+
+def select_benchmarks(benchmarks, pattern="", kind=""):
+    return [
+        b
+        for b in benchmarks
+        if (not pattern or re.search(pattern, b.name)) and (not kind or b.kind == kind)
+    ]
+
+
+def run_benchmarks(benchmarks, repeats=10, warmup=2, seed=1) -> Dict:
+    results = {}
+    for benchmark in benchmarks:
+        torch.manual_seed(seed)
+        np.random.seed(seed)
+        fn = benchmark.setup()
+        result = time_function(fn, repeats=repeats, warmup=warmup)
+        result["kind"] = benchmark.kind
+        results[benchmark.name] = result
+        print(f"| {benchmark.name}: {result['median_ms']:.2f} ms (median)", flush=True)
+    return {
+        "metadata": {
+            "torch_version": torch.__version__,
+            "num_threads": torch.get_num_threads(),
+            "python_version": platform.python_version(),
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        },
+        "results": results,
+    }
+
+
+def compare_results(baseline, current, threshold=0.1):
+    """
+    Compares median timings of two result dicts. Returns a list of
+    (name, baseline_ms, current_ms, relative_change, regressed) tuples for
+    benchmarks present in both, where regressed means the current median is
+    slower than the baseline by more than threshold (relative).
+    """
+    comparisons = []
+    for name, base in sorted(baseline["results"].items()):
+        if name not in current["results"]:
+            continue
+        base_ms = base["median_ms"]
+        current_ms = current["results"][name]["median_ms"]
+        change = (current_ms - base_ms) / base_ms if base_ms > 0 else 0.0
+        comparisons.append((name, base_ms, current_ms, change, change > threshold))
+    return comparisons
+
+
+def print_comparison(comparisons, baseline, current):
+    print(f"| {'benchmark':<40} {'baseline ms':>12} {'current ms':>12} {'change':>8}")
+    for name, base_ms, current_ms, change, regressed in comparisons:
+        flag = "  REGRESSION" if regressed else ""
+        print(
+            f"| {name:<40} {base_ms:>12.2f} {current_ms:>12.2f} "
+            f"{change * 100:>+7.1f}%{flag}"
+        )
+    for name in sorted(set(baseline["results"]) - set(current["results"])):
+        print(f"| {name}: missing from current results")
+    for name in sorted(set(current["results"]) - set(baseline["results"])):
+        print(f"| {name}: new, no baseline")
+    if baseline.get("metadata") != current.get("metadata"):
+        print("| Note: metadata differs, timings may not be comparable:")
+        for key in sorted(set(baseline["metadata"]) | set(current["metadata"])):
+            if key == "timestamp":
+                continue
+            base_value = baseline["metadata"].get(key)
+            current_value = current["metadata"].get(key)
+            if base_value != current_value:
+                print(f"|   {key}: {base_value} -> {current_value}")
+
+
+def read_results(path):
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Run CPU benchmarks and compare them against a baseline."
+    )
+    subparsers = parser.add_subparsers(dest="command")
+
+    run_parser = subparsers.add_parser("run", help="Run benchmarks.")
+    run_parser.add_argument(
+        "--output-file",
+        default="",
+        help="JSON file to write results to, e.g. a new baseline.",
+    )
+    run_parser.add_argument(
+        "--filter",
+        default="",
+        help="Only run benchmarks whose name matches this regular expression.",
+    )
+    run_parser.add_argument(
+        "--kind",
+        default="",
+        choices=["", "micro", "macro"],
+        help="Only run micro or macro benchmarks.",
+    )
+    run_parser.add_argument(
+        "--repeats", type=int, default=10, help="Timed runs per benchmark."
+    )
+    run_parser.add_argument(
+        "--warmup", type=int, default=2, help="Untimed runs per benchmark."
+    )
+    run_parser.add_argument(
+        "--num-threads",
+        type=int,
+        default=1,
+        help="Number of intra-op threads. Fixed by default to reduce noise.",
+    )
+    run_parser.add_argument(
+        "--list", action="store_true", help="List benchmark names and exit."
+    )
+
+    compare_parser = subparsers.add_parser(
+        "compare", help="Compare results against a baseline."
+    )
+    compare_parser.add_argument("baseline", help="Baseline JSON results.")
+    compare_parser.add_argument("current", help="JSON results to check.")
+    compare_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Relative slowdown of the median above which a benchmark is "
+        "flagged as a regression (0.1 = 10%%).",
+    )
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    if args.command == "compare":
+        baseline = read_results(args.baseline)
+        current = read_results(args.current)
+        comparisons = compare_results(baseline, current, threshold=args.threshold)
+        print_comparison(comparisons, baseline, current)
+        num_regressions = sum(regressed for *_, regressed in comparisons)
+        print(f"| {num_regressions} regression(s) above {args.threshold * 100:.0f}%")
+        return 1 if num_regressions > 0 else 0
+    elif args.command == "run":
+        benchmarks = select_benchmarks(all_benchmarks(), args.filter, args.kind)
+        if args.list:
+            for benchmark in benchmarks:
+                print(f"{benchmark.name} ({benchmark.kind})")
+            return 0
+        torch.set_num_threads(args.num_threads)
+        results = run_benchmarks(benchmarks, repeats=args.repeats, warmup=args.warmup)
+        if args.output_file:
+            with open(args.output_file, "w") as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+            print(f"| Wrote results to {args.output_file}")
+        return 0
+    get_parser().print_help()
+    return 1
+
+
+if __name__ == "__main__":
+    # Hide GPUs before anything initializes CUDA so that all benchmarks run
+    # on CPU regardless of the machine.
+    os.environ["CUDA_VISIBLE_DEVICES"] = ""
+    sys.exit(main())
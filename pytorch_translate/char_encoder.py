@@ -166,11 +166,18 @@ class CharCNNModel(nn.Module):
         use_pretrained_weights=False,
         finetune_pretrained_weights=False,
         weights_file=None,
+        # Words are convolved in groups whose lengths are rounded up to a
+        # multiple of length_bucket_size. 0 convolves all words at the full
+        # padded length of the batch.
+        length_bucket_size=4,
     ):
         super().__init__()
         self.dictionary = dictionary
         self.padding_idx = dictionary.pad()
         self.use_pretrained_weights = use_pretrained_weights
+        self.length_bucket_size = length_bucket_size
+        # disables length bucketing if True (enables ONNX tracing)
+        self.onnx_export_model = False
 
         # model parameters
         self.pool_type = pool_type
@@ -365,25 +372,15 @@ class CharCNNModel(nn.Module):
         self.projection.weight.requires_grad = self._finetune_pretrained_weights
         self.projection.bias.requires_grad = self._finetune_pretrained_weights
 
-    def forward(self, char_inds_flat):
-        x = self.embed_chars(char_inds_flat)
-        encoder_padding_mask = char_inds_flat.eq(self.padding_idx)
-        char_lengths = torch.sum(1 - encoder_padding_mask, dim=0)
-        if not encoder_padding_mask.any():
-            encoder_padding_mask = None
+    def prepare_for_onnx_export_(self, **kwargs):
+        self.onnx_export_model = True
 
-        kernel_outputs = []
-        for conv in self.convolutions:
-            if encoder_padding_mask is not None:
-                x = x.masked_fill(encoder_padding_mask.unsqueeze(-1), 0)
-            # conv input: [total_words, char_emb_dim, seq_len]
-            # conv output: [total_words, in_channel_dim, seq_len]
-            conv_output = conv(x.permute(1, 2, 0))
-            kernel_outputs.append(conv_output)
-        # Pooling over the entire seq
-        pools = [self.pooling(conv, char_lengths, dim=2) for conv in kernel_outputs]
-        # [total_words, sum(output_channel_dim)]
-        encoder_output = torch.cat([p for p in pools], 1)
+    def forward(self, char_inds_flat):
+        # char_inds_flat: [max_word_len, total_words]
+        if self.onnx_export_model or not self.length_bucket_size:
+            encoder_output = self._encode_words(char_inds_flat)
+        else:
+            encoder_output = self._encode_words_by_length(char_inds_flat)
 
         for highway_layer in self.highway_layers:
             encoder_output = highway_layer(encoder_output)
@@ -394,16 +391,104 @@ class CharCNNModel(nn.Module):
         # (total_words, output_dim)
         return encoder_output
 
-    def pooling(self, inputs, char_lengths, dim):
+    def _encode_words(self, char_inds_flat, num_pad_positions=0):
+        """
+        Convolves and pools the characters of a group of words.
+
+        Args:
+            char_inds_flat: [word_len, num_words] character indices
+            num_pad_positions: number of trailing padding characters that have
+                been cut off from char_inds_flat. Pooling treats them as if
+                they were still there.
+
+        Returns:
+            [num_words, sum(output_channel_dim)]
+        """
+        x = self.embed_chars(char_inds_flat)
+        encoder_padding_mask = char_inds_flat.eq(self.padding_idx)
+        if encoder_padding_mask.any():
+            x = x.masked_fill(encoder_padding_mask.unsqueeze(-1), 0)
+        # conv input: [num_words, char_emb_dim, word_len]
+        x = x.permute(1, 2, 0)
+
+        pools = []
+        for conv in self.convolutions:
+            # conv output: [num_words, out_channel_dim, word_len + kernel_size + 1]
+            conv_output = conv(x)
+            pad_output = None
+            if num_pad_positions > 0:
+                # The output for a window which only covers padding
+                pad_output = conv(x.new_zeros(1, x.size(1), 1))[:, :, 0]
+            pools.append(
+                self.pooling(
+                    conv_output,
+                    dim=2,
+                    pad_output=pad_output,
+                    num_pad_positions=num_pad_positions,
+                )
+            )
+        # [num_words, sum(output_channel_dim)]
+        return torch.cat(pools, 1)
+
+    def _encode_words_by_length(self, char_inds_flat):
+        """
+        Same as _encode_words(), but groups words by length so that short words
+        are not convolved at the length of the longest word in the batch.
+        """
+        max_word_len, total_words = char_inds_flat.size()
+        bucket_size = self.length_bucket_size
+        char_lengths = char_inds_flat.ne(self.padding_idx).long().sum(dim=0)
+        # round up to a multiple of the bucket size, with at least one char
+        bucket_lengths = (
+            (char_lengths.clamp(min=1) + bucket_size - 1) // bucket_size * bucket_size
+        ).clamp(max=max_word_len)
+        unique_lengths = torch.unique(bucket_lengths).tolist()
+        if len(unique_lengths) == 1:
+            return self._encode_words(char_inds_flat)
+
+        word_orders = []
+        bucket_outputs = []
+        for bucket_len in unique_lengths:
+            word_indices = torch.nonzero(bucket_lengths == bucket_len).squeeze(1)
+            word_orders.append(word_indices)
+            bucket_outputs.append(
+                self._encode_words(
+                    char_inds_flat[:bucket_len].index_select(1, word_indices),
+                    num_pad_positions=max_word_len - bucket_len,
+                )
+            )
+        # restore the original word order
+        _, inverse_order = torch.sort(torch.cat(word_orders))
+        return torch.cat(bucket_outputs, 0).index_select(0, inverse_order)
+
+    def pooling(self, inputs, dim, pad_output=None, num_pad_positions=0):
+        """
+        Pools inputs over dim. If num_pad_positions > 0, pooling includes as
+        many additional positions with pad_output as their value.
+        """
         if self.pool_type == "max":
+            # windows only covering padding are always part of inputs, since
+            # convolutions pad by the kernel size
             return torch.max(inputs, dim=dim)[0]
 
-        elif self.pool_type == "mean":
-            return torch.mean(inputs, dim=dim)
+        num_positions = inputs.size(dim) + num_pad_positions
+        if self.pool_type == "mean":
+            total = torch.sum(inputs, dim=dim)
+            if num_pad_positions > 0:
+                total = total + num_pad_positions * pad_output
+            return total / num_positions
 
         elif self.pool_type == "logsumexp":
-            logsumexp = inputs.exp().mean(dim=dim, keepdim=True).log()
-            return logsumexp.squeeze(dim)
+            # log(mean(exp(inputs))), computed relative to the maximum for
+            # numerical stability
+            max_inputs = torch.max(inputs, dim=dim, keepdim=True)[0]
+            if num_pad_positions > 0:
+                max_inputs = torch.max(max_inputs, pad_output.unsqueeze(dim))
+            total = torch.sum(torch.exp(inputs - max_inputs), dim=dim)
+            max_inputs = max_inputs.squeeze(dim)
+            if num_pad_positions > 0:
+                total = total + num_pad_positions * torch.exp(pad_output - max_inputs)
+            return max_inputs + torch.log(total / num_positions)
 
         else:
             raise Exception("Invalid pool type: {}".format(self.pool_type))
@@ -3,6 +3,8 @@
 import os
 from typing import Optional
 
+import numpy as np
+from fairseq.data import data_utils as fairseq_data_utils
 from pytorch_translate import char_data, data as pytorch_translate_data, weighted_data
 
 
@@ -88,6 +90,53 @@ def load_monolingual_dataset(
     return dataset
 
 
+def get_target_lang_ids(dataset):
+    """Returns a numpy array with the target language ID of every example in
+    a multilingual language pair dataset. Target sentences are expected to
+    start with the language ID token."""
+    tgt = dataset.tgt
+    if isinstance(tgt, pytorch_translate_data.InMemoryNumpyDataset):
+        lang_tokens = tgt.buffer[tgt.offsets[:-1]]
+    else:
+        lang_tokens = np.array([tgt[i][0].item() for i in range(len(tgt))])
+    lang_tokens = lang_tokens.astype(np.int64)
+    return lang_tokens - pytorch_translate_data.MULTILING_DIALECT_ID_OFFSET
+
+
+def batch_by_size_and_lang(
+    indices,
+    lang_ids,
+    num_tokens_fn,
+    max_tokens=None,
+    max_sentences=None,
+    required_batch_size_multiple=1,
+):
+    """Like fairseq.data.data_utils.batch_by_size(), but only puts examples
+    with the same language ID into a batch. The order of `indices` is kept
+    within each language.
+
+    Args:
+        indices (np.array): ordered list of dataset indices
+        lang_ids (np.array): language ID of every example in the dataset
+        num_tokens_fn, max_tokens, max_sentences, required_batch_size_multiple:
+            see fairseq.data.data_utils.batch_by_size()
+    """
+    indices = np.asarray(indices)
+    index_lang_ids = lang_ids[indices]
+    batches = []
+    for lang_id in np.unique(index_lang_ids):
+        batches.extend(
+            fairseq_data_utils.batch_by_size(
+                indices[index_lang_ids == lang_id],
+                num_tokens_fn,
+                max_tokens=max_tokens,
+                max_sentences=max_sentences,
+                required_batch_size_multiple=required_batch_size_multiple,
+            )
+        )
+    return batches
+
+
 def validate_corpus_exists(
     corpus: pytorch_translate_data.ParallelCorpusConfig, split: str
 ):
@@ -20,6 +20,7 @@ from caffe2.python.onnx import backend as caffe2_backend
 from caffe2.python.predictor import predictor_exporter
 from fairseq import tasks, utils
 from fairseq.models import ARCH_MODEL_REGISTRY
+from pytorch_translate.attention import attention_utils
 from pytorch_translate.tasks.pytorch_translate_task import DictionaryHolderTask
 from pytorch_translate.transformer import TransformerEncoder
 from pytorch_translate.word_prediction import word_prediction_model
@@ -120,6 +121,35 @@ def load_models_from_checkpoints(
     return models, src_dict, dst_dict
 
 
+QUANTIZE_OPTIONS = ["none", "dynamic-int8", "fp16"]
+
+
+def quantize_module(module, quantize="none"):
+    """
+    Replaces the linear (and, for int8, LSTM cell) submodules of module with
+    dynamically quantized versions. quantize is one of QUANTIZE_OPTIONS; for
+    backward compatibility True and False mean "dynamic-int8" and "none".
+    fp16 only applies to linear layers and leaves RNN cells in fp32.
+    """
+    if quantize is True:
+        quantize = "dynamic-int8"
+    elif quantize is False or quantize is None:
+        quantize = "none"
+
+    if quantize == "none":
+        return module
+    elif quantize == "dynamic-int8":
+        module = torch.jit.quantized.quantize_linear_modules(module)
+        return torch.jit.quantized.quantize_rnn_cell_modules(module)
+    elif quantize == "fp16":
+        return torch.jit.quantized.quantize_linear_modules(
+            module, dtype=torch.float16
+        )
+    raise ValueError(
+        f"Unknown quantization {quantize}, expected one of {QUANTIZE_OPTIONS}"
+    )
+
+
 def merge_transpose_and_batchmatmul(caffe2_backend_rep):
     """
     Fuses Transpose and BatchMatMul ops if the Transpose inverts the last two
@@ -392,6 +422,7 @@ class EncoderEnsemble(nn.Module):
         src_dict_filename,
         dst_dict_filename,
         lexical_dict_paths=None,
+        quantize="none",
     ):
         models, src_dict, _ = load_models_from_checkpoints(
             checkpoint_filenames,
@@ -399,7 +430,7 @@ class EncoderEnsemble(nn.Module):
             dst_dict_filename,
             lexical_dict_paths,
         )
-        return cls(models, src_dict=src_dict)
+        return quantize_module(cls(models, src_dict=src_dict), quantize)
 
 
 class DecoderBatchedStepEnsemble(nn.Module):
@@ -439,6 +470,99 @@ class DecoderBatchedStepEnsemble(nn.Module):
         len(self.models) elements of inputs) must be tiled k (beam size)
         times on the batch dimension (axis 1).
         """
+        (
+            average_log_probs,
+            average_attn_weights,
+            possible_translation_tokens,
+            state_outputs,
+            beam_axis_per_state,
+        ) = self._step_models(input_tokens, timestep, inputs)
+
+        best_scores_k_by_k, best_tokens_k_by_k = torch.topk(
+            average_log_probs.squeeze(1), k=self.beam_size
+        )
+
+        prev_scores_k_by_k = prev_scores.view(-1, 1).expand(-1, self.beam_size)
+        total_scores_k_by_k = best_scores_k_by_k + prev_scores_k_by_k
+
+        # flatten to take top k over all (beam x beam) hypos
+        total_scores_flat = total_scores_k_by_k.view(-1)
+        best_tokens_flat = best_tokens_k_by_k.view(-1)
+
+        best_scores, best_indices = torch.topk(total_scores_flat, k=self.beam_size)
+
+        best_tokens = best_tokens_flat.index_select(dim=0, index=best_indices).view(-1)
+
+        # integer division to determine which input produced each successor
+        prev_hypos = best_indices / self.beam_size
+
+        attention_weights = average_attn_weights.index_select(dim=0, index=prev_hypos)
+
+        if possible_translation_tokens is not None:
+            best_tokens = possible_translation_tokens.index_select(
+                dim=0, index=best_tokens
+            )
+
+        word_rewards_for_best_tokens = self.word_rewards.index_select(0, best_tokens)
+        best_scores += word_rewards_for_best_tokens
+
+        self.input_names = ["prev_tokens", "prev_scores", "timestep"]
+        for i in range(len(self.models)):
+            self.input_names.append(f"fixed_input_{i}")
+
+        if possible_translation_tokens is not None:
+            self.input_names.append("possible_translation_tokens")
+
+        # 'attention_weights_average' output shape: (src_length x beam_size)
+        attention_weights = attention_weights.squeeze(1)
+
+        outputs = [best_tokens, best_scores, prev_hypos, attention_weights]
+        self.output_names = [
+            "best_tokens_indices",
+            "best_scores",
+            "prev_hypos_indices",
+            "attention_weights_average",
+        ]
+        for i in range(len(self.models)):
+            self.output_names.append(f"fixed_input_{i}")
+            if self.tile_internal:
+                outputs.append(inputs[i].repeat(1, self.beam_size, 1))
+            else:
+                outputs.append(inputs[i])
+
+        if possible_translation_tokens is not None:
+            self.output_names.append("possible_translation_tokens")
+            outputs.append(possible_translation_tokens)
+
+        outputs.extend(
+            self._reorder_states(state_outputs, beam_axis_per_state, prev_hypos)
+        )
+
+        return tuple(outputs)
+
+    def _reorder_states(self, state_outputs, beam_axis_per_state, prev_hypos):
+        next_states = []
+        for i, state in enumerate(state_outputs):
+            beam_axis = beam_axis_per_state[i]
+            if beam_axis is None:
+                next_state = state
+                # to ensure correct Caffe2 export during save_to_db()
+                self.copied_from[f"state_output_{i}"] = f"state_input_{i}"
+            else:
+                next_state = state.index_select(dim=beam_axis, index=prev_hypos)
+            next_states.append(next_state)
+            self.output_names.append(f"state_output_{i}")
+            self.input_names.append(f"state_input_{i}")
+        return next_states
+
+    def _step_models(self, input_tokens, timestep, inputs, src_lengths=None):
+        """
+        Runs one decoder step of every model in the ensemble and returns
+        (average_log_probs, average_attn_weights, possible_translation_tokens,
+        state_outputs, beam_axis_per_state). If src_lengths (one per row of
+        input_tokens) is given, the decoders mask out source padding;
+        otherwise all rows are assumed to share the full source length.
+        """
         log_probs_per_model = []
         attn_weights_per_model = []
         state_outputs = []
@@ -461,6 +585,14 @@ class DecoderBatchedStepEnsemble(nn.Module):
         else:
             possible_translation_tokens = None
 
+        if src_lengths is not None:
+            # (batch x max_src_length), nonzero at padding positions
+            src_padding_mask = attention_utils.create_src_lengths_mask(
+                batch_size=src_lengths.size(0), src_lengths=src_lengths
+            ).eq(0)
+        else:
+            src_padding_mask = None
+
         futures = []
 
         for i, model in enumerate(self.models):
@@ -500,12 +632,17 @@ class DecoderBatchedStepEnsemble(nn.Module):
                     reduced_output_weights = None
                 reduced_output_weights_per_model.append(reduced_output_weights)
 
-                # no batching, we only care about care about "max" length
-                src_length_int = int(encoder_output.size()[0])
-                src_length = torch.LongTensor(np.array([src_length_int]))
+                if src_lengths is None:
+                    # no batching, we only care about care about "max" length
+                    src_length_int = int(encoder_output.size()[0])
+                    src_length = torch.LongTensor(np.array([src_length_int]))
 
-                # notional, not actually used for decoder computation
-                src_tokens = torch.LongTensor(np.array([[0] * src_length_int]))
+                    # notional, not actually used for decoder computation
+                    src_tokens = torch.LongTensor(np.array([[0] * src_length_int]))
+                else:
+                    src_length = src_lengths
+                    # notional, not actually used for decoder computation
+                    src_tokens = src_padding_mask.long()
                 src_embeddings = encoder_output.new_zeros(encoder_output.shape)
 
                 encoder_out = (
@@ -597,7 +734,7 @@ class DecoderBatchedStepEnsemble(nn.Module):
                     state_inputs.extend(inputs[next_state_input : next_state_input + 4])
                     next_state_input += 4
 
-                encoder_out = (encoder_output, None, None)
+                encoder_out = (encoder_output, None, src_padding_mask)
 
                 # TODO(jcross)
                 reduced_output_weights = None
@@ -642,7 +779,7 @@ class DecoderBatchedStepEnsemble(nn.Module):
                 model.decoder._is_incremental_eval = True
                 model.eval()
 
-                encoder_out = (encoder_output, None, None)
+                encoder_out = (encoder_output, None, src_padding_mask)
 
                 num_states = (1 + model.decoder.num_layers) * 2
                 state_inputs = inputs[next_state_input : next_state_input + num_states]
@@ -755,76 +892,14 @@ class DecoderBatchedStepEnsemble(nn.Module):
             torch.cat(attn_weights_per_model, dim=1), dim=1, keepdim=True
         )
 
-        best_scores_k_by_k, best_tokens_k_by_k = torch.topk(
-            average_log_probs.squeeze(1), k=self.beam_size
+        return (
+            average_log_probs,
+            average_attn_weights,
+            possible_translation_tokens,
+            state_outputs,
+            beam_axis_per_state,
         )
 
-        prev_scores_k_by_k = prev_scores.view(-1, 1).expand(-1, self.beam_size)
-        total_scores_k_by_k = best_scores_k_by_k + prev_scores_k_by_k
-
-        # flatten to take top k over all (beam x beam) hypos
-        total_scores_flat = total_scores_k_by_k.view(-1)
-        best_tokens_flat = best_tokens_k_by_k.view(-1)
-
-        best_scores, best_indices = torch.topk(total_scores_flat, k=self.beam_size)
-
-        best_tokens = best_tokens_flat.index_select(dim=0, index=best_indices).view(-1)
-
-        # integer division to determine which input produced each successor
-        prev_hypos = best_indices / self.beam_size
-
-        attention_weights = average_attn_weights.index_select(dim=0, index=prev_hypos)
-
-        if possible_translation_tokens is not None:
-            best_tokens = possible_translation_tokens.index_select(
-                dim=0, index=best_tokens
-            )
-
-        word_rewards_for_best_tokens = self.word_rewards.index_select(0, best_tokens)
-        best_scores += word_rewards_for_best_tokens
-
-        self.input_names = ["prev_tokens", "prev_scores", "timestep"]
-        for i in range(len(self.models)):
-            self.input_names.append(f"fixed_input_{i}")
-
-        if possible_translation_tokens is not None:
-            self.input_names.append("possible_translation_tokens")
-
-        # 'attention_weights_average' output shape: (src_length x beam_size)
-        attention_weights = attention_weights.squeeze(1)
-
-        outputs = [best_tokens, best_scores, prev_hypos, attention_weights]
-        self.output_names = [
-            "best_tokens_indices",
-            "best_scores",
-            "prev_hypos_indices",
-            "attention_weights_average",
-        ]
-        for i in range(len(self.models)):
-            self.output_names.append(f"fixed_input_{i}")
-            if self.tile_internal:
-                outputs.append(inputs[i].repeat(1, self.beam_size, 1))
-            else:
-                outputs.append(inputs[i])
-
-        if possible_translation_tokens is not None:
-            self.output_names.append("possible_translation_tokens")
-            outputs.append(possible_translation_tokens)
-
-        for i, state in enumerate(state_outputs):
-            beam_axis = beam_axis_per_state[i]
-            if beam_axis is None:
-                next_state = state
-                # to ensure correct Caffe2 export during save_to_db()
-                self.copied_from[f"state_output_{i}"] = f"state_input_{i}"
-            else:
-                next_state = state.index_select(dim=beam_axis, index=prev_hypos)
-            outputs.append(next_state)
-            self.output_names.append(f"state_output_{i}")
-            self.input_names.append(f"state_input_{i}")
-
-        return tuple(outputs)
-
     def onnx_export(self, output_path, encoder_ensemble_outputs):
         # single EOS (as flat array)
         input_token = torch.LongTensor(np.array([self.tgt_dict.eos()]))
@@ -854,6 +929,7 @@ class DecoderBatchedStepEnsemble(nn.Module):
         word_reward=0,
         unk_reward=0,
         lexical_dict_paths=None,
+        quantize="none",
     ):
         models, _, tgt_dict = load_models_from_checkpoints(
             checkpoint_filenames,
@@ -861,13 +937,14 @@ class DecoderBatchedStepEnsemble(nn.Module):
             dst_dict_filename,
             lexical_dict_paths,
         )
-        return cls(
+        decoder_step_ensemble = cls(
             models,
             tgt_dict,
             beam_size=beam_size,
             word_reward=word_reward,
             unk_reward=unk_reward,
         )
+        return quantize_module(decoder_step_ensemble, quantize)
 
     def save_to_db(self, output_path, encoder_ensemble_outputs):
         """
@@ -891,6 +968,124 @@ class DecoderBatchedStepEnsemble(nn.Module):
         )
 
 
+class DecoderBatchedMultiSentenceStepEnsemble(DecoderBatchedStepEnsemble):
+    """
+    Decoder step over a batch of source sentences, each with its own beam.
+    Rows of the decoder inputs are grouped by sentence: one row per sentence
+    on the first step (tile_internal=True), beam_size rows per sentence
+    afterwards. src_lengths holds the source length of each row and is used
+    to mask source padding. A hypothesis whose previous token is EOS is
+    finished and can only be extended by EOS at no cost.
+    """
+
+    def __init__(
+        self,
+        models,
+        tgt_dict,
+        beam_size,
+        word_reward=0,
+        unk_reward=0,
+        tile_internal=False,
+    ):
+        super().__init__(
+            models,
+            tgt_dict,
+            beam_size,
+            word_reward=word_reward,
+            unk_reward=unk_reward,
+            tile_internal=tile_internal,
+        )
+        self.finished_scores = torch.FloatTensor(beam_size).fill_(float("-inf"))
+        self.finished_scores[0] = 0
+
+    def forward(self, input_tokens, prev_scores, timestep, src_lengths, *inputs):
+        (
+            average_log_probs,
+            average_attn_weights,
+            possible_translation_tokens,
+            state_outputs,
+            beam_axis_per_state,
+        ) = self._step_models(input_tokens, timestep, inputs, src_lengths=src_lengths)
+
+        best_scores_k_by_k, best_tokens_k_by_k = torch.topk(
+            average_log_probs.squeeze(1), k=self.beam_size
+        )
+        if possible_translation_tokens is not None:
+            best_tokens_k_by_k = possible_translation_tokens.index_select(
+                dim=0, index=best_tokens_k_by_k.view(-1)
+            ).view_as(best_tokens_k_by_k)
+
+        eos = self.tgt_dict.eos()
+        finished = (input_tokens == eos) & (timestep > 0)
+        finished = finished.view(-1, 1).expand_as(best_scores_k_by_k)
+        best_scores_k_by_k = torch.where(
+            finished,
+            self.finished_scores.view(1, -1).expand_as(best_scores_k_by_k),
+            best_scores_k_by_k,
+        )
+        best_tokens_k_by_k = best_tokens_k_by_k.masked_fill(finished, eos)
+
+        prev_scores_k_by_k = prev_scores.view(-1, 1).expand(-1, self.beam_size)
+        total_scores_k_by_k = best_scores_k_by_k + prev_scores_k_by_k
+
+        # take top k over all (hypos x beam) candidates of each sentence
+        hypos_per_sentence = 1 if self.tile_internal else self.beam_size
+        num_candidates = hypos_per_sentence * self.beam_size
+        total_scores = total_scores_k_by_k.view(-1, num_candidates)
+        candidate_tokens = best_tokens_k_by_k.view(-1, num_candidates)
+
+        best_scores, best_indices = torch.topk(total_scores, k=self.beam_size)
+        best_tokens = candidate_tokens.gather(dim=1, index=best_indices).view(-1)
+
+        # row of the first hypothesis of each sentence
+        sentence_offsets = (
+            torch.ones_like(best_indices[:, :1]).cumsum(dim=0) - 1
+        ) * hypos_per_sentence
+        prev_hypos = (best_indices / self.beam_size + sentence_offsets).view(-1)
+
+        word_rewards_for_best_tokens = self.word_rewards.index_select(0, best_tokens)
+        best_scores = best_scores.view(-1) + word_rewards_for_best_tokens
+
+        # 'attention_weights_average' output shape: (num_hypos x src_length)
+        attention_weights = average_attn_weights.index_select(
+            dim=0, index=prev_hypos
+        ).squeeze(1)
+
+        self.input_names = ["prev_tokens", "prev_scores", "timestep", "src_lengths"]
+        outputs = [best_tokens, best_scores, prev_hypos, attention_weights]
+        self.output_names = [
+            "best_tokens_indices",
+            "best_scores",
+            "prev_hypos_indices",
+            "attention_weights_average",
+            "src_lengths",
+        ]
+        # fixed inputs are shared by all hypotheses of a sentence, so they
+        # only need to be tiled out from one row per sentence
+        if self.tile_internal:
+            outputs.append(src_lengths.index_select(dim=0, index=prev_hypos))
+        else:
+            outputs.append(src_lengths)
+        for i in range(len(self.models)):
+            self.input_names.append(f"fixed_input_{i}")
+            self.output_names.append(f"fixed_input_{i}")
+            if self.tile_internal:
+                outputs.append(inputs[i].index_select(dim=1, index=prev_hypos))
+            else:
+                outputs.append(inputs[i])
+
+        if possible_translation_tokens is not None:
+            self.input_names.append("possible_translation_tokens")
+            self.output_names.append("possible_translation_tokens")
+            outputs.append(possible_translation_tokens)
+
+        outputs.extend(
+            self._reorder_states(state_outputs, beam_axis_per_state, prev_hypos)
+        )
+
+        return tuple(outputs)
+
+
 class BeamSearch(torch.jit.ScriptModule):
 
     __constants__ = ["beam_size"]
@@ -904,7 +1099,7 @@ class BeamSearch(torch.jit.ScriptModule):
         beam_size=1,
         word_reward=0,
         unk_reward=0,
-        quantize=False,
+        quantize="none",
     ):
         super().__init__()
         self.models = model_list
@@ -914,9 +1109,7 @@ class BeamSearch(torch.jit.ScriptModule):
         self.unk_reward = unk_reward
 
         encoder_ens = EncoderEnsemble(self.models)
-        if quantize:
-            encoder_ens = torch.jit.quantized.quantize_linear_modules(encoder_ens)
-            encoder_ens = torch.jit.quantized.quantize_rnn_cell_modules(encoder_ens)
+        encoder_ens = quantize_module(encoder_ens, quantize)
         example_encoder_outs = encoder_ens(src_tokens, src_lengths)
         self.encoder_ens = torch.jit.trace(
             encoder_ens, (src_tokens, src_lengths), _force_outplace=True
@@ -929,9 +1122,7 @@ class BeamSearch(torch.jit.ScriptModule):
             unk_reward,
             tile_internal=False,
         )
-        if quantize:
-            decoder_ens = torch.jit.quantized.quantize_linear_modules(decoder_ens)
-            decoder_ens = torch.jit.quantized.quantize_rnn_cell_modules(decoder_ens)
+        decoder_ens = quantize_module(decoder_ens, quantize)
         decoder_ens_tile = DecoderBatchedStepEnsemble(
             self.models,
             tgt_dict,
@@ -940,13 +1131,7 @@ class BeamSearch(torch.jit.ScriptModule):
             unk_reward,
             tile_internal=True,
         )
-        if quantize:
-            decoder_ens_tile = torch.jit.quantized.quantize_linear_modules(
-                decoder_ens_tile
-            )
-            decoder_ens_tile = torch.jit.quantized.quantize_rnn_cell_modules(
-                decoder_ens_tile
-            )
+        decoder_ens_tile = quantize_module(decoder_ens_tile, quantize)
         prev_token = torch.LongTensor([0])
         prev_scores = torch.FloatTensor([0.0])
         ts = torch.LongTensor([0])
@@ -998,14 +1183,13 @@ class BeamSearch(torch.jit.ScriptModule):
     ):
         enc_states = self.encoder_ens(src_tokens, src_lengths)
 
-        all_tokens = prev_token.repeat(repeats=[self.beam_size]).unsqueeze(dim=0)
-        all_scores = prev_scores.repeat(repeats=[self.beam_size]).unsqueeze(dim=0)
-        all_weights = (
-            attn_weights.unsqueeze(dim=0)
-            .repeat(repeats=[self.beam_size, 1])
-            .unsqueeze(dim=0)
+        tokens, scores, weights, prev_indices = self.initial_outputs(
+            prev_token, prev_scores, attn_weights, prev_hypos_indices
         )
-        all_prev_indices = prev_hypos_indices.unsqueeze(dim=0)
+        all_tokens = tokens.unsqueeze(dim=0)
+        all_scores = scores.unsqueeze(dim=0)
+        all_weights = weights.unsqueeze(dim=0)
+        all_prev_indices = prev_indices.unsqueeze(dim=0)
 
         prev_token, prev_scores, prev_hypos_indices, attn_weights, *states = self.decoder_ens_tile(
             prev_token, prev_scores, _to_tensor(0), *enc_states  # noqa
@@ -1038,6 +1222,25 @@ class BeamSearch(torch.jit.ScriptModule):
 
         return all_tokens, all_scores, all_weights, all_prev_indices
 
+    @torch.jit.script_method
+    def initial_outputs(
+        self,
+        prev_token: torch.Tensor,
+        prev_scores: torch.Tensor,
+        attn_weights: torch.Tensor,
+        prev_hypos_indices: torch.Tensor,
+    ):
+        """
+        Returns the first row of each output, for the hypotheses the search
+        starts from.
+        """
+        return (
+            prev_token.repeat(repeats=[self.beam_size]),
+            prev_scores.repeat(repeats=[self.beam_size]),
+            attn_weights.unsqueeze(dim=0).repeat(repeats=[self.beam_size, 1]),
+            prev_hypos_indices,
+        )
+
     def onnx_export(self, output_path):
         length = 10
         src_tokens = torch.LongTensor(np.ones((length, 1), dtype="int64"))
@@ -1082,6 +1285,7 @@ class BeamSearch(torch.jit.ScriptModule):
         word_reward=0,
         unk_reward=0,
         lexical_dict_paths=None,
+        quantize="dynamic-int8",
     ):
         length = 10
         models, _, tgt_dict = load_models_from_checkpoints(
@@ -1100,7 +1304,7 @@ class BeamSearch(torch.jit.ScriptModule):
             beam_size=beam_size,
             word_reward=word_reward,
             unk_reward=unk_reward,
-            quantize=True,
+            quantize=quantize,
         )
 
     def save_to_db(self, output_path):
@@ -1131,6 +1335,310 @@ class BeamSearch(torch.jit.ScriptModule):
         )
 
 
+class EarlyStopBeamSearch(torch.jit.ScriptModule):
+    """
+    TorchScript-only variant of a BeamSearch which stops decoding once every
+    hypothesis has produced EOS or descends from one that did. It takes the
+    same inputs, and its outputs are the first rows of the BeamSearch outputs:
+    one row per decoded step, at most num_steps + 1. The data-dependent exit
+    has no ONNX/Caffe2 lowering, so exported models keep using BeamSearch.
+    """
+
+    __constants__ = ["eos"]
+
+    def __init__(self, beam_search):
+        super().__init__()
+        self.beam_search = beam_search
+        self.eos = beam_search.tgt_dict.eos()
+
+    @torch.jit.script_method
+    def forward(
+        self,
+        src_tokens: torch.Tensor,
+        src_lengths: torch.Tensor,
+        prev_token: torch.Tensor,
+        prev_scores: torch.Tensor,
+        attn_weights: torch.Tensor,
+        prev_hypos_indices: torch.Tensor,
+        num_steps: int,
+    ):
+        enc_states = self.beam_search.encoder_ens(src_tokens, src_lengths)
+
+        # outputs are preallocated for num_steps steps and written in place,
+        # and only the decoded rows are returned
+        beam_size = self.beam_search.beam_size
+        all_tokens = torch.zeros([num_steps + 1, beam_size], dtype=torch.long)
+        all_scores = torch.zeros([num_steps + 1, beam_size])
+        all_weights = torch.zeros([num_steps + 1, beam_size, attn_weights.size(0)])
+        all_prev_indices = torch.zeros([num_steps + 1, beam_size], dtype=torch.long)
+
+        tokens, scores, weights, prev_indices = self.beam_search.initial_outputs(
+            prev_token, prev_scores, attn_weights, prev_hypos_indices
+        )
+        all_tokens[0] = tokens
+        all_scores[0] = scores
+        all_weights[0] = weights
+        all_prev_indices[0] = prev_indices
+
+        prev_token, prev_scores, prev_hypos_indices, attn_weights, *states = self.beam_search.decoder_ens_tile(
+            prev_token, prev_scores, _to_tensor(0), *enc_states  # noqa
+        )
+
+        all_tokens[1] = prev_token
+        all_scores[1] = prev_scores
+        all_weights[1] = attn_weights
+        all_prev_indices[1] = prev_hypos_indices
+
+        # a hypothesis is finished once it or one of its ancestors is EOS
+        finished = prev_token.eq(self.eos)
+        step = 1
+        while step < num_steps and not bool(finished.all()):
+            (
+                prev_token,
+                prev_scores,
+                prev_hypos_indices,
+                attn_weights,
+                *states,
+            ) = self.beam_search.decoder_ens(
+                prev_token, prev_scores, _to_tensor(step), *states  # noqa
+            )
+            step += 1
+
+            all_tokens[step] = prev_token
+            all_scores[step] = prev_scores
+            all_weights[step] = attn_weights
+            all_prev_indices[step] = prev_hypos_indices
+            finished = finished.index_select(0, prev_hypos_indices) | prev_token.eq(
+                self.eos
+            )
+
+        return (
+            all_tokens[: step + 1],
+            all_scores[: step + 1],
+            all_weights[: step + 1],
+            all_prev_indices[: step + 1],
+        )
+
+    def save_to_pytorch(self, output_path):
+        BeamSearch.save_to_pytorch(self, output_path)
+
+
+class BatchBeamSearch(torch.jit.ScriptModule):
+    """
+    Beam search over a batch of source sentences of different lengths.
+    src_tokens is (max_src_length x batch_size), padded at the end of each
+    sentence. Decoding stops once every hypothesis has produced EOS, or after
+    num_steps steps. The beam_size best hypotheses of each sentence are
+    returned best first, as (tokens, scores, lengths, attention weights) of
+    shapes (batch x beam x steps), (batch x beam), (batch x beam) and
+    (batch x beam x steps x max_src_length). Tokens after EOS are EOS.
+    """
+
+    __constants__ = ["beam_size", "eos"]
+
+    def __init__(
+        self,
+        model_list,
+        tgt_dict,
+        src_tokens,
+        src_lengths,
+        beam_size=1,
+        word_reward=0,
+        unk_reward=0,
+        quantize="none",
+    ):
+        super().__init__()
+        self.models = model_list
+        self.tgt_dict = tgt_dict
+        self.beam_size = beam_size
+        self.eos = tgt_dict.eos()
+        self.word_reward = word_reward
+        self.unk_reward = unk_reward
+
+        # example inputs should contain several sentences of different
+        # lengths, sorted by decreasing length
+        src_lengths, order = torch.sort(src_lengths, descending=True)
+        src_tokens = src_tokens.index_select(dim=1, index=order)
+
+        encoder_ens = EncoderEnsemble(self.models)
+        encoder_ens = quantize_module(encoder_ens, quantize)
+        example_encoder_outs = encoder_ens(src_tokens, src_lengths)
+        self.encoder_ens = torch.jit.trace(
+            encoder_ens, (src_tokens, src_lengths), _force_outplace=True
+        )
+        decoder_ens = DecoderBatchedMultiSentenceStepEnsemble(
+            self.models,
+            tgt_dict,
+            beam_size,
+            word_reward,
+            unk_reward,
+            tile_internal=False,
+        )
+        decoder_ens = quantize_module(decoder_ens, quantize)
+        decoder_ens_tile = DecoderBatchedMultiSentenceStepEnsemble(
+            self.models,
+            tgt_dict,
+            beam_size,
+            word_reward,
+            unk_reward,
+            tile_internal=True,
+        )
+        decoder_ens_tile = quantize_module(decoder_ens_tile, quantize)
+        batch_size = src_lengths.size(0)
+        prev_token = torch.LongTensor(batch_size).fill_(self.eos)
+        prev_scores = torch.zeros(batch_size)
+        ts = torch.LongTensor([0])
+        _, _, _, _, *tiled_states = decoder_ens_tile(
+            prev_token, prev_scores, ts, src_lengths.long(), *example_encoder_outs
+        )
+        self.decoder_ens_tile = torch.jit.trace(
+            decoder_ens_tile,
+            (prev_token, prev_scores, ts, src_lengths.long(), *example_encoder_outs),
+            _force_outplace=True,
+        )
+        self.decoder_ens = torch.jit.trace(
+            decoder_ens,
+            (
+                prev_token.repeat(self.beam_size),
+                prev_scores.repeat(self.beam_size),
+                ts + 1,
+                *tiled_states,
+            ),
+            _force_outplace=True,
+        )
+
+    @torch.jit.script_method
+    def forward(
+        self, src_tokens: torch.Tensor, src_lengths: torch.Tensor, num_steps: int
+    ):
+        # the encoders expect sentences sorted by decreasing length
+        src_lengths, order = torch.sort(src_lengths, descending=True)
+        _, inverse_order = torch.sort(order)
+        src_tokens = src_tokens.index_select(dim=1, index=order)
+        enc_states = self.encoder_ens(src_tokens, src_lengths)
+
+        num_sentences = src_lengths.size(0)
+        prev_token = torch.zeros([num_sentences], dtype=torch.long).fill_(self.eos)
+        prev_scores = torch.zeros([num_sentences])
+        (
+            prev_token,
+            prev_scores,
+            prev_hypos_indices,
+            attn_weights,
+            *states,
+        ) = self.decoder_ens_tile(
+            prev_token,
+            prev_scores,
+            _to_tensor(0),  # noqa
+            src_lengths.long(),
+            *enc_states,
+        )
+
+        # preallocated for the longest possible output, filled step by step
+        num_hypos = prev_token.size(0)
+        all_tokens = torch.zeros([num_steps, num_hypos], dtype=torch.long)
+        all_scores = torch.zeros([num_steps, num_hypos])
+        all_weights = torch.zeros([num_steps, num_hypos, attn_weights.size(1)])
+        all_prev_indices = torch.zeros([num_steps, num_hypos], dtype=torch.long)
+        all_tokens.select(0, 0).copy_(prev_token)
+        all_scores.select(0, 0).copy_(prev_scores)
+        all_weights.select(0, 0).copy_(attn_weights)
+        all_prev_indices.select(0, 0).copy_(prev_hypos_indices)
+
+        step = 1
+        while step < num_steps and bool(prev_token.ne(self.eos).any()):
+            (
+                prev_token,
+                prev_scores,
+                prev_hypos_indices,
+                attn_weights,
+                *states,
+            ) = self.decoder_ens(
+                prev_token, prev_scores, _to_tensor(step), *states  # noqa
+            )
+            all_tokens.select(0, step).copy_(prev_token)
+            all_scores.select(0, step).copy_(prev_scores)
+            all_weights.select(0, step).copy_(attn_weights)
+            all_prev_indices.select(0, step).copy_(prev_hypos_indices)
+            step += 1
+
+        # word rewards are added after selection, so re-rank each beam
+        scores, ranks = torch.sort(
+            prev_scores.view(num_sentences, self.beam_size), dim=1, descending=True
+        )
+        sentence_offsets = torch.arange(num_sentences).view(-1, 1) * self.beam_size
+        hypos = (ranks + sentence_offsets).view(-1)
+
+        # follow back-pointers from the final hypotheses
+        tokens = torch.zeros([step, num_hypos], dtype=torch.long)
+        weights = torch.zeros([step, num_hypos, attn_weights.size(1)])
+        for i in range(step):
+            t = step - 1 - i
+            tokens.select(0, t).copy_(all_tokens.select(0, t).index_select(0, hypos))
+            weights.select(0, t).copy_(
+                all_weights.select(0, t).index_select(0, hypos)
+            )
+            hypos = all_prev_indices.select(0, t).index_select(0, hypos)
+
+        tokens = tokens.t().contiguous().view(num_sentences, self.beam_size, step)
+        weights = weights.transpose(0, 1).contiguous().view(
+            num_sentences, self.beam_size, step, attn_weights.size(1)
+        )
+        # number of tokens up to and including the first EOS
+        lengths = tokens.ne(self.eos).long().cumprod(dim=2).sum(dim=2) + 1
+        lengths = lengths.clamp(max=step)
+
+        return (
+            tokens.index_select(0, inverse_order),
+            scores.index_select(0, inverse_order),
+            lengths.index_select(0, inverse_order),
+            weights.index_select(0, inverse_order),
+        )
+
+    @classmethod
+    def build_from_checkpoints(
+        cls,
+        checkpoint_filenames,
+        src_dict_filename,
+        dst_dict_filename,
+        beam_size,
+        word_reward=0,
+        unk_reward=0,
+        lexical_dict_paths=None,
+        quantize="dynamic-int8",
+    ):
+        models, src_dict, tgt_dict = load_models_from_checkpoints(
+            checkpoint_filenames,
+            src_dict_filename,
+            dst_dict_filename,
+            lexical_dict_paths,
+        )
+        # two example sentences so that traces do not specialize on batch size
+        lengths = [10, 8]
+        src_tokens = torch.LongTensor(np.ones((lengths[0], 2), dtype="int64"))
+        src_tokens[lengths[1] :, 1] = src_dict.pad()
+        src_lengths = torch.IntTensor(np.array(lengths, dtype="int32"))
+        return cls(
+            models,
+            tgt_dict,
+            src_tokens,
+            src_lengths,
+            beam_size=beam_size,
+            word_reward=word_reward,
+            unk_reward=unk_reward,
+            quantize=quantize,
+        )
+
+    def save_to_pytorch(self, output_path):
+        self.apply(
+            lambda s: s._get_method("_pack")() if s._has_method("_pack") else None
+        )
+        torch.jit.save(self, output_path)
+        self.apply(
+            lambda s: s._get_method("_unpack")() if s._has_method("_unpack") else None
+        )
+
+
 class KnownOutputDecoderStepEnsemble(nn.Module):
     def __init__(self, models, tgt_dict, word_reward=0, unk_reward=0):
         super().__init__()
@@ -1296,7 +1804,9 @@ class KnownOutputDecoderStepEnsemble(nn.Module):
 
 
 class ForcedDecoder(torch.jit.ScriptModule):
-    def __init__(self, model_list, tgt_dict, word_reward=0, unk_reward=0):
+    def __init__(
+        self, model_list, tgt_dict, word_reward=0, unk_reward=0, quantize="none"
+    ):
         super().__init__()
         self.models = model_list
         self.tgt_dict = tgt_dict
@@ -1306,7 +1816,7 @@ class ForcedDecoder(torch.jit.ScriptModule):
         source_tokens = torch.LongTensor(np.ones((5, 1), dtype="int64"))
         source_length = torch.LongTensor([5])
 
-        encoder_ens = EncoderEnsemble(self.models)
+        encoder_ens = quantize_module(EncoderEnsemble(self.models), quantize)
         example_encoder_outs = encoder_ens(source_tokens, source_length)
         self.encoder_ens = torch.jit.trace(
             encoder_ens, (source_tokens, source_length), _force_outplace=True
@@ -1314,6 +1824,7 @@ class ForcedDecoder(torch.jit.ScriptModule):
         decoder_ens = KnownOutputDecoderStepEnsemble(
             self.models, tgt_dict, word_reward, unk_reward
         )
+        decoder_ens = quantize_module(decoder_ens, quantize)
         prev_token = torch.LongTensor([0])
         target_token = torch.LongTensor([0])
         ts = torch.LongTensor([0])
@@ -1409,6 +1920,7 @@ class ForcedDecoder(torch.jit.ScriptModule):
         word_reward=0,
         unk_reward=0,
         lexical_dict_paths=None,
+        quantize="none",
     ):
         models, _, tgt_dict = load_models_from_checkpoints(
             checkpoint_filenames,
@@ -1416,7 +1928,13 @@ class ForcedDecoder(torch.jit.ScriptModule):
             dst_dict_filename,
             lexical_dict_paths,
         )
-        return cls(models, tgt_dict, word_reward=word_reward, unk_reward=unk_reward)
+        return cls(
+            models,
+            tgt_dict,
+            word_reward=word_reward,
+            unk_reward=unk_reward,
+            quantize=quantize,
+        )
 
     def save_to_db(self, output_path):
         """
@@ -1518,6 +2036,7 @@ class CharSourceEncoderEnsemble(nn.Module):
         src_dict_filename,
         dst_dict_filename,
         lexical_dict_paths=None,
+        quantize="none",
     ):
         models, src_dict, _ = load_models_from_checkpoints(
             checkpoint_filenames,
@@ -1525,7 +2044,7 @@ class CharSourceEncoderEnsemble(nn.Module):
             dst_dict_filename,
             lexical_dict_paths,
         )
-        return cls(models, src_dict=src_dict)
+        return quantize_module(cls(models, src_dict=src_dict), quantize)
 
     def save_to_db(self, output_path):
         """
@@ -13,6 +13,7 @@ from pytorch_translate import (
     checkpoint,
     constants,
     generate,
+    memory_profiling,
     utils as pytorch_translate_utils,
 )
 from pytorch_translate.dual_learning.dual_learning_task import DualLearningTask
@@ -116,6 +117,8 @@ def eval_tune_loss(args, trainer, task, subset, extra_state):
         if meter is not None:
             meter.reset()
 
+    memory_profiler = memory_profiling.build_memory_profiler(args)
+    memory_profiler.start()
     extra_meters = defaultdict(lambda: AverageMeter())
     for sample in progress:
         log_output = trainer.valid_step(sample)
@@ -136,6 +139,8 @@ def eval_tune_loss(args, trainer, task, subset, extra_state):
     stats = get_valid_stats(trainer)
     for k, meter in extra_meters.items():
         stats[k] = meter.avg
+    for k, v in memory_profiler.stop(name=f"valid on '{subset}'").items():
+        stats[f"valid_{k}"] = v
     progress.print(stats)
 
     extra_state["tune_eval"]["loss"] = stats["valid_loss"]
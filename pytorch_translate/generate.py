@@ -21,6 +21,7 @@ from pytorch_translate import (
     char_source_transformer_model,
     data as pytorch_translate_data,
     dictionary as pytorch_translate_dictionary,
+    memory_profiling,
     options as pytorch_translate_options,
     utils as pytorch_translate_utils,
 )
@@ -187,6 +188,7 @@ def _generate_score(models, args, task, dataset, optimize=True):
     with progress_bar.build_progress_bar(args, itr) as t:
         wps_meter = TimeMeter()
         gen_timer = StopwatchMeter()
+        memory_profiler = memory_profiling.build_memory_profiler(args, use_cuda)
         translations = translator.generate_batched_itr(
             t,
             maxlen_a=args.max_len_a,
@@ -194,6 +196,7 @@ def _generate_score(models, args, task, dataset, optimize=True):
             cuda=use_cuda,
             timer=gen_timer,
             prefix_size=1 if pytorch_translate_data.is_multilingual(args) else 0,
+            memory_profiler=memory_profiler,
         )
 
         for trans_info in _iter_translations(
@@ -220,9 +223,11 @@ def _generate_score(models, args, task, dataset, optimize=True):
                 )
             )
             wps_meter.update(trans_info.src_tokens.size(0))
-            t.log({"wps": round(wps_meter.avg)})
+            t.log({"wps": round(wps_meter.avg), **memory_profiler.last_stats})
             num_sentences += 1
 
+    memory_profiler.print_buckets("Decode")
+
     # If applicable, save collected hypothesis tokens to binary output file
     if collect_output_hypos:
         output_dataset = pytorch_translate_data.InMemoryNumpyDataset()
@@ -580,7 +585,7 @@ def generate(args):
     pytorch_translate_options.print_args(args)
 
     models, model_args, task = pytorch_translate_utils.load_diverse_ensemble_for_inference(
-        args.path.split(":")
+        args.path.split(":"), inference_dtype=args.inference_dtype
     )
     args.source_lang = model_args[0].source_lang
     args.target_lang = model_args[0].target_lang
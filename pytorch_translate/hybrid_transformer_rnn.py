@@ -287,6 +287,12 @@ class HybridRNNDecoder(FairseqIncrementalDecoder):
             )
             if prev_states is None:
                 prev_states = self._init_prev_states(encoder_out)
+                utils.set_incremental_state(
+                    self,
+                    incremental_state,
+                    "encoder_proj_source_ids",
+                    self._source_ids(src_tokens, prev_output_tokens),
+                )
 
             # final 2 states of list are projected key and value
             saved_state = {"prev_key": prev_states[-2], "prev_value": prev_states[-1]}
@@ -421,10 +427,21 @@ class HybridRNNDecoder(FairseqIncrementalDecoder):
 
         return states
 
-    def reorder_incremental_state(self, incremental_state, new_order):
-        # parent reorders attention model
-        super().reorder_incremental_state(incremental_state, new_order)
+    def _source_ids(self, src_tokens, prev_output_tokens):
+        """
+        Ids which are equal for batch entries with identical source sentences
+        (e.g. all hypotheses of a beam), and hence identical encoder
+        projections.
+        """
+        if src_tokens is None:
+            batch_size = prev_output_tokens.size(0)
+            return torch.arange(batch_size).type_as(prev_output_tokens)
+        _, source_ids = torch.unique(src_tokens, dim=0, return_inverse=True)
+        return source_ids
 
+    def reorder_incremental_state(self, incremental_state, new_order):
+        # The input buffer of self.attention is rebuilt from cached_state at
+        # every step, so the parent class does not need to reorder it.
         cached_state = utils.get_incremental_state(
             self, incremental_state, "cached_state"
         )
@@ -436,6 +453,24 @@ class HybridRNNDecoder(FairseqIncrementalDecoder):
         for i, state in enumerate(cached_state[:-2]):
             cached_state[i] = state.index_select(1, new_order)
 
+        # Beam reordering only maps hypotheses to other hypotheses of the same
+        # source sentence, which share the same encoder projections. They are
+        # only copied if an entry moves to a different source sentence, e.g.
+        # when finished sentences are removed from the batch.
+        source_ids = utils.get_incremental_state(
+            self, incremental_state, "encoder_proj_source_ids"
+        )
+        new_source_ids = None
+        if source_ids is not None:
+            new_source_ids = source_ids.index_select(0, new_order)
+        if new_source_ids is None or not torch.equal(new_source_ids, source_ids):
+            cached_state[-2] = cached_state[-2].index_select(0, new_order)
+            cached_state[-1] = cached_state[-1].index_select(0, new_order)
+            if new_source_ids is not None:
+                utils.set_incremental_state(
+                    self, incremental_state, "encoder_proj_source_ids", new_source_ids
+                )
+
         utils.set_incremental_state(
             self, incremental_state, "cached_state", cached_state
         )
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+import collections
+import gc
+import resource
+import sys
+import tracemalloc
+from typing import Dict, Optional
+
+import torch
+
+
+def current_rss_mb() -> float:
+    """Resident set size of this process in MB."""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * resource.getpagesize() / 2 ** 20
+    except (OSError, IndexError, ValueError):
+        # Not on Linux - fall back to the high-water mark
+        return peak_rss_mb()
+
+
+def peak_rss_mb() -> float:
+    """High-water mark of the resident set size of this process in MB."""
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return maxrss / 2 ** 20 if sys.platform == "darwin" else maxrss / 2 ** 10
+
+
+def region_peak_rss_mb() -> Optional[float]:
+    """
+    Peak resident set size (VmHWM) of this process in MB since the last
+    reset_peak_rss(), or None when /proc/self/status is unavailable.
+    """
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 2 ** 10
+    except (OSError, IndexError, ValueError):
+        pass
+    return None
+
+
+def reset_peak_rss() -> bool:
+    """
+    Resets the VmHWM of this process to its current RSS (Linux 4.0 and
+    later). Returns whether it could be reset.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+    return region_peak_rss_mb() is not None
+
+
+def largest_tensor_groups(top_k=10):
+    """
+    Live tensors grouped by (device, dtype, shape), largest total size first.
+    Returns a list of (description, count, total_mb).
+    """
+    groups = collections.defaultdict(lambda: [0, 0])
+    for obj in gc.get_objects():
+        try:
+            if not torch.is_tensor(obj):
+                continue
+            key = f"{obj.device} {obj.dtype} {tuple(obj.size())}"
+            groups[key][0] += 1
+            groups[key][1] += obj.numel() * obj.element_size()
+        except Exception:
+            # Some objects raise on attribute access (e.g. weakref proxies)
+            continue
+    ordered = sorted(groups.items(), key=lambda item: item[1][1], reverse=True)
+    return [(key, count, size / 2 ** 20) for key, (count, size) in ordered[:top_k]]
+
+
+class MemoryProfiler:
+    """
+    Opt-in memory instrumentation for training steps, evals and decoding.
+
+    Wrap the region to measure in start() / stop(). stop() returns the peak
+    memory of the region, the current CPU RSS and how much the RSS grew over
+    the region, all in MB. The peak is the allocated GPU memory when running
+    on CUDA, and the RSS high-water mark otherwise. On CPU, start() resets
+    the high-water mark through /proc/self/clear_refs; where that is not
+    possible (e.g. not on Linux) the peak is the lifetime peak of the process
+    and only the RSS growth is specific to the region. When a key
+    is passed to stop(), e.g. (bsz, srclen, beam) for a decode batch, maxima
+    are also kept per key. The first time the peak crosses threshold_mb, and
+    every time it reaches a new maximum above it after that, the largest live
+    tensors and the top Python allocation sites are printed.
+    """
+
+    def __init__(self, enabled=False, use_cuda=False, threshold_mb=0.0, top_k=10):
+        self.enabled = enabled
+        self.use_cuda = use_cuda and torch.cuda.is_available()
+        self.threshold_mb = threshold_mb
+        self.top_k = top_k
+        self.buckets = collections.OrderedDict()
+        self.last_stats: Dict[str, float] = {}
+        self.max_reported_mb = 0.0
+        self.start_rss_mb = 0.0
+        self.peak_rss_reset = False
+        if self.enabled and self.threshold_mb > 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def start(self):
+        if not self.enabled:
+            return
+        if self.use_cuda and hasattr(torch.cuda, "reset_max_memory_allocated"):
+            torch.cuda.reset_max_memory_allocated()
+        elif not self.use_cuda:
+            self.peak_rss_reset = reset_peak_rss()
+        self.start_rss_mb = current_rss_mb()
+
+    def stop(self, key=None, name="") -> Dict[str, float]:
+        if not self.enabled:
+            return {}
+        rss_mb = current_rss_mb()
+        if self.use_cuda:
+            peak_mem_mb = torch.cuda.max_memory_allocated() / 2 ** 20
+        elif self.peak_rss_reset:
+            peak_mem_mb = region_peak_rss_mb() or peak_rss_mb()
+        else:
+            # lifetime peak of the process, see rss_delta_mb for the region
+            peak_mem_mb = peak_rss_mb()
+        stats = {
+            "peak_mem_mb": round(peak_mem_mb, 1),
+            "rss_mb": round(rss_mb, 1),
+            "rss_delta_mb": round(rss_mb - self.start_rss_mb, 1),
+        }
+        self.last_stats = stats
+
+        if key is not None:
+            bucket = self.buckets.setdefault(
+                key, {"count": 0, "peak_mem_mb": 0.0, "rss_mb": 0.0}
+            )
+            bucket["count"] += 1
+            bucket["peak_mem_mb"] = max(bucket["peak_mem_mb"], stats["peak_mem_mb"])
+            bucket["rss_mb"] = max(bucket["rss_mb"], stats["rss_mb"])
+
+        if (
+            self.threshold_mb > 0
+            and peak_mem_mb > self.threshold_mb
+            and peak_mem_mb > self.max_reported_mb
+        ):
+            self.max_reported_mb = peak_mem_mb
+            self.print_top_allocations(
+                f"{name} {key if key is not None else ''}".strip(), peak_mem_mb
+            )
+        return stats
+
+    def print_top_allocations(self, name, peak_mem_mb):
+        print(
+            f"| Memory threshold of {self.threshold_mb:.0f} MB exceeded "
+            f"({peak_mem_mb:.1f} MB) in {name or 'profiled region'}. "
+            f"Largest live tensors:"
+        )
+        for description, count, total_mb in largest_tensor_groups(self.top_k):
+            print(f"|   {total_mb:10.1f} MB in {count} x {description}")
+        if tracemalloc.is_tracing():
+            print("| Top Python allocation sites:")
+            snapshot = tracemalloc.take_snapshot()
+            for stat in snapshot.statistics("lineno")[: self.top_k]:
+                print(f"|   {stat.size / 2 ** 20:10.1f} MB at {stat.traceback}")
+        if self.use_cuda and hasattr(torch.cuda, "memory_summary"):
+            print(torch.cuda.memory_summary(abbreviated=True))
+
+    def print_buckets(self, title, key_names=("bsz", "srclen", "beam")):
+        if not self.enabled or not self.buckets:
+            return
+        print(f"| {title} memory by ({', '.join(key_names)}):")
+        for key, bucket in sorted(self.buckets.items()):
+            print(
+                f"|   {key}: {bucket['count']} batches, "
+                f"peak {bucket['peak_mem_mb']:.1f} MB, rss {bucket['rss_mb']:.1f} MB"
+            )
+
+
+def build_memory_profiler(args, use_cuda: Optional[bool] = None) -> MemoryProfiler:
+    if use_cuda is None:
+        use_cuda = torch.cuda.is_available() and not getattr(args, "cpu", False)
+    return MemoryProfiler(
+        enabled=getattr(args, "memory_profile", False),
+        use_cuda=use_cuda,
+        threshold_mb=getattr(args, "memory_profile_threshold_mb", 0.0),
+        top_k=getattr(args, "memory_profile_top_k", 10),
+    )
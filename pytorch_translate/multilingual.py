@@ -2,6 +2,7 @@
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from fairseq.models import FairseqEncoder, FairseqIncrementalDecoder
 from pytorch_translate import data as pytorch_translate_data, utils
 
@@ -23,6 +24,47 @@ def register_hooks(module, submodules):
             p.register_hook(create_hook_fn(module, idx))
 
 
+def init_missing_grads(module):
+    """Makes sure that all parameters of a module have a gradient.
+
+    fairseq requires every parameter to have a gradient at update time, but
+    parameters of a language which has not been in any batch yet have none.
+    Existing gradients are left untouched so that accumulated gradients from
+    earlier batches (--update-freq) are not lost.
+    """
+    for p in module.parameters():
+        if p.grad is None:
+            p.grad = torch.zeros_like(p.data)
+
+
+def sort_by_language(lang_ids, num_langs):
+    """Groups a batch by language ID.
+
+    Returns:
+        lang_order: permutation of the batch which sorts it by language ID.
+            Sentences with the same language ID stay in their original
+            relative order (e.g. sorted by source length).
+        inverse_order: permutation which restores the original order.
+        lang_bszs: Python list with the number of sentences for each language.
+    """
+    bsz = lang_ids.size(0)
+    positions = torch.arange(bsz).type_as(lang_ids)
+    _, lang_order = torch.sort(lang_ids * bsz + positions)
+    _, inverse_order = torch.sort(lang_order)
+    lang_bszs = torch.bincount(lang_ids, minlength=num_langs).tolist()
+    return lang_order, inverse_order, lang_bszs
+
+
+def pad_to_length(x, length, dim=0):
+    """Zero-pads x along dim to the given length."""
+    pad_size = length - x.size(dim)
+    if pad_size <= 0:
+        return x
+    pad_shape = list(x.size())
+    pad_shape[dim] = pad_size
+    return torch.cat([x, x.new_zeros(pad_shape)], dim=dim)
+
+
 class MultilingualEncoder(FairseqEncoder):
     """Multilingual encoder.
 
@@ -56,33 +98,41 @@ class MultilingualEncoder(FairseqEncoder):
         )
         src_tokens = src_tokens[:, :-1]
         src_lengths -= 1
-        # Create tensors for collecting encoder outputs
         bsz, seq_len = src_tokens.size()[:2]
-        all_encoder_outs = utils.maybe_cuda(torch.zeros(seq_len, bsz, self.hidden_dim))
-        all_final_hidden = utils.maybe_cuda(
-            torch.zeros(self.num_layers, bsz, self.hidden_dim)
+        # Sort the batch by language once so that each encoder runs on a
+        # contiguous slice of it
+        lang_order, inverse_order, lang_bszs = sort_by_language(
+            lang_ids, len(self.encoders)
         )
-        all_final_cell = utils.maybe_cuda(
-            torch.zeros(self.num_layers, bsz, self.hidden_dim)
-        )
-        # We cannot use zeros_like() for src_lengths because dtype changes
-        # from LongInt to Int
-        all_src_lengths = utils.maybe_cuda(torch.zeros(bsz, dtype=torch.int))
-        all_src_tokens = torch.zeros_like(src_tokens)
-        all_embedded_words = utils.maybe_cuda(torch.zeros(seq_len, bsz, self.word_dim))
+        # Batches with a single language are already sorted
+        single_lang = max(lang_bszs) == bsz
+        if not single_lang:
+            src_tokens = src_tokens.index_select(0, lang_order)
+            src_lengths = src_lengths.index_select(0, lang_order)
         self.last_bsz = bsz
         self.last_lang_bszs = []
+        lang_outs = []
+        start = 0
         for lang_id, encoder in enumerate(self.encoders):
+            lang_bsz = lang_bszs[lang_id]
+            end = start + lang_bsz
             if encoder is None:
+                if lang_bsz > 0:
+                    # Rows of a language without an encoder get zero outputs
+                    lang_outs.append(
+                        self._zero_encoder_out(
+                            src_tokens[start:end], src_lengths[start:end]
+                        )
+                    )
+                    start = end
                 continue
-            indices = torch.nonzero(lang_ids == lang_id)
-            lang_bsz = indices.size(0)
             self.last_lang_bszs.append(lang_bsz)
             if lang_bsz == 0:  # Language not in this batch
-                for p in encoder.parameters():
-                    p.grad = torch.zeros_like(p.data)
+                if self.training:
+                    # Only allocates the gradients fairseq expects the first
+                    # time; later batches leave them untouched
+                    init_missing_grads(encoder)
                 continue
-            indices = indices.squeeze(1)
             (
                 lang_encoder_outs,
                 lang_final_hidden,
@@ -90,21 +140,39 @@ class MultilingualEncoder(FairseqEncoder):
                 lang_src_lengths,
                 lang_src_tokens,
                 lang_embedded_words,
-            ) = encoder(src_tokens[indices], src_lengths[indices])
-            lang_seq_len = lang_encoder_outs.size(0)
-            all_encoder_outs[:lang_seq_len, indices, :] = lang_encoder_outs
-            all_final_hidden[:, indices, :] = lang_final_hidden
-            all_final_cell[:, indices, :] = lang_final_cell
-            all_src_lengths[indices] = lang_src_lengths
-            all_src_tokens[indices] = lang_src_tokens
-            all_embedded_words[:, indices, :] = lang_embedded_words
+            ) = encoder(src_tokens[start:end], src_lengths[start:end])
+            lang_outs.append(
+                (
+                    pad_to_length(lang_encoder_outs, seq_len, dim=0),
+                    lang_final_hidden,
+                    lang_final_cell,
+                    lang_src_lengths.int(),
+                    lang_src_tokens,
+                    lang_embedded_words,
+                )
+            )
+            start = end
+        if single_lang:
+            return lang_outs[0]
+        # Concatenate the per-language outputs and restore the original order.
+        # encoder_outs, final_hidden, final_cell and embedded_words are
+        # time-major, src_lengths and src_tokens are batch-major.
+        batch_dims = (1, 1, 1, 0, 0, 1)
+        return tuple(
+            torch.cat(outs, dim=dim).index_select(dim, inverse_order)
+            for outs, dim in zip(zip(*lang_outs), batch_dims)
+        )
+
+    def _zero_encoder_out(self, src_tokens, src_lengths):
+        """Encoder outputs for the sentences of a language without an encoder."""
+        bsz, seq_len = src_tokens.size()[:2]
         return (
-            all_encoder_outs,
-            all_final_hidden,
-            all_final_cell,
-            all_src_lengths,
-            all_src_tokens,
-            all_embedded_words,
+            utils.maybe_cuda(torch.zeros(seq_len, bsz, self.hidden_dim)),
+            utils.maybe_cuda(torch.zeros(self.num_layers, bsz, self.hidden_dim)),
+            utils.maybe_cuda(torch.zeros(self.num_layers, bsz, self.hidden_dim)),
+            src_lengths.int(),
+            src_tokens,
+            utils.maybe_cuda(torch.zeros(seq_len, bsz, self.word_dim)),
         )
 
     def reorder_encoder_out(self, encoder_out, new_order):
@@ -165,65 +233,113 @@ class MultilingualDecoder(FairseqIncrementalDecoder):
             incremental_state = {lang_id: None for lang_id in range(len(self.decoders))}
         else:
             seq_len = 1
-        # Create tensors for collecting encoder outputs
-        # +1 for language ID
-        all_logits = utils.maybe_cuda(
-            torch.zeros(bsz, seq_len + 1, self.max_vocab_size)
-        )
-        all_attn_scores = utils.maybe_cuda(
-            torch.zeros(bsz, seq_len, encoder_out[0].size(0))
+        lang_order, inverse_order, lang_bszs = sort_by_language(
+            lang_ids, len(self.decoders)
         )
+        # Batches with a single language (e.g. in generation or when batches
+        # are grouped by target language) are passed to a single decoder
+        # without any reordering
+        single_lang = max(lang_bszs) == bsz
+        if not single_lang:
+            input_tokens = input_tokens.index_select(0, lang_order)
+            encoder_out = self._reorder_encoder_out(encoder_out, lang_order)
         self.last_bsz = bsz
         self.last_lang_bszs = []
+        all_logits = []
+        all_attn_scores = []
+        start = 0
         for lang_id, decoder in enumerate(self.decoders):
+            lang_bsz = lang_bszs[lang_id]
+            end = start + lang_bsz
             if decoder is None:
+                if lang_bsz > 0:
+                    # Rows of a language without a decoder get zero outputs
+                    all_logits.append(
+                        encoder_out[0].new_zeros(
+                            lang_bsz, seq_len + 1, self.max_vocab_size
+                        )
+                    )
+                    all_attn_scores.append(
+                        encoder_out[0].new_zeros(
+                            lang_bsz, seq_len, encoder_out[0].size(0)
+                        )
+                    )
+                    start = end
                 continue
             if lang_id not in incremental_state:
                 incremental_state[lang_id] = {}
-            indices = torch.nonzero(lang_ids == lang_id)
-            lang_bsz = indices.size(0)
             self.last_lang_bszs.append(lang_bsz)
             if lang_bsz == 0:  # Language not in this batch
-                for p in decoder.parameters():
-                    p.grad = torch.zeros_like(p.data)
+                if self.training:
+                    init_missing_grads(decoder)
                 continue
-            indices = indices.squeeze(1)
-            max_source_length = torch.max(encoder_out[3][indices])
-            lang_encoder_out = (
-                encoder_out[0][:max_source_length, indices, :],
-                encoder_out[1][:, indices, :],
-                encoder_out[2][:, indices, :],
-                encoder_out[3][indices],
-                encoder_out[4][indices, :max_source_length],
-                encoder_out[5][:max_source_length, indices, :],
-            )
-
+            if single_lang:
+                lang_input_tokens = input_tokens
+                lang_encoder_out = encoder_out
+            else:
+                lang_input_tokens = input_tokens[start:end]
+                max_source_length = torch.max(encoder_out[3][start:end])
+                lang_encoder_out = (
+                    encoder_out[0][:max_source_length, start:end, :],
+                    encoder_out[1][:, start:end, :],
+                    encoder_out[2][:, start:end, :],
+                    encoder_out[3][start:end],
+                    encoder_out[4][start:end, :max_source_length],
+                    encoder_out[5][:max_source_length, start:end, :],
+                )
             lang_logits, lang_attn_scores, _ = decoder(
-                input_tokens[indices], lang_encoder_out, incremental_state[lang_id]
+                lang_input_tokens, lang_encoder_out, incremental_state[lang_id]
+            )
+            # Pad to the maximum vocabulary size and source length, and add
+            # a (zero) time step for the language ID
+            vocab_pad = self.max_vocab_size - lang_logits.size(2)
+            all_logits.append(F.pad(lang_logits, (0, vocab_pad, 1, 0)))
+            all_attn_scores.append(
+                pad_to_length(lang_attn_scores, encoder_out[0].size(0), dim=2)
             )
-            all_attn_scores[indices, :, :max_source_length] = lang_attn_scores
-            all_logits[indices, 1:, : lang_logits.size(2)] = lang_logits
+            start = end
         incremental_state["lang_ids"] = lang_ids
-        return all_logits, all_attn_scores, None
+        if single_lang:
+            return all_logits[0], all_attn_scores[0], None
+        return (
+            torch.cat(all_logits, dim=0).index_select(0, inverse_order),
+            torch.cat(all_attn_scores, dim=0).index_select(0, inverse_order),
+            None,
+        )
+
+    def _reorder_encoder_out(self, encoder_out, new_order):
+        """Reorder the MultilingualEncoder output along the batch dimension."""
+        return (
+            encoder_out[0].index_select(1, new_order),
+            encoder_out[1].index_select(1, new_order),
+            encoder_out[2].index_select(1, new_order),
+            encoder_out[3].index_select(0, new_order),
+            encoder_out[4].index_select(0, new_order),
+            encoder_out[5].index_select(1, new_order),
+        )
 
     def reorder_incremental_state(self, incremental_state, new_order):
         """Reorder buffered internal state (for incremental generation)."""
         if not incremental_state:
             return
         bsz = new_order.size(0)
+        lang_order, _, lang_bszs = sort_by_language(
+            incremental_state["lang_ids"], len(self.decoders)
+        )
+        start = 0
         for lang_id, decoder in enumerate(self.decoders):
-            if decoder is None:
-                continue
-            indices = torch.nonzero(incremental_state["lang_ids"] == lang_id)
-            lang_bsz = indices.size(0)
-            if lang_bsz > 0:
+            lang_bsz = lang_bszs[lang_id]
+            end = start + lang_bsz
+            if decoder is not None and lang_bsz > 0:
                 if lang_bsz == bsz:
                     lang_new_order = new_order
                 else:
-                    lang_new_order = utils.densify(new_order[indices.squeeze(1)])
+                    indices = lang_order[start:end]
+                    lang_new_order = utils.densify(new_order[indices])
                 decoder.reorder_incremental_state(
                     incremental_state[lang_id], lang_new_order
                 )
+            start = end
 
     def max_positions(self):
         """Maximum output length supported by the decoder."""
@@ -1,10 +1,12 @@
 #!/usr/bin/env python3
 
 import argparse
+import os
+import tempfile
 
 import numpy as np
 import torch
-from pytorch_translate import rnn  # noqa
+from pytorch_translate import benchmark, dictionary, quantization_report, rnn  # noqa
 from pytorch_translate.ensemble_export import (
     CharSourceEncoderEnsemble,
     DecoderBatchedStepEnsemble,
@@ -69,6 +71,8 @@ def get_parser_with_args():
             "token and character numberized inputs)."
         ),
     )
+    quantization_report.add_quantization_args(parser)
+    quantization_report.add_report_args(parser)
 
     return parser
 
@@ -90,8 +94,33 @@ def main():
 
 def export(args):
     assert_required_args_are_set(args)
+    assert not (args.char_source and args.report_source_file), (
+        "--report-source-file is not supported with --char-source, since the "
+        "report runs the components without character inputs"
+    )
     checkpoint_filenames = args.path.split(":")
+    export_components(
+        args,
+        checkpoint_filenames,
+        args.quantize,
+        args.encoder_output_file,
+        args.decoder_output_file,
+    )
 
+    quantization_report.maybe_report(
+        args,
+        build_runner=lambda quantize: build_report_runner(
+            args, checkpoint_filenames, quantize
+        ),
+        checkpoint_filenames=checkpoint_filenames,
+        src_dict_filename=args.source_vocab_file,
+        dst_dict_filename=args.target_vocab_file,
+    )
+
+
+def export_components(
+    args, checkpoint_filenames, quantize, encoder_output_file, decoder_output_file
+):
     if args.char_source:
         encoder_class = CharSourceEncoderEnsemble
     else:
@@ -101,11 +130,12 @@ def export(args):
         checkpoint_filenames=checkpoint_filenames,
         src_dict_filename=args.source_vocab_file,
         dst_dict_filename=args.target_vocab_file,
+        quantize=quantize,
     )
-    if args.encoder_output_file != "":
-        encoder_ensemble.save_to_db(args.encoder_output_file)
+    if encoder_output_file != "":
+        encoder_ensemble.save_to_db(encoder_output_file)
 
-    if args.decoder_output_file != "":
+    if decoder_output_file != "":
         decoder_step_ensemble = DecoderBatchedStepEnsemble.build_from_checkpoints(
             checkpoint_filenames=checkpoint_filenames,
             src_dict_filename=args.source_vocab_file,
@@ -113,6 +143,7 @@ def export(args):
             beam_size=args.beam_size,
             word_reward=args.word_reward,
             unk_reward=args.unk_reward,
+            quantize=quantize,
         )
 
         # need example encoder outputs to pass through network
@@ -134,9 +165,33 @@ def export(args):
         else:
             pytorch_encoder_outputs = encoder_ensemble(src_tokens, src_lengths)
 
-        decoder_step_ensemble.save_to_db(
-            args.decoder_output_file, pytorch_encoder_outputs
-        )
+        decoder_step_ensemble.save_to_db(decoder_output_file, pytorch_encoder_outputs)
+
+
+def build_report_runner(args, checkpoint_filenames, quantize):
+    """
+    Returns a runner of the components exported with quantize, exporting
+    them to temporary files unless they are the ones saved to
+    args.encoder_output_file and args.decoder_output_file.
+    """
+    assert args.encoder_output_file and args.decoder_output_file, (
+        "--report-source-file needs both --encoder-output-file and "
+        "--decoder-output-file"
+    )
+    output_files = [args.encoder_output_file, args.decoder_output_file]
+    if quantize != args.quantize:
+        output_files = [
+            tempfile.NamedTemporaryFile(delete=False).name for _ in output_files
+        ]
+        export_components(args, checkpoint_filenames, quantize, *output_files)
+
+    eos = dictionary.Dictionary.load(args.target_vocab_file).eos()
+    runner = benchmark.Caffe2ComponentsRunner(*output_files, args.beam_size, eos)
+    if quantize != args.quantize:
+        # runners load the whole artifacts
+        for output_file in output_files:
+            os.remove(output_file)
+    return runner
 
 
 if __name__ == "__main__":
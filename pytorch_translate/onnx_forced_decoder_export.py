@@ -2,7 +2,7 @@
 
 import argparse
 
-from pytorch_translate import rnn  # noqa
+from pytorch_translate import quantization_report, rnn  # noqa
 from pytorch_translate.ensemble_export import ForcedDecoder
 
 
@@ -43,6 +43,7 @@ def main():
         default=0.0,
         help="Value to add for each word UNK token",
     )
+    quantization_report.add_quantization_args(parser)
 
     args = parser.parse_args()
 
@@ -59,6 +60,7 @@ def main():
         dst_dict_filename=args.dst_dict,
         word_reward=args.word_reward,
         unk_reward=args.unk_reward,
+        quantize=args.quantize,
     )
     forced_decoder.save_to_db(args.output_file)
 
@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
 
 import argparse
+import os
+import tempfile
 
-from pytorch_translate import rnn  # noqa
-from pytorch_translate.ensemble_export import BeamSearch
+from pytorch_translate import benchmark, dictionary, quantization_report, rnn  # noqa
+from pytorch_translate.ensemble_export import BeamSearch, EarlyStopBeamSearch
 
 
 def main():
@@ -49,6 +51,26 @@ def main():
         default=0.0,
         help="Value to add for each word UNK token",
     )
+    parser.add_argument(
+        "--output_format",
+        default="caffe2",
+        choices=["caffe2", "pytorch"],
+        help=(
+            "Save the beam search as a Caffe2 predictor database or as a "
+            "TorchScript module (BeamSearch.save_to_pytorch)"
+        ),
+    )
+    parser.add_argument(
+        "--early_stop",
+        action="store_true",
+        help=(
+            "Stop decoding once every hypothesis has finished. Only supported "
+            "with --output_format pytorch, since Caffe2 cannot run the "
+            "data-dependent loop"
+        ),
+    )
+    quantization_report.add_quantization_args(parser, default="dynamic-int8")
+    quantization_report.add_report_args(parser)
 
     args = parser.parse_args()
 
@@ -56,9 +78,24 @@ def main():
         print("No action taken. Need output_file to be specified.")
         parser.print_help()
         return
+    if args.early_stop and args.output_format != "pytorch":
+        parser.error("--early_stop requires --output_format pytorch")
 
     checkpoint_filenames = [arg[0] for arg in args.checkpoint]
+    export(args, checkpoint_filenames, args.quantize, args.output_file)
 
+    quantization_report.maybe_report(
+        args,
+        build_runner=lambda quantize: build_report_runner(
+            args, checkpoint_filenames, quantize
+        ),
+        checkpoint_filenames=checkpoint_filenames,
+        src_dict_filename=args.src_dict,
+        dst_dict_filename=args.dst_dict,
+    )
+
+
+def export(args, checkpoint_filenames, quantize, output_file):
     beam_search = BeamSearch.build_from_checkpoints(
         checkpoint_filenames=checkpoint_filenames,
         src_dict_filename=args.src_dict,
@@ -66,8 +103,35 @@ def main():
         beam_size=args.beam_size,
         word_reward=args.word_reward,
         unk_reward=args.unk_reward,
+        quantize=quantize,
     )
-    beam_search.save_to_db(args.output_file)
+    if args.early_stop:
+        beam_search = EarlyStopBeamSearch(beam_search)
+    if args.output_format == "pytorch":
+        beam_search.save_to_pytorch(output_file)
+    else:
+        beam_search.save_to_db(output_file)
+
+
+def build_report_runner(args, checkpoint_filenames, quantize):
+    """
+    Returns a runner of the beam search exported with quantize, exporting it
+    to a temporary file unless it is the one saved to args.output_file.
+    """
+    output_file = args.output_file
+    if quantize != args.quantize:
+        output_file = tempfile.NamedTemporaryFile(delete=False).name
+        export(args, checkpoint_filenames, quantize, output_file)
+
+    eos = dictionary.Dictionary.load(args.dst_dict).eos()
+    if args.output_format == "pytorch":
+        runner = benchmark.TorchScriptBeamSearchRunner(output_file, args.beam_size, eos)
+    else:
+        runner = benchmark.Caffe2BeamSearchRunner(output_file, args.beam_size, eos)
+    if output_file != args.output_file:
+        # runners load the whole artifact
+        os.remove(output_file)
+    return runner
 
 
 if __name__ == "__main__":
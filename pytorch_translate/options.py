@@ -365,6 +365,17 @@ def add_preprocessing_args(parser):
             "samples a specific component has received in a training batch."
         ),
     )
+    group.add_argument(
+        "--multiling-group-by-target-lang",
+        type=utils.bool_flag,
+        nargs="?",
+        const=True,
+        default=False,
+        help=(
+            "If true, only put sentences with the same target language into a "
+            "batch, so that each batch is decoded by a single decoder."
+        ),
+    )
 
     group.add_argument(
         "--penalized-target-tokens-file",
@@ -671,6 +682,16 @@ def expand_generation_args(group, train=False):
         default=0.0,
         help=("The diversity rate of sibling_rank for generating diverse beams"),
     )
+    group.add_argument(
+        "--inference-dtype",
+        default="fp32",
+        choices=utils.INFERENCE_DTYPES,
+        help=(
+            "Floating point type to cast models to for decoding. Output "
+            "log-softmax and score accumulation always run in fp32. fp16 is "
+            "meant for GPUs, bf16 also works on CPUs with bfloat16 support."
+        ),
+    )
 
     # These arguments are only used during training
     if train:
@@ -719,6 +740,27 @@ def add_verbosity_args(parser, train=False):
         "arguments, one per line). The default is 1."
         "one per line)",
     )
+    verbosity_group.add_argument(
+        "--memory-profile",
+        action="store_true",
+        help="Record peak allocated memory and CPU RSS for every train step, "
+        "eval and decode batch (bucketed by batch size, source length and beam), "
+        "and add them to the progress bar logs.",
+    )
+    verbosity_group.add_argument(
+        "--memory-profile-threshold-mb",
+        default=0.0,
+        type=float,
+        help="With --memory-profile, print the largest live tensors and top "
+        "allocation sites whenever peak memory exceeds this many MB and is "
+        "higher than any previously reported peak. 0 disables the dump.",
+    )
+    verbosity_group.add_argument(
+        "--memory-profile-top-k",
+        default=10,
+        type=int,
+        help="Number of allocation sites to print for --memory-profile-threshold-mb.",
+    )
     return verbosity_group
 
 
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+import json
+import time
+
+import numpy as np
+import torch
+from fairseq import bleu, tokenizer
+from pytorch_translate import dictionary
+from pytorch_translate.ensemble_export import QUANTIZE_OPTIONS
+
+
+def add_quantization_args(parser, default="none"):
+    parser.add_argument(
+        "--quantize",
+        default=default,
+        choices=QUANTIZE_OPTIONS,
+        help=(
+            "Dynamic quantization applied to the exported model: int8 linear "
+            "and LSTM cell weights, or fp16 linear weights."
+        ),
+    )
+
+
+def add_report_args(parser):
+    parser.add_argument(
+        "--report-source-file",
+        default="",
+        metavar="FILE",
+        help=(
+            "Held-out source text file. If set, the exported model is run on "
+            "it and compared against a float export (latency and accuracy)."
+        ),
+    )
+    parser.add_argument(
+        "--report-target-file",
+        default="",
+        metavar="FILE",
+        help="Reference translations of --report-source-file, used for BLEU.",
+    )
+    parser.add_argument(
+        "--report-output-file",
+        default="",
+        metavar="FILE",
+        help="If set, the quantization report is also written there as JSON.",
+    )
+
+
+def read_sentences(filename, dictionary, append_eos=False, reverse_order=False):
+    sentences = []
+    with open(filename, "r") as f:
+        for line in f:
+            inds = [dictionary.index(w) for w in tokenizer.tokenize_line(line)]
+            if reverse_order:
+                inds.reverse()
+            if append_eos:
+                inds.append(dictionary.eos())
+            sentences.append(inds)
+    return sentences
+
+
+def translate_sentences(runner, sentences, num_steps):
+    """
+    Translates sentences one at a time with an exported model runner (see
+    benchmark.build_exported_model_runner), as a serving thread would. Returns
+    the best hypothesis (without EOS) and its score for each sentence, and
+    the latency of each call in seconds.
+    """
+    hypos = []
+    scores = []
+    latencies = []
+    for inds in sentences:
+        start = time.perf_counter()
+        hypo, score = runner(inds, num_steps)
+        latencies.append(time.perf_counter() - start)
+        hypos.append(hypo)
+        scores.append(score)
+    return hypos, scores, latencies
+
+
+def quantization_report(
+    runners,
+    checkpoint_filenames,
+    src_dict_filename,
+    dst_dict_filename,
+    source_file,
+    target_file=None,
+    num_steps=200,
+):
+    """
+    Compares exported models on a held-out file. runners maps quantization
+    modes to runners of the models exported with them, "none" being the
+    float model. Returns a dict from quantization mode to latency
+    percentiles, throughput and (if target_file is given) BLEU; quantized
+    entries also report agreement with the float model.
+    """
+    model_args = torch.load(checkpoint_filenames[0], map_location="cpu")["args"]
+    src_dict = dictionary.Dictionary.load(src_dict_filename)
+    sentences = read_sentences(
+        source_file,
+        src_dict,
+        append_eos=getattr(model_args, "append_eos_to_source", False),
+        reverse_order=getattr(model_args, "reverse_source", False),
+    )
+    dst_dict = dictionary.Dictionary.load(dst_dict_filename)
+    references = None
+    if target_file:
+        references = read_sentences(target_file, dst_dict)
+        assert len(references) == len(sentences), "source/target size mismatch"
+
+    results = {}
+    translations = {}
+    for mode, runner in runners.items():
+        hypos, scores, latencies = translate_sentences(runner, sentences, num_steps)
+        latencies_ms = 1000 * np.array(latencies)
+        result = {
+            "sentences": len(sentences),
+            "latency_p50_ms": float(np.percentile(latencies_ms, 50)),
+            "latency_p90_ms": float(np.percentile(latencies_ms, 90)),
+            "latency_p99_ms": float(np.percentile(latencies_ms, 99)),
+            "sentences_per_sec": len(sentences) / sum(latencies),
+        }
+        if references is not None:
+            scorer = bleu.Scorer(dst_dict.pad(), dst_dict.eos(), dst_dict.unk())
+            for reference, hypo in zip(references, hypos):
+                scorer.add(torch.IntTensor(reference), torch.IntTensor(hypo))
+            result["bleu"] = scorer.score()
+        results[mode] = result
+        translations[mode] = (hypos, scores)
+
+    float_hypos, float_scores = translations["none"]
+    for mode, (hypos, scores) in translations.items():
+        if mode == "none":
+            continue
+        results[mode]["exact_match_with_float"] = float(
+            np.mean([h == f for h, f in zip(hypos, float_hypos)])
+        )
+        results[mode]["mean_abs_score_diff"] = float(
+            np.mean(np.abs(np.array(scores) - np.array(float_scores)))
+        )
+        results[mode]["speedup_p50"] = (
+            results["none"]["latency_p50_ms"] / results[mode]["latency_p50_ms"]
+        )
+    return results
+
+
+def print_report(results, output_file=""):
+    for mode, result in results.items():
+        print(f"| quantize={mode}")
+        for key, value in result.items():
+            print(f"|   {key}: {value:.4f}")
+    if output_file:
+        with open(output_file, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+def maybe_report(
+    args, build_runner, checkpoint_filenames, src_dict_filename, dst_dict_filename
+):
+    """
+    Reports on the exported model if --report-source-file is set.
+    build_runner(quantize) returns a runner of the model exported with
+    quantize: the artifact just written for args.quantize, and a float
+    export for "none".
+    """
+    if not args.report_source_file:
+        return
+    runners = {mode: build_runner(mode) for mode in ["none", args.quantize]}
+    results = quantization_report(
+        runners,
+        checkpoint_filenames=checkpoint_filenames,
+        src_dict_filename=src_dict_filename,
+        dst_dict_filename=dst_dict_filename,
+        source_file=args.report_source_file,
+        target_file=args.report_target_file,
+    )
+    print_report(results, args.report_output_file)
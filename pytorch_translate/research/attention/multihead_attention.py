@@ -5,6 +5,7 @@ import math
 import numpy as np
 import torch
 import torch.nn.functional as F
+from pytorch_translate.utils import get_future_mask
 from torch import nn
 
 
@@ -20,27 +21,22 @@ def create_src_lengths_mask(batch_size, src_lengths):
 def apply_masks(scores, batch_size, unseen_mask, src_lengths):
     seq_len = scores.shape[-1]
 
-    # [1, seq_len, seq_len]
-    sequence_mask = torch.ones(seq_len, seq_len).unsqueeze(0).int()
     if unseen_mask:
-        # [1, seq_len, seq_len]
-        sequence_mask = (
-            torch.tril(torch.ones(seq_len, seq_len), diagonal=0).unsqueeze(0).int()
+        # [seq_len, seq_len] additive mask, shared with all other callers so
+        # that no per-call [seq_len, seq_len] mask has to be built
+        scores = scores + get_future_mask(
+            seq_len, device=scores.device, dtype=scores.dtype
         )
 
     if src_lengths is not None:
-        # [batch_size, 1, seq_len]
-        src_lengths_mask = create_src_lengths_mask(
-            batch_size=batch_size, src_lengths=src_lengths
-        ).unsqueeze(-2)
-
-        # [batch_size, seq_len, seq_len]
-        sequence_mask = sequence_mask & src_lengths_mask
-
-    # [batch_size, 1, seq_len, seq_len]
-    sequence_mask = sequence_mask.unsqueeze(1)
+        # [batch_size, 1, 1, seq_len]
+        src_lengths_mask = (
+            create_src_lengths_mask(batch_size=batch_size, src_lengths=src_lengths)
+            .unsqueeze(1)
+            .unsqueeze(2)
+        )
+        scores = scores.masked_fill(src_lengths_mask == 0, -np.inf)
 
-    scores = scores.masked_fill(sequence_mask == 0, -np.inf)
     return scores
 
 
@@ -9,6 +9,16 @@ from fairseq.criterions import FairseqCriterion, register_criterion
 from pytorch_translate import utils as pytorch_translate_utils
 
 
+def sparse_kd_loss(lprobs, topk_ids, topk_probs):
+    """KD loss against sparse teacher targets. topk_ids and topk_probs are
+    [N, k] teacher tokens and probabilities for the N rows of lprobs; each row is
+    renormalized over its k tokens and all-zero (padding) rows are ignored."""
+    topk_probs = topk_probs.type_as(lprobs)
+    row_sums = topk_probs.sum(dim=-1, keepdim=True)
+    topk_probs = topk_probs / row_sums.masked_fill(row_sums == 0, 1)
+    return -torch.sum(topk_probs * lprobs.gather(-1, topk_ids))
+
+
 @register_criterion("word_knowledge_distillation")
 class KnowledgeDistillationCriterion(FairseqCriterion):
     def __init__(self, args, task):
@@ -18,6 +28,18 @@ class KnowledgeDistillationCriterion(FairseqCriterion):
         http://www.aclweb.org/anthology/D16-1139
         """
         super().__init__(args, task)
+        self.kd_weight = getattr(args, "kd_weight", 0)
+        if self.kd_weight < 0 or self.kd_weight > 1:
+            raise ValueError(f"--kd-weight ({self.kd_weight}) must be in [0, 1]")
+
+        self.top_k_teacher_tokens = getattr(args, "top_k_teacher_tokens", 8)
+
+        # With precomputed teacher outputs (see teacher_cache.py), the training
+        # dataset provides the sparse teacher targets and no teacher is loaded.
+        self.use_teacher_cache = bool(getattr(args, "teacher_topk_cache_path", ""))
+        if self.use_teacher_cache:
+            return
+
         assert (
             args.teacher_path
         ), "Please specify at least one valid file for --teacher-path"
@@ -37,12 +59,6 @@ class KnowledgeDistillationCriterion(FairseqCriterion):
                 beamable_mm_beam_size=None if args.no_beamable_mm else args.beam
             )
 
-        self.kd_weight = getattr(args, "kd_weight", 0)
-        if self.kd_weight < 0 or self.kd_weight > 1:
-            raise ValueError(f"--kd-weight ({self.kd_weight}) must be in [0, 1]")
-
-        self.top_k_teacher_tokens = getattr(args, "top_k_teacher_tokens", 8)
-
     @staticmethod
     def add_args(parser):
         """Add criterion-specific arguments to the parser."""
@@ -72,6 +88,16 @@ class KnowledgeDistillationCriterion(FairseqCriterion):
                 "enumerating all.",
             ),
         )
+        parser.add_argument(
+            "--teacher-topk-cache-path",
+            default="",
+            metavar="PREFIX",
+            help=(
+                "Prefix of precomputed teacher top-k outputs for the training set "
+                "(written by research/knowledge_distillation/teacher_cache.py). "
+                "When set, no teacher model is run during training."
+            ),
+        )
 
     def forward(self, model, sample, reduce=True):
         """Compute the loss for the given sample.
@@ -88,39 +114,20 @@ class KnowledgeDistillationCriterion(FairseqCriterion):
         # [bsz, seqlen, vocab] -> [bsz*seqlen, vocab]
         lprobs = lprobs.view(-1, lprobs.size(-1))
 
-        # 2. Generate translation using teacher models
-        avg_probs = None
-        for teacher_model in self.teacher_models:
-            teacher_output = teacher_model(**sample["net_input"])
-            probs = teacher_model.get_normalized_probs(teacher_output, log_probs=False)
-            if avg_probs is None:
-                avg_probs = probs
-            else:
-                avg_probs.add_(probs)
-        avg_probs.div_(len(self.teacher_models))
-        avg_probs = avg_probs.view(-1, avg_probs.size(-1)).detach()
+        target = model.get_targets(sample, net_output).view(-1)
 
-        if self.top_k_teacher_tokens > 0:
-            # Getting the topk probabilities, masking others, normalizing the topk
-            # probabilities.
-            top_k_teacher_tokens_avg_probs, indices = torch.topk(
-                avg_probs, k=self.top_k_teacher_tokens
-            )
-            top_k_teacher_tokens_probs_normalized = (
-                top_k_teacher_tokens_avg_probs
-                / torch.sum(top_k_teacher_tokens_avg_probs)
-            )
-            topk_mask = torch.zeros(avg_probs.shape).type_as(avg_probs)
-            topk_probs = topk_mask.scatter(
-                1, indices, top_k_teacher_tokens_probs_normalized
+        # 2. Generate translation using teacher models
+        if self.use_teacher_cache:
+            top_k = sample["teacher_topk_ids"].size(-1)
+            kd_loss = sparse_kd_loss(
+                lprobs,
+                sample["teacher_topk_ids"].view(-1, top_k),
+                sample["teacher_topk_probs"].view(-1, top_k),
             )
-
-            kd_loss = -torch.sum(topk_probs * lprobs)
         else:
-            kd_loss = -torch.sum(avg_probs * lprobs)
+            kd_loss = self.compute_teacher_kd_loss(sample, lprobs, target)
 
         # 3. Compute NLL loss with respect to the ground truth
-        target = model.get_targets(sample, net_output).view(-1)
         nll_loss = F.nll_loss(
             lprobs,
             target,
@@ -148,6 +155,37 @@ class KnowledgeDistillationCriterion(FairseqCriterion):
         }
         return loss, sample_size, logging_output
 
+    def compute_teacher_kd_loss(self, sample, lprobs, target):
+        """Runs the teacher ensemble on sample and returns the KD loss of the
+        student log-probabilities lprobs ([bsz*seqlen, vocab]). Padding
+        positions of target ([bsz*seqlen]) are ignored."""
+        with torch.no_grad():
+            avg_probs = None
+            for teacher_model in self.teacher_models:
+                teacher_output = teacher_model(**sample["net_input"])
+                probs = teacher_model.get_normalized_probs(
+                    teacher_output, log_probs=False
+                )
+                if avg_probs is None:
+                    avg_probs = probs
+                else:
+                    avg_probs.add_(probs)
+            avg_probs = avg_probs.view(-1, avg_probs.size(-1))
+            avg_probs.div_(len(self.teacher_models))
+            avg_probs.masked_fill_(target.eq(self.padding_idx).unsqueeze(-1), 0)
+            if self.top_k_teacher_tokens > 0:
+                # Only the top k teacher tokens of each position are kept, so
+                # the loss is computed from a [bsz*seqlen, k] gather of the
+                # student log-probabilities instead of vocab-sized targets.
+                topk_probs, topk_ids = torch.topk(
+                    avg_probs, k=self.top_k_teacher_tokens
+                )
+                del avg_probs
+
+        if self.top_k_teacher_tokens > 0:
+            return sparse_kd_loss(lprobs, topk_ids, topk_probs)
+        return -torch.sum(avg_probs * lprobs)
+
     @staticmethod
     def aggregate_logging_outputs(logging_outputs):
         """Aggregate logging outputs from data parallel training."""
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+
+"""
+Offline teacher outputs for word-level knowledge distillation.
+
+Running every teacher on every training batch dominates the cost of
+distillation and keeps the whole ensemble in GPU memory. Instead, the teacher
+ensemble can be run once over the training set with this script, which stores
+the top-k token ids and (averaged, unnormalized) probabilities of every target
+position in memory-mapped .npy files:
+
+    <prefix>.ids.npy      int32   [total_target_tokens, k]
+    <prefix>.probs.npy    float16 [total_target_tokens, k]
+    <prefix>.offsets.npy  int64   [num_examples + 1]
+
+Rows offsets[i]:offsets[i + 1] hold the target positions of example i of the
+training dataset. Passing --teacher-topk-cache-path <prefix> to the
+word_knowledge_distillation criterion then loads these rows in the collater
+instead of running the teachers.
+"""
+
+import numpy as np
+import torch
+from fairseq import options, tasks, utils
+from fairseq.data import FairseqDataset
+from pytorch_translate import (
+    options as pytorch_translate_options,
+    utils as pytorch_translate_utils,
+)
+
+
+def cache_paths(prefix):
+    return f"{prefix}.ids.npy", f"{prefix}.probs.npy", f"{prefix}.offsets.npy"
+
+
+class TeacherTopKCache(object):
+    """Read-only view of the memory-mapped teacher top-k outputs."""
+
+    def __init__(self, prefix):
+        ids_path, probs_path, offsets_path = cache_paths(prefix)
+        self.ids = np.load(ids_path, mmap_mode="r")
+        self.probs = np.load(probs_path, mmap_mode="r")
+        self.offsets = np.load(offsets_path)
+        assert self.ids.shape == self.probs.shape
+        assert self.offsets[-1] == len(self.ids)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def top_k(self):
+        return self.ids.shape[1]
+
+    def lengths(self):
+        return self.offsets[1:] - self.offsets[:-1]
+
+    def collate(self, indices, tgt_len, pad_idx):
+        """Returns [bsz, tgt_len, k] ids and probs for the given examples.
+        Positions past the end of an example get probability 0."""
+        ids = torch.full((len(indices), tgt_len, self.top_k), pad_idx).long()
+        probs = torch.zeros(len(indices), tgt_len, self.top_k)
+        for i, index in enumerate(indices):
+            start, end = self.offsets[index], self.offsets[index + 1]
+            ids[i, : end - start] = torch.from_numpy(
+                self.ids[start:end].astype(np.int64)
+            )
+            probs[i, : end - start] = torch.from_numpy(
+                self.probs[start:end].astype(np.float32)
+            )
+        return ids, probs
+
+
+class TeacherTopKDataset(FairseqDataset):
+    """
+    Wraps a language pair dataset so that every collated sample also carries
+    the cached teacher targets for its (right-padded) target positions, as
+    sample["teacher_topk_ids"] and sample["teacher_topk_probs"]. Batching
+    (sizes, ordering, prefetching) is that of the wrapped dataset.
+    """
+
+    def __init__(self, dataset, cache):
+        assert len(dataset) == len(cache), (
+            f"Teacher cache has {len(cache)} examples but the dataset has "
+            f"{len(dataset)}"
+        )
+        assert np.array_equal(
+            cache.lengths(), dataset.tgt_sizes
+        ), "Teacher cache is not aligned with the dataset target lengths"
+        self.dataset = dataset
+        self.cache = cache
+        self.src_dict = dataset.src_dict
+        self.tgt_dict = dataset.tgt_dict
+        self.src_sizes = dataset.src_sizes
+        self.tgt_sizes = dataset.tgt_sizes
+
+    def __getitem__(self, i):
+        return self.dataset[i]
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def num_tokens(self, index):
+        return self.dataset.num_tokens(index)
+
+    def size(self, index):
+        return self.dataset.size(index)
+
+    def ordered_indices(self):
+        return self.dataset.ordered_indices()
+
+    @property
+    def supports_prefetch(self):
+        return getattr(self.dataset, "supports_prefetch", False)
+
+    def prefetch(self, indices):
+        self.dataset.prefetch(indices)
+
+    def collater(self, samples):
+        sample = self.dataset.collater(samples)
+        if len(sample) == 0:
+            return sample
+        ids, probs = self.cache.collate(
+            sample["id"].tolist(), sample["target"].size(1), self.tgt_dict.pad()
+        )
+        sample["teacher_topk_ids"] = ids
+        sample["teacher_topk_probs"] = probs
+        return sample
+
+    def get_dummy_batch(self, *args, **kwargs):
+        sample = self.dataset.get_dummy_batch(*args, **kwargs)
+        bsz, tgt_len = sample["target"].size()
+        sample["teacher_topk_ids"] = torch.full(
+            (bsz, tgt_len, self.cache.top_k), self.tgt_dict.pad()
+        ).long()
+        sample["teacher_topk_probs"] = torch.zeros(bsz, tgt_len, self.cache.top_k)
+        return sample
+
+
+def dump_teacher_topk(teacher_models, dataset, prefix, top_k, batch_size=64):
+    """Runs the teacher ensemble over every example of dataset and writes
+    the averaged top-k probabilities of each target position under prefix."""
+    use_cuda = next(teacher_models[0].parameters()).is_cuda
+    offsets = np.zeros(len(dataset) + 1, dtype=np.int64)
+    np.cumsum(dataset.tgt_sizes, out=offsets[1:])
+    ids_path, probs_path, offsets_path = cache_paths(prefix)
+    ids_out = np.lib.format.open_memmap(
+        ids_path, mode="w+", dtype=np.int32, shape=(offsets[-1], top_k)
+    )
+    probs_out = np.lib.format.open_memmap(
+        probs_path, mode="w+", dtype=np.float16, shape=(offsets[-1], top_k)
+    )
+
+    indices = dataset.ordered_indices()
+    for model in teacher_models:
+        model.eval()
+    with torch.no_grad():
+        for i in range(0, len(indices), batch_size):
+            sample = dataset.collater([dataset[j] for j in indices[i : i + batch_size]])
+            if use_cuda:
+                sample = utils.move_to_cuda(sample)
+            avg_probs = None
+            for model in teacher_models:
+                probs = model.get_normalized_probs(
+                    model(**sample["net_input"]), log_probs=False
+                )
+                avg_probs = probs if avg_probs is None else avg_probs.add_(probs)
+            avg_probs.div_(len(teacher_models))
+            topk_probs, topk_ids = avg_probs.topk(top_k, dim=-1)
+            topk_probs, topk_ids = topk_probs.cpu().numpy(), topk_ids.cpu().numpy()
+            for row, index in enumerate(sample["id"].tolist()):
+                start, end = offsets[index], offsets[index + 1]
+                ids_out[start:end] = topk_ids[row, : end - start]
+                probs_out[start:end] = topk_probs[row, : end - start]
+
+    ids_out.flush()
+    probs_out.flush()
+    np.save(offsets_path, offsets)
+    print(
+        f"| wrote top-{top_k} teacher outputs for {len(dataset)} examples "
+        f"({offsets[-1]} target tokens) to {prefix}"
+    )
+
+
+def get_parser_with_args():
+    parser = options.get_parser("Teacher top-k", default_task="pytorch_translate")
+    pytorch_translate_options.add_verbosity_args(parser)
+    pytorch_translate_options.add_dataset_args(parser, train=True)
+    pytorch_translate_options.add_preprocessing_args(parser)
+    group = parser.add_argument_group("Teacher top-k")
+    group.add_argument(
+        "--teacher-path",
+        metavar="FILE",
+        help="path(s) to teacher model file(s) colon separated",
+    )
+    group.add_argument(
+        "--top-k-teacher-tokens",
+        type=int,
+        default=8,
+        help="number of teacher tokens to store for every target position",
+    )
+    group.add_argument(
+        "--teacher-topk-output",
+        metavar="PREFIX",
+        help="prefix of the .ids.npy, .probs.npy and .offsets.npy output files",
+    )
+    return parser
+
+
+def main():
+    parser = get_parser_with_args()
+    args = options.parse_args_and_arch(parser)
+    assert args.teacher_path, "Please specify --teacher-path"
+    assert args.teacher_topk_output, "Please specify --teacher-topk-output"
+    assert args.top_k_teacher_tokens > 0, "--top-k-teacher-tokens must be positive"
+    pytorch_translate_options.print_args(args)
+
+    task = tasks.setup_task(args)
+    task.load_dataset(
+        args.train_subset,
+        args.train_source_binary_path,
+        args.train_target_binary_path,
+    )
+    teacher_models, _, _ = pytorch_translate_utils.load_diverse_ensemble_for_inference(
+        args.teacher_path.split(":"), task
+    )
+    if torch.cuda.is_available() and not args.cpu:
+        for model in teacher_models:
+            model.cuda()
+    dump_teacher_topk(
+        teacher_models,
+        task.dataset(args.train_subset),
+        args.teacher_topk_output,
+        args.top_k_teacher_tokens,
+        batch_size=args.max_sentences or 64,
+    )
+
+
+if __name__ == "__main__":
+    main()
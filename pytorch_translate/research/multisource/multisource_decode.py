@@ -91,6 +91,7 @@ class MultiSourceSequenceGenerator(torch.nn.Module):
         cuda=False,
         timer=None,
         prefix_size=0,
+        memory_profiler=None,
     ):
         """Iterate over a batched dataset and yield individual translations.
 
@@ -99,6 +100,8 @@ class MultiSourceSequenceGenerator(torch.nn.Module):
                 where x is the source sentence length.
             cuda: use GPU for generation
             timer: StopwatchMeter for timing generations.
+            memory_profiler: MemoryProfiler recording memory per batch,
+                bucketed by (bsz, srclen, beam).
         """
         if maxlen_b is None:
             maxlen_b = self.maxlen
@@ -116,6 +119,8 @@ class MultiSourceSequenceGenerator(torch.nn.Module):
                     "multisource sentences."
                 )
             encoder_inputs = (input["src_tokens"], input["src_lengths"])
+            if memory_profiler is not None:
+                memory_profiler.start()
             if timer is not None:
                 timer.start()
             with torch.no_grad():
@@ -130,6 +135,11 @@ class MultiSourceSequenceGenerator(torch.nn.Module):
                 )
             if timer is not None:
                 timer.stop(s["ntokens"])
+            if memory_profiler is not None:
+                memory_profiler.stop(
+                    key=(len(s["id"]), srclen, beam_size or self.beam_size),
+                    name="decode batch",
+                )
             for i, id in enumerate(s["id"]):
                 src = input["src_tokens"].index_select(
                     0, input["src_ids"][self.align_to]
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+import shutil
+import tempfile
+import unittest
+from os import path
+
+from pytorch_translate.research.unsupervised_morphology import (
+    morphology_runner,
+    unsupervised_morphology,
+)
+
+
+class TestMorphologyRunner(unittest.TestCase):
+    def test_segment_file(self):
+        test_dir = tempfile.mkdtemp()
+        input_file = path.join(test_dir, "input.txt")
+        with open(input_file, "w", encoding="utf-8") as f:
+            f.write("123 124 234 345\n112 122 123 345\n\n123456789\n123456 456789\n")
+        model_path = path.join(test_dir, "model")
+        params = unsupervised_morphology.MorphologyHMMParams()
+        params.init_uniform_params_from_data(input_file)
+        params.save(model_path)
+
+        segmentor = unsupervised_morphology.MorphologySegmentor(
+            unsupervised_morphology.MorphologyHMMParams.load(model_path)
+        )
+        with open(input_file, "r", encoding="utf-8") as f:
+            expected = [
+                " ".join(
+                    segmentor.segment_word(word, add_affix_symbols=True)
+                    for word in line.strip().split()
+                )
+                for line in f
+            ]
+
+        output_file = path.join(test_dir, "output.txt")
+        cache_path = path.join(test_dir, "segment_cache.txt")
+        for num_cpus, expected_segmented in [(2, 9), (1, 0)]:
+            num_types, num_segmented = morphology_runner.segment_file(
+                model_path,
+                input_file,
+                output_file,
+                num_cpus=num_cpus,
+                cache_path=cache_path,
+                chunk_size=2,
+            )
+            assert num_types == 9
+            # The second run reads every segmentation from the cache.
+            assert num_segmented == expected_segmented
+            with open(output_file, "r", encoding="utf-8") as f:
+                assert f.read().splitlines() == expected
+
+        # The cache is not reused with other options.
+        _, num_segmented = morphology_runner.segment_file(
+            model_path,
+            input_file,
+            output_file,
+            add_affix_symbols=False,
+            num_cpus=1,
+            cache_path=cache_path,
+        )
+        assert num_segmented == 9
+        shutil.rmtree(test_dir)
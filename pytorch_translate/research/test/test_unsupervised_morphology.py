@@ -8,7 +8,11 @@ import unittest
 from os import path
 from unittest.mock import Mock, patch
 
-from pytorch_translate.research.unsupervised_morphology import unsupervised_morphology
+import numpy as np
+from pytorch_translate.research.unsupervised_morphology import (
+    morpheme_index,
+    unsupervised_morphology,
+)
 
 
 def get_all_substrings(string):
@@ -66,6 +70,61 @@ class TestUnsupervisedMorphology(unittest.TestCase):
             assert morph_hmm_model.affix_trans_probs["END"]["suffix"] == 0
             assert morph_hmm_model.affix_trans_probs["END"]["END"] == 0
 
+    def test_pruned_morph_init(self):
+        morph_hmm_model = unsupervised_morphology.MorphologyHMMParams(
+            max_morph_length=3, min_morph_count=3
+        )
+        with patch("builtins.open") as mock_open:
+            txt_content = [
+                "123 124 234 345",
+                "112 122 123 345",
+                "123456789",
+                "123456 456789",
+            ]
+            mock_open.return_value.__enter__ = mock_open
+            mock_open.return_value.__iter__ = Mock(return_value=iter(txt_content))
+            morph_hmm_model.init_uniform_params_from_data("no_exist_file.txt")
+
+            stems = morph_hmm_model.morph_emit_probs["stem"]
+            assert all(len(stem) <= 3 for stem in stems)
+            assert "12" in stems
+            assert "345" in stems
+            # Longer than max_morph_length.
+            assert "1234" not in stems
+            # Seen only twice.
+            assert "789" not in stems
+            assert stems["345"] == 1.1 / (len(stems) * 1.1)
+            # Pruned morphemes have zero likeness.
+            assert morph_hmm_model.emission_prob("stem", "789") == 0
+
+    def test_morpheme_index_string_pool(self):
+        long_word = "x" * 500 + "yz"
+        word_counts = {"çağ": 2, "ağa": 1, long_word: 3}
+        index = morpheme_index.MorphemeIndex.build(word_counts, min_morph_count=2)
+        # Words of any length only cost their bytes in the pool.
+        assert index.pool.dtype == np.uint8
+        assert index.offsets[-1] == len(index.pool)
+        morphemes = [index.morpheme(i) for i in range(len(index))]
+        assert morphemes == sorted(morphemes)
+        assert "ağ" in morphemes and long_word in morphemes
+        # Seen once.
+        assert "ağa" not in morphemes
+        assert index.counts[index.index("ağ")] == 3
+        assert list(index.lookup(["ç", long_word[:-1], "ağa", "x" * 501])) == [
+            morphemes.index("ç"),
+            morphemes.index(long_word[:-1]),
+            -1,
+            -1,
+        ]
+
+        test_dir = tempfile.mkdtemp()
+        index.save(path.join(test_dir, "index"))
+        loaded = morpheme_index.MorphemeIndex.load(path.join(test_dir, "index"))
+        assert isinstance(loaded.pool, np.memmap)
+        assert [loaded.morpheme(i) for i in range(len(loaded))] == morphemes
+        assert loaded.index(long_word) == morphemes.index(long_word)
+        shutil.rmtree(test_dir)
+
     def test_zero_out_params(self):
         morph_hmm_model = unsupervised_morphology.MorphologyHMMParams()
         with patch("builtins.open") as mock_open:
@@ -271,6 +330,42 @@ class TestUnsupervisedMorphology(unittest.TestCase):
             segmentor = unsupervised_morphology.MorphologySegmentor(morph_hmm_model)
             assert segmentor.segment_viterbi("123123789") == (["stem"], [0, 9])
 
+    def test_segment_viterbi_words(self):
+        morph_hmm_model = unsupervised_morphology.MorphologyHMMParams()
+        with patch("builtins.open") as mock_open:
+            txt_content = [
+                "123 124 234 345",
+                "112 122 123 345",
+                "123456789",
+                "123456 456789",
+            ]
+            mock_open.return_value.__enter__ = mock_open
+            mock_open.return_value.__iter__ = Mock(return_value=iter(txt_content))
+            morph_hmm_model.init_uniform_params_from_data("no_exist_file.txt")
+
+        segmentor = unsupervised_morphology.MorphologySegmentor(morph_hmm_model)
+        words = ["123123789", "456", "1", "124", "123456", "789789", "99"]
+        segmentations = segmentor.segment_viterbi_words(words, batch_size=2)
+        for word, (labels, indices) in zip(words, segmentations):
+            assert segmentor.segment_viterbi(word) == (labels, indices)
+            assert indices[0] == 0 and indices[-1] == len(word)
+            assert len(labels) + 1 == len(indices)
+        # Words without any plausible segmentation are kept as a single stem.
+        assert segmentor.segment_viterbi("1") == (["stem"], [0, 1])
+        # The cache holds each distinct substring once.
+        cache = {}
+        for word in words:
+            assert np.array_equal(
+                morph_hmm_model.word_emission_probs(word, cache),
+                morph_hmm_model.word_emission_probs(word),
+            )
+        assert set(cache) == {
+            substr for word in words for substr in get_all_substrings(word)
+        }
+        assert segmentor.segment_words(words, add_affix_symbols=True) == [
+            segmentor.segment_word(word, add_affix_symbols=True) for word in words
+        ]
+
     def test_segment_word_no_smoothing(self):
         morph_hmm_model = unsupervised_morphology.MorphologyHMMParams(
             smoothing_const=0.0, use_morph_likeness=False
@@ -459,6 +554,34 @@ class TestUnsupervisedMorphology(unittest.TestCase):
             )
             unsupervised_model.expectation_maximization(10, 10)
 
+    def test_EM_independent_of_num_cpus(self):
+        txt_content = ["work works worked working", "go goes gone going see seeing"]
+        models = []
+        for num_cpus in [1, 3]:
+            with patch("builtins.open") as mock_open:
+                mock_open.return_value.__enter__ = mock_open
+                mock_open.return_value.__iter__ = Mock(return_value=iter(txt_content))
+                unsupervised_model = unsupervised_morphology.UnsupervisedMorphology(
+                    "no_exist_file.txt", smoothing_const=0.1
+                )
+            unsupervised_model.expectation_maximization(3, num_cpus)
+            models.append(unsupervised_model)
+
+        params1, params3 = models[0].params, models[1].params
+        for tag in params1.morph_emit_probs.keys():
+            for morph, prob in params1.morph_emit_probs[tag].items():
+                assert math.isclose(
+                    prob, params3.morph_emit_probs[tag][morph], rel_tol=1e-9
+                )
+        for prev_tag in params1.affix_trans_probs.keys():
+            for tag, prob in params1.affix_trans_probs[prev_tag].items():
+                assert math.isclose(
+                    prob,
+                    params3.affix_trans_probs[prev_tag][tag],
+                    rel_tol=1e-9,
+                    abs_tol=1e-12,
+                )
+
     def test_get_expectations_from_viterbi(self):
         with patch("builtins.open") as mock_open:
             txt_content = [
@@ -535,4 +658,5 @@ class TestUnsupervisedMorphology(unittest.TestCase):
             unsupervised_model.params.smoothing_const == loaded_params.smoothing_const
         )
         assert unsupervised_model.params.SMALL_CONST == loaded_params.SMALL_CONST
+        assert isinstance(loaded_params.morph_emit_array, np.memmap)
         shutil.rmtree(test_dir)
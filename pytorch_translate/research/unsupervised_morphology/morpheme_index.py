@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+
+from array import array
+from collections.abc import MutableMapping
+
+import numpy as np
+
+# Bit flags of the morpheme classes a candidate morpheme can be emitted by.
+PREFIX, STEM, SUFFIX = 1, 2, 4
+CLASS_FLAGS = {"prefix": PREFIX, "stem": STEM, "suffix": SUFFIX}
+
+
+def candidate_classes(word, start, end):
+    """
+    Returns the class flags of word[start:end] as a candidate morpheme: prefixes
+    leave at least two characters of the word after them, stems have at least
+    two characters (or are a whole word of length at most two) and suffixes
+    leave at least two characters before them.
+    """
+    n = len(word)
+    flags = 0
+    if end < n - 1:
+        flags |= PREFIX
+    if end - start >= 2 or n <= 2 and start == 0 and end == n:
+        flags |= STEM
+    if start >= 2:
+        flags |= SUFFIX
+    return flags
+
+
+def _compare_rows(a, b):
+    """
+    Compares the rows of two byte arrays lexicographically: returns -1, 0 or 1
+    for every row of a lower than, equal to or greater than the one of b.
+    """
+    different = a != b
+    first = different.argmax(axis=1)
+    rows = np.arange(len(a))
+    return np.where(
+        different.any(axis=1),
+        np.sign(a[rows, first].astype(np.int16) - b[rows, first]),
+        0,
+    )
+
+
+class MorphemeIndex(object):
+    """
+    Compact index of the candidate morphemes of a vocabulary. Morphemes are kept
+    sorted in a string pool: one buffer with their concatenated UTF-8 bytes and
+    the offsets of every morpheme in it, so that the id of a morpheme is its
+    position in the pool and lookups are binary searches. Next to it, the index
+    keeps the class flags and the frequency of every morpheme.
+    """
+
+    def __init__(self, pool, offsets, class_flags, counts):
+        self.pool = pool
+        self.offsets = offsets
+        self.class_flags = class_flags
+        self.counts = counts
+
+    @staticmethod
+    def build(word_counts, max_morph_length=None, min_morph_count=1):
+        """
+        Collects every substring of the words in word_counts as a candidate
+        morpheme, with its frequency in the (token-weighted) vocabulary.
+        Substrings are counted one length at a time, and a substring is only
+        counted when both its substrings one character shorter are frequent
+        enough, since it cannot be seen more often than them.
+        Args:
+            max_morph_length: if set, longer substrings are not candidates.
+            min_morph_count: substrings seen less often are not candidates.
+        """
+        max_length = max((len(word) for word in word_counts), default=0)
+        if max_morph_length is not None:
+            max_length = min(max_length, max_morph_length)
+
+        morphemes = []
+        counts = array("q")
+        class_flags = bytearray()
+        frequent = None
+        for length in range(1, max_length + 1):
+            length_counts = {}
+            length_flags = {}
+            for word, word_count in word_counts.items():
+                n = len(word)
+                for start in range(n - length + 1):
+                    end = start + length
+                    substr = word[start:end]
+                    if frequent is not None and (
+                        substr[:-1] not in frequent or substr[1:] not in frequent
+                    ):
+                        continue
+                    length_counts[substr] = length_counts.get(substr, 0) + word_count
+                    flags = candidate_classes(word, start, end)
+                    length_flags[substr] = length_flags.get(substr, 0) | flags
+            frequent = {
+                substr
+                for substr, count in length_counts.items()
+                if count >= min_morph_count
+            }
+            for substr in frequent:
+                morphemes.append(substr)
+                counts.append(length_counts[substr])
+                class_flags.append(length_flags[substr])
+            del length_counts, length_flags
+            if min_morph_count <= 1:
+                # Nothing is pruned, so there is no need to check shorter ones.
+                frequent = None
+
+        # Code point order of the strings is the byte order of their UTF-8.
+        order = sorted(range(len(morphemes)), key=morphemes.__getitem__)
+        encoded = [morphemes[i].encode("utf-8") for i in order]
+        del morphemes
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(m) for m in encoded], out=offsets[1:])
+        pool = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        order = np.array(order, dtype=np.int64)
+        return MorphemeIndex(
+            pool,
+            offsets,
+            np.frombuffer(class_flags, dtype=np.uint8)[order],
+            np.frombuffer(counts, dtype=np.int64)[order],
+        )
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def morpheme(self, i):
+        return (
+            self.pool[self.offsets[i] : self.offsets[i + 1]].tobytes().decode("utf-8")
+        )
+
+    def _padded(self, ids, width):
+        """
+        Returns the first width bytes of the morphemes ids as the rows of an
+        array, padded with zeros.
+        """
+        starts = self.offsets[ids]
+        lengths = self.offsets[ids + 1] - starts
+        columns = np.arange(width)
+        in_morpheme = columns < lengths[:, None]
+        rows = self.pool[np.where(in_morpheme, starts[:, None] + columns, 0)]
+        rows[~in_morpheme] = 0
+        return rows
+
+    def lookup(self, morphemes):
+        """
+        Returns the ids of a list of morphemes, -1 for the ones not in the index.
+        All the morphemes are binary searched together over the pool.
+        """
+        if len(morphemes) == 0 or len(self) == 0:
+            return np.full(len(morphemes), -1, dtype=np.int64)
+        encoded = [m.encode("utf-8") for m in morphemes]
+        # One more byte than the longest key, so that keys compare lower than
+        # the longer morphemes they are a prefix of.
+        width = max(len(m) for m in encoded) + 1
+        keys = np.zeros((len(encoded), width), dtype=np.uint8)
+        for row, m in zip(keys, encoded):
+            row[: len(m)] = np.frombuffer(m, dtype=np.uint8)
+
+        low = np.zeros(len(keys), dtype=np.int64)
+        high = np.full(len(keys), len(self), dtype=np.int64)
+        while True:
+            searching = np.flatnonzero(low < high)
+            if len(searching) == 0:
+                break
+            middle = (low[searching] + high[searching]) // 2
+            less = _compare_rows(self._padded(middle, width), keys[searching]) < 0
+            low[searching[less]] = middle[less] + 1
+            high[searching[~less]] = middle[~less]
+
+        positions = np.minimum(low, len(self) - 1)
+        found = _compare_rows(self._padded(positions, width), keys) == 0
+        return np.where(found, positions, -1)
+
+    def index(self, morpheme):
+        return int(self.lookup([morpheme])[0])
+
+    def class_ids(self, morpheme_class):
+        """
+        Returns the ids of the candidate morphemes of a class, in increasing order.
+        """
+        return np.flatnonzero(self.class_flags & CLASS_FLAGS[morpheme_class])
+
+    @staticmethod
+    def paths(prefix):
+        return (
+            f"{prefix}.morpheme_pool.npy",
+            f"{prefix}.morpheme_offsets.npy",
+            f"{prefix}.class_flags.npy",
+            f"{prefix}.counts.npy",
+        )
+
+    def save(self, prefix):
+        for path, values in zip(
+            MorphemeIndex.paths(prefix),
+            (self.pool, self.offsets, self.class_flags, self.counts),
+        ):
+            np.save(path, values)
+
+    @staticmethod
+    def load(prefix, mmap_mode="r"):
+        return MorphemeIndex(
+            *(
+                np.load(path, mmap_mode=mmap_mode)
+                for path in MorphemeIndex.paths(prefix)
+            )
+        )
+
+
+class MorphemeValues(MutableMapping):
+    """
+    Dictionary-like view of the values of one morpheme class, stored in an array
+    over all the ids of a MorphemeIndex. Only the candidates of the class are
+    keys of the view, unless morpheme_class is None. Values of other morphemes
+    are default, or a KeyError when default is None. New keys cannot be added.
+    """
+
+    def __init__(self, index, values, morpheme_class=None, default=None):
+        self.index = index
+        self.values = values
+        self.flag = 0 if morpheme_class is None else CLASS_FLAGS[morpheme_class]
+        self.ids = (
+            np.arange(len(index))
+            if morpheme_class is None
+            else index.class_ids(morpheme_class)
+        )
+        self.default = default
+
+    def _id(self, morpheme):
+        i = self.index.index(morpheme)
+        if i >= 0 and (self.flag == 0 or self.index.class_flags[i] & self.flag):
+            return i
+        return -1
+
+    def __getitem__(self, morpheme):
+        i = self._id(morpheme)
+        if i >= 0:
+            return float(self.values[i])
+        if self.default is None:
+            raise KeyError(morpheme)
+        return self.default
+
+    def __setitem__(self, morpheme, value):
+        i = self._id(morpheme)
+        if i < 0:
+            raise KeyError(morpheme)
+        self.values[i] = value
+
+    def __delitem__(self, morpheme):
+        raise TypeError("Morphemes cannot be removed from a MorphemeValues view")
+
+    def __contains__(self, morpheme):
+        return self._id(morpheme) >= 0
+
+    def __iter__(self):
+        return (self.index.morpheme(i) for i in self.ids)
+
+    def __len__(self):
+        return len(self.ids)
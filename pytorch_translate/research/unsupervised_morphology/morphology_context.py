@@ -1,8 +1,11 @@
 #!/usr/bin/env python3
 
 import math
+from array import array
 from collections import Counter
 
+import numpy as np
+
 
 class MorphologyContext:
     """
@@ -51,3 +54,98 @@ class MorphologyContext:
 
     def right_perplexity(self):
         return self.perplexity("right")
+
+
+class ContextCounts(object):
+    """
+    Array-based left or right context counts of all the morphemes of a
+    MorphemeIndex. Every (morpheme id, context) pair is kept once with its
+    total count; contexts are represented by their hash, so that no string is
+    stored per pair. Pairs are buffered and merged every max_buffer_size pairs.
+    """
+
+    def __init__(self, num_morphemes, max_buffer_size=1 << 22):
+        self.num_morphemes = num_morphemes
+        self.max_buffer_size = max_buffer_size
+        self.morpheme_ids = np.zeros(0, dtype=np.int64)
+        self.context_keys = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.buffers = (array("q"), array("q"), array("q"))
+
+    def add(self, morpheme_id, context, count):
+        morpheme_ids, context_keys, counts = self.buffers
+        morpheme_ids.append(morpheme_id)
+        context_keys.append(hash(context))
+        counts.append(count)
+        if len(counts) >= self.max_buffer_size:
+            self.merge()
+
+    def merge(self):
+        morpheme_ids, context_keys, counts = (
+            np.concatenate((merged, np.frombuffer(buffer, dtype=np.int64)))
+            for merged, buffer in zip(
+                (self.morpheme_ids, self.context_keys, self.counts), self.buffers
+            )
+        )
+        self.buffers = (array("q"), array("q"), array("q"))
+        order = np.lexsort((context_keys, morpheme_ids))
+        morpheme_ids, context_keys = morpheme_ids[order], context_keys[order]
+        starts = np.flatnonzero(
+            np.concatenate(
+                (
+                    [True],
+                    (morpheme_ids[1:] != morpheme_ids[:-1])
+                    | (context_keys[1:] != context_keys[:-1]),
+                )
+            )
+        )
+        self.morpheme_ids = morpheme_ids[starts]
+        self.context_keys = context_keys[starts]
+        self.counts = (
+            np.add.reduceat(counts[order], starts)
+            if len(starts) > 0
+            else np.zeros(0, dtype=np.int64)
+        )
+
+    def perplexities(self):
+        """
+        Same as MorphologyContext.perplexity for every morpheme id. Uses
+        entropy = log(total) - sum(c * log(c)) / total over the context counts c.
+        """
+        self.merge()
+        counts = self.counts.astype(np.float64)
+        totals = np.bincount(
+            self.morpheme_ids, weights=counts, minlength=self.num_morphemes
+        )
+        count_log_counts = np.bincount(
+            self.morpheme_ids,
+            weights=counts * np.log(counts),
+            minlength=self.num_morphemes,
+        )
+        entropies = np.zeros(self.num_morphemes)
+        seen = totals > 0
+        entropies[seen] = np.log(totals[seen]) - count_log_counts[seen] / totals[seen]
+        return np.exp(entropies)
+
+
+def context_perplexities(index, word_counts):
+    """
+    Returns the left and right perplexity of every morpheme in index, as arrays
+    over the morpheme ids. As in MorphologyContext, contexts are the substrings
+    of length at least 3 right before (left) or right after (right) every
+    occurrence of a morpheme in the vocabulary, weighted by word counts.
+    """
+    left_contexts = ContextCounts(len(index))
+    right_contexts = ContextCounts(len(index))
+    for word, word_count in word_counts.items():
+        n = len(word)
+        spans = [(i, j) for i in range(n) for j in range(i + 1, n + 1)]
+        morpheme_ids = index.lookup([word[i:j] for i, j in spans])
+        for (i, j), morpheme_id in zip(spans, morpheme_ids.tolist()):
+            if morpheme_id < 0:
+                continue
+            for k in range(0, i - 2):
+                left_contexts.add(morpheme_id, word[k:i], word_count)
+            for k in range(j + 3, n + 1):
+                right_contexts.add(morpheme_id, word[j:k], word_count)
+    return left_contexts.perplexities(), right_contexts.perplexities()
@@ -1,9 +1,14 @@
 #!/usr/bin/env python3
 
+import os
+from itertools import chain
+from multiprocessing import Pool
 from optparse import OptionParser
 
 from pytorch_translate.research.unsupervised_morphology import unsupervised_morphology
 
+SEGMENT_CACHE_HEADER = "#segment-cache"
+
 
 def get_arg_parser():
     parser = OptionParser()
@@ -55,6 +60,13 @@ def get_arg_parser():
         dest="add_affix_symbols",
         default=True,
     )
+    parser.add_option(
+        "--segment-cache",
+        dest="segment_cache",
+        help="Word segmentations cached across runs of the same model.",
+        metavar="FILE",
+        default=None,
+    )
     parser.add_option(
         "--save-checkpoint", action="store_true", dest="save_checkpoint", default=False
     )
@@ -124,6 +136,20 @@ def get_arg_parser():
         dest="length_slope",
         default=2,
     )
+    parser.add_option(
+        "--max-morph-length",
+        type="int",
+        help="Maximum length of a candidate morpheme (default: no limit).",
+        dest="max_morph_length",
+        default=None,
+    )
+    parser.add_option(
+        "--min-morph-count",
+        type="int",
+        help="Minimum frequency of a candidate morpheme in the training data.",
+        dest="min_morph_count",
+        default=1,
+    )
     parser.add_option(
         "--investigate",
         action="store_true",
@@ -134,6 +160,137 @@ def get_arg_parser():
     return parser
 
 
+def segment_cache_key(model_path, add_affix_symbols):
+    """
+    Cached segmentations are only valid for the model file they were computed
+    with (as of its last modification) and the same affix symbol option.
+    """
+    model_stat = os.stat(model_path)
+    return "\t".join(
+        [
+            SEGMENT_CACHE_HEADER,
+            os.path.abspath(model_path),
+            str(model_stat.st_mtime_ns),
+            str(model_stat.st_size),
+            str(add_affix_symbols),
+        ]
+    )
+
+
+def load_segment_cache(cache_path, cache_key):
+    """
+    Returns the word to segmentation map stored in cache_path, or an empty map
+    if there is no cache for cache_key.
+    """
+    segmentations = {}
+    if not os.path.exists(cache_path):
+        return segmentations
+    with open(cache_path, "r", encoding="utf-8") as cache_file:
+        if cache_file.readline().rstrip("\n") != cache_key:
+            return segmentations
+        for line in cache_file:
+            word, segmented = line.rstrip("\n").split("\t", 1)
+            segmentations[word] = segmented
+    return segmentations
+
+
+def save_segment_cache(cache_path, cache_key, segmentations):
+    # Written to a temporary file first, so that an interrupted run does not
+    # leave a truncated cache behind.
+    tmp_path = f"{cache_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as cache_file:
+        cache_file.write(cache_key + "\n")
+        for word, segmented in segmentations.items():
+            cache_file.write(f"{word}\t{segmented}\n")
+    os.replace(tmp_path, cache_path)
+
+
+# The segmentor of a segmentation worker process, set once by
+# _init_segment_worker when the pool starts.
+_segment_worker_state = None
+
+
+def _init_segment_worker(model_path, add_affix_symbols):
+    global _segment_worker_state
+    # The model arrays are memory-mapped, so workers share their pages.
+    model = unsupervised_morphology.MorphologyHMMParams.load(model_path)
+    _segment_worker_state = (
+        unsupervised_morphology.MorphologySegmentor(model),
+        add_affix_symbols,
+    )
+
+
+def _run_segment_worker(words):
+    segmentor, add_affix_symbols = _segment_worker_state
+    return segmentor.segment_words(words, add_affix_symbols=add_affix_symbols)
+
+
+def segment_types(model_path, words, add_affix_symbols, num_cpus, chunk_size=4096):
+    """
+    Segments a list of distinct words with num_cpus processes and returns a
+    word to segmentation map. Words are sorted by length before they are
+    chunked, so that the segmentor gets full batches of same-length words.
+    """
+    words = sorted(words, key=len)
+    chunks = [words[i : i + chunk_size] for i in range(0, len(words), chunk_size)]
+    if num_cpus > 1 and len(chunks) > 1:
+        with Pool(
+            min(num_cpus, len(chunks)),
+            initializer=_init_segment_worker,
+            initargs=(model_path, add_affix_symbols),
+        ) as pool:
+            segmented = pool.map(_run_segment_worker, chunks)
+    else:
+        _init_segment_worker(model_path, add_affix_symbols)
+        segmented = [_run_segment_worker(chunk) for chunk in chunks]
+    return dict(zip(words, chain.from_iterable(segmented)))
+
+
+def segment_file(
+    model_path,
+    input_file,
+    output_file,
+    add_affix_symbols=True,
+    num_cpus=10,
+    cache_path=None,
+    chunk_size=4096,
+):
+    """
+    Segments every token of input_file into output_file. The distinct words of
+    the input are collected first, and only the ones that are not in the cache
+    are segmented (once, in parallel). The corpus is then rewritten in a
+    streaming pass over the input. New segmentations are added to the cache.
+    Returns the number of distinct words and the number of newly segmented ones.
+    """
+    cache_key = segment_cache_key(model_path, add_affix_symbols)
+    segmentations = (
+        load_segment_cache(cache_path, cache_key) if cache_path is not None else {}
+    )
+
+    words = set()
+    with open(input_file, "r", encoding="utf-8") as input_stream:
+        for line in input_stream:
+            words.update(line.strip().split())
+    new_words = [word for word in words if word not in segmentations]
+    if len(new_words) > 0:
+        segmentations.update(
+            segment_types(
+                model_path, new_words, add_affix_symbols, num_cpus, chunk_size
+            )
+        )
+        if cache_path is not None:
+            save_segment_cache(cache_path, cache_key, segmentations)
+
+    with open(input_file, "r", encoding="utf-8") as input_stream, open(
+        output_file, "w", encoding="utf-8"
+    ) as writer:
+        for line in input_stream:
+            writer.write(
+                " ".join(segmentations[word] for word in line.strip().split()) + "\n"
+            )
+    return len(words), len(new_words)
+
+
 if __name__ == "__main__":
     arg_parser = get_arg_parser()
     options, args = arg_parser.parse_args()
@@ -150,6 +307,8 @@ if __name__ == "__main__":
             perplexity_slope=options.perplexity_slope,
             length_threshold=options.length_threshold,
             length_slope=options.length_slope,
+            max_morph_length=options.max_morph_length,
+            min_morph_count=options.min_morph_count,
         )
         print("Number of training words", len(model.params.word_counts))
         model.expectation_maximization(
@@ -165,22 +324,15 @@ if __name__ == "__main__":
         and options.output_file is not None
         and options.model_path is not None
     ):
-        model = unsupervised_morphology.MorphologyHMMParams.load(options.model_path)
-        segmentor = unsupervised_morphology.MorphologySegmentor(model)
-        segment_cache = {}
-        writer = open(options.output_file, "w", encoding="utf-8")
-        with open(options.input_file, "r", encoding="utf-8") as input_stream:
-            for line in input_stream:
-                output = []
-                for word in line.strip().split():
-                    if word not in segment_cache:
-                        segmented = segmentor.segment_word(
-                            word, add_affix_symbols=options.add_affix_symbols
-                        )
-                        segment_cache[word] = segmented
-                    output.append(segment_cache[word])
-                writer.write(" ".join(output) + "\n")
-        writer.close()
+        num_types, num_segmented = segment_file(
+            options.model_path,
+            options.input_file,
+            options.output_file,
+            add_affix_symbols=options.add_affix_symbols,
+            num_cpus=options.num_cpus,
+            cache_path=options.segment_cache,
+        )
+        print(f"Segmented {num_segmented} new words out of {num_types} distinct words")
 
     if options.investigate and options.model_path is not None:
         model = unsupervised_morphology.MorphologyHMMParams.load(options.model_path)
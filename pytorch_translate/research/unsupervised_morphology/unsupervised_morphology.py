@@ -5,14 +5,27 @@ import pickle
 import random
 from collections import Counter, defaultdict
 from itertools import chain, zip_longest
-from multiprocessing import Pool
+from multiprocessing import Pool, RawArray
 from typing import Dict
 
+import numpy as np
+from pytorch_translate.research.unsupervised_morphology.morpheme_index import (
+    CLASS_FLAGS,
+    MorphemeIndex,
+    MorphemeValues,
+)
 from pytorch_translate.research.unsupervised_morphology.morphology_context import (
-    MorphologyContext,
+    context_perplexities,
 )
 
 
+# Affix classes in the order used by the array views of the parameters.
+AFFIX_TAGS = ["START", "prefix", "stem", "suffix", "END"]
+MORPH_TAGS = ["prefix", "stem", "suffix"]
+AFFIX_TAG_IDS = {tag: i for i, tag in enumerate(AFFIX_TAGS)}
+MORPH_TAG_IDS = {tag: i for i, tag in enumerate(MORPH_TAGS)}
+
+
 class MorphologyHMMParams(object):
     def __init__(
         self,
@@ -22,6 +35,8 @@ class MorphologyHMMParams(object):
         perplexity_slope: float = 1,
         length_threshold: float = 3,
         length_slope: float = 2,
+        max_morph_length: int = None,
+        min_morph_count: int = 1,
     ):
         """
         This class contains HMM probabilities for the morphological model.
@@ -46,6 +61,10 @@ class MorphologyHMMParams(object):
             * length_threshold and length_slope: This comes from equation 17 of
             the above paper:
             > stem_like(m) = 1/(1+ exp(-length_slope*(length(m)-length_threshold)))
+            * max_morph_length and min_morph_count: Prune the candidate morphemes
+            to the substrings of at most max_morph_length characters that occur
+            at least min_morph_count times in the data. By default, every
+            substring is a candidate.
         """
         self.morph_emit_probs: Dict[str, dict] = {
             "prefix": {},
@@ -67,7 +86,15 @@ class MorphologyHMMParams(object):
         self.perplexity_slope = perplexity_slope
         self.length_threshold = length_threshold
         self.length_slope = length_slope
-
+        self.max_morph_length = max_morph_length
+        self.min_morph_count = min_morph_count
+
+        # These get values after calling init_uniform_params_from_data:
+        # morph_emit_probs and morph_likeness are then dictionary-like views of
+        # [len(MORPH_TAGS), len(morpheme_index)] arrays.
+        self.morpheme_index = None
+        self.morph_emit_array = None
+        self.morph_likeness_array = None
         # This gets values after calling init_uniform_params_from_data if
         # use_morph_likeness is True.
         self.morph_likeness = None
@@ -76,7 +103,6 @@ class MorphologyHMMParams(object):
         """
         We should obtain a list of all possible morphemes from a data file.
         """
-        self.morph_emit_probs = {"prefix": {}, "stem": {}, "suffix": {}}
         self.affix_trans_probs = {
             "prefix": {},
             "stem": {},
@@ -90,52 +116,22 @@ class MorphologyHMMParams(object):
                 for word in line.strip().split():
                     self.word_counts[word] += 1
 
-        context_dics: Dict[str, MorphologyContext] = {}
-        for word in self.word_counts:
-            word_count = self.word_counts[word]
-            if len(word) <= 2:
-                # If a word is very short, it is definitely an
-                # independent stem.
-                self.morph_emit_probs["stem"][word] = 1.0
-                if self.use_morph_likeness:
-                    # We don't allow context with length lower than 3.
-                    if word not in context_dics:
-                        context_dics[word] = MorphologyContext()
-
-            for i in range(0, len(word)):
-                for j in range(i, len(word)):
-                    substr = word[i : j + 1]
-                    if j < len(word) - 2:
-                        self.morph_emit_probs["prefix"][substr] = 1.0
-                    if j - i >= 1:
-                        self.morph_emit_probs["stem"][substr] = 1.0
-                    if i >= 2:
-                        self.morph_emit_probs["suffix"][substr] = 1.0
-
-                    if self.use_morph_likeness:
-                        if substr not in context_dics:
-                            context_dics[substr] = MorphologyContext()
-
-                        # Updating left and right context vectors.
-                        for k in range(0, i - 2):
-                            # Get context values of length at least 3.
-                            left_context_str = word[k:i]
-                            context_dics[substr].add_to_left_context(
-                                left_context_str, word_count
-                            )
-                        for k in range(j + 4, len(word) + 1):
-                            # Get context values of length at least 3.
-                            right_context_str = word[j + 1 : k]
-                            context_dics[substr].add_to_right_context(
-                                right_context_str, word_count
-                            )
+        self.morpheme_index = MorphemeIndex.build(
+            self.word_counts,
+            max_morph_length=self.max_morph_length,
+            min_morph_count=self.min_morph_count,
+        )
+        self.set_morpheme_arrays(
+            self.morpheme_index,
+            np.zeros((len(MORPH_TAGS), len(self.morpheme_index))),
+        )
 
         # Normalizing the initial probabilities uniformly.
-        for affix in self.morph_emit_probs.keys():
-            num_morphs = len(self.morph_emit_probs[affix])
-            for morph in self.morph_emit_probs[affix].keys():
-                self.morph_emit_probs[affix][morph] = (1.0 + self.smoothing_const) / (
-                    num_morphs * (1 + self.smoothing_const)
+        for i, tag in enumerate(MORPH_TAGS):
+            ids = self.morph_emit_probs[tag].ids
+            if len(ids) > 0:
+                self.morph_emit_array[i, ids] = (1.0 + self.smoothing_const) / (
+                    len(ids) * (1 + self.smoothing_const)
                 )
 
         # Initializing the transition probabilities. Here we force some trivial
@@ -167,33 +163,32 @@ class MorphologyHMMParams(object):
         self.affix_trans_probs["END"]["END"] = 0
 
         if self.use_morph_likeness:
-            self.build_morph_likeness_values(context_dics)
+            self.build_morph_likeness_values()
 
-        # Deleting this to free memory just in case GC does not work efficiently.
-        del context_dics
-
-    def build_morph_likeness_values(self, context_dics):
-        self.morph_likeness = {
-            "prefix": defaultdict(float),
-            "stem": defaultdict(float),
-            "suffix": defaultdict(float),
-        }
-        for substr in context_dics.keys():
-            left_perplexity = context_dics[substr].left_perplexity()
-            right_perplexity = context_dics[substr].right_perplexity()
+    def build_morph_likeness_values(self):
+        left_perplexity, right_perplexity = context_perplexities(
+            self.morpheme_index, self.word_counts
+        )
+        morph_lengths = np.array(
+            [
+                len(self.morpheme_index.morpheme(i))
+                for i in range(len(self.morpheme_index))
+            ]
+        )
 
+        with np.errstate(over="ignore"):
             # Following https://users.ics.aalto.fi/krista/papers/Creutz07.pdf
             # As in eq. 16.
             prefix_like = 1.0 / (
                 1
-                + math.exp(
+                + np.exp(
                     -self.perplexity_slope
                     * (right_perplexity - self.perplexity_threshold)
                 )
             )
             suffix_like = 1.0 / (
                 1
-                + math.exp(
+                + np.exp(
                     -self.perplexity_slope
                     * (left_perplexity - self.perplexity_threshold)
                 )
@@ -201,15 +196,43 @@ class MorphologyHMMParams(object):
 
             # As in eq. 17.
             stem_like = 1.0 / (
-                1 + math.exp(-self.length_slope * (len(substr) - self.length_threshold))
+                1 + np.exp(-self.length_slope * (morph_lengths - self.length_threshold))
             )
 
-            # Similar to eq. 19, but we ignore non-morpheme type and normalization
-            # exponent q.
-            denom = prefix_like + stem_like + suffix_like
-            self.morph_likeness["stem"][substr] = stem_like / denom
-            self.morph_likeness["prefix"][substr] = prefix_like / denom
-            self.morph_likeness["suffix"][substr] = suffix_like / denom
+        # Similar to eq. 19, but we ignore non-morpheme type and normalization
+        # exponent q.
+        denom = prefix_like + stem_like + suffix_like
+        self.set_morpheme_arrays(
+            self.morpheme_index,
+            self.morph_emit_array,
+            np.stack([prefix_like / denom, stem_like / denom, suffix_like / denom]),
+        )
+
+    def set_morpheme_arrays(
+        self, morpheme_index, morph_emit_array, morph_likeness_array=None
+    ):
+        """
+        Sets the [len(MORPH_TAGS), len(morpheme_index)] emission and likeness
+        arrays, and morph_emit_probs and morph_likeness as their views by
+        morpheme.
+        """
+        self.morpheme_index = morpheme_index
+        self.morph_emit_array = morph_emit_array
+        self.morph_emit_probs = {
+            tag: MorphemeValues(morpheme_index, morph_emit_array[i], tag)
+            for i, tag in enumerate(MORPH_TAGS)
+        }
+        self.morph_likeness_array = morph_likeness_array
+        self.morph_likeness = (
+            None
+            if morph_likeness_array is None
+            else {
+                tag: MorphemeValues(
+                    morpheme_index, morph_likeness_array[i], default=0.0
+                )
+                for i, tag in enumerate(MORPH_TAGS)
+            }
+        )
 
     def zero_out_parmas(self):
         """
@@ -219,9 +242,7 @@ class MorphologyHMMParams(object):
             for morpheme_class2 in self.affix_trans_probs[morpheme_class1].keys():
                 self.affix_trans_probs[morpheme_class1][morpheme_class2] = 0.0
 
-        for morpheme_class in self.morph_emit_probs.keys():
-            for morpheme in self.morph_emit_probs[morpheme_class].keys():
-                self.morph_emit_probs[morpheme_class][morpheme] = 0.0
+        self.morph_emit_array[:] = 0.0
 
     def sample_segmentation(self, word, affix_len_mean, affix_len_std_dev):
         """
@@ -353,12 +374,11 @@ class MorphologyHMMParams(object):
                     prev_tag
                 ]
 
-        for tag in self.morph_emit_probs.keys():
-            num_morphs = len(self.morph_emit_probs[tag])
-            for word in self.morph_emit_probs[tag].keys():
-                self.morph_emit_probs[tag][word] = (
-                    self.morph_emit_probs[tag][word] + self.smoothing_const
-                ) / (self.morph_emit_denoms[tag] + num_morphs * self.smoothing_const)
+        for i, tag in enumerate(MORPH_TAGS):
+            ids = self.morph_emit_probs[tag].ids
+            self.morph_emit_array[i, ids] = (
+                self.morph_emit_array[i, ids] + self.smoothing_const
+            ) / (self.morph_emit_denoms[tag] + len(ids) * self.smoothing_const)
 
     def transition_log_prob(self, prev_tag, current_tag):
         """
@@ -403,45 +423,319 @@ class MorphologyHMMParams(object):
             return self.SMALL_CONST
         return math.log(self.emission_prob(morpheme_type, morpheme))
 
+    def transition_probs_array(self):
+        """
+        Returns the transition probabilities as an array over AFFIX_TAGS.
+        """
+        return np.array(
+            [[self.affix_trans_probs[m1][m2] for m2 in AFFIX_TAGS] for m1 in AFFIX_TAGS]
+        )
+
+    def word_emission_probs(self, word, cache=None):
+        """
+        Returns a [len(MORPH_TAGS), n + 1, n + 1] array with the emission
+        probability of each substring word[start:end] for every morpheme class.
+        Empty spans (end <= start) have zero probability.
+        Args:
+            cache: optional dictionary from substrings to their emission
+                probabilities, shared between words segmented with the same
+                parameter values.
+        """
+        n = len(word)
+        probs = np.zeros((len(MORPH_TAGS), n + 1, n + 1))
+        if self.morpheme_index is not None:
+            if cache is None:
+                cache = {}
+            starts, ends = np.triu_indices(n + 1, k=1)
+            substrs = [word[start:end] for start, end in zip(starts, ends)]
+            missing = list({substr for substr in substrs if substr not in cache})
+            if missing:
+                missing_probs = self.morpheme_emission_probs(
+                    self.morpheme_index.lookup(missing)
+                )
+                cache.update(zip(missing, missing_probs.T))
+            probs[:, starts, ends] = np.stack([cache[substr] for substr in substrs], 1)
+            return probs
+        for start in range(n):
+            for end in range(start + 1, n + 1):
+                substr = word[start:end]
+                if cache is not None and substr in cache:
+                    probs[:, start, end] = cache[substr]
+                    continue
+                substr_probs = [self.emission_prob(tag, substr) for tag in MORPH_TAGS]
+                probs[:, start, end] = substr_probs
+                if cache is not None:
+                    cache[substr] = substr_probs
+        return probs
+
+    def morpheme_emission_probs(self, ids):
+        """
+        Same as emission_prob for every morpheme class and every id of
+        morpheme_index in ids, where -1 stands for a morpheme not in the index.
+        Returns a [len(MORPH_TAGS), len(ids)] array.
+        """
+        found = ids >= 0
+        ids = ids[found]
+        class_flags = self.morpheme_index.class_flags[ids]
+        if self.morph_likeness is None:
+            likeness = np.ones((len(MORPH_TAGS), len(found)))
+        else:
+            likeness = np.zeros((len(MORPH_TAGS), len(found)))
+            likeness[:, found] = self.morph_likeness_array[:, ids]
+
+        probs = np.zeros((len(MORPH_TAGS), len(found)))
+        for i, tag in enumerate(MORPH_TAGS):
+            num_morphs = len(self.morph_emit_probs[tag])
+            if num_morphs > 0:
+                probs[i] = (
+                    likeness[i]
+                    * self.smoothing_const
+                    / (num_morphs * (1 + self.smoothing_const))
+                )
+            in_class = (class_flags & CLASS_FLAGS[tag]) > 0
+            seen = found.copy()
+            seen[found] = in_class
+            probs[i, seen] = likeness[i, seen] * self.morph_emit_array[i, ids[in_class]]
+        return probs
+
+    def to_log_probs(self, probs):
+        """
+        Same as transition_log_prob and emission_log_probs for arrays: zero
+        probabilities get a log-probability of SMALL_CONST.
+        """
+        log_probs = np.full(probs.shape, float(self.SMALL_CONST))
+        np.log(probs, out=log_probs, where=probs > 0)
+        return log_probs
+
     @staticmethod
-    def load(file_path):
+    def load(file_path, mmap_mode="r"):
+        """
+        Loads parameters written by save. The morpheme index and the emission
+        and likeness arrays are memory-mapped with mmap_mode (read-only by
+        default). Models saved with dictionaries of morphemes are still loaded
+        as such.
+        """
         with open(file_path, "rb") as f:
-            e, t, s, c, morph_likeness = pickle.load(f)
-        m = MorphologyHMMParams(s)
-        m.morph_emit_probs = e
-        m.affix_trans_probs = t
-        m.word_counts = c
-        m.morph_likeness = morph_likeness
+            saved = pickle.load(f)
+        if isinstance(saved, tuple):
+            e, t, s, c, morph_likeness = saved
+            m = MorphologyHMMParams(s)
+            m.morph_emit_probs = e
+            m.affix_trans_probs = t
+            m.word_counts = c
+            m.morph_likeness = morph_likeness
+            return m
+
+        m = MorphologyHMMParams(saved["smoothing_const"])
+        m.affix_trans_probs = saved["affix_trans_probs"]
+        m.word_counts = saved["word_counts"]
+        emission_path, likeness_path = MorphologyHMMParams.array_paths(file_path)
+        m.set_morpheme_arrays(
+            MorphemeIndex.load(file_path, mmap_mode=mmap_mode),
+            np.load(emission_path, mmap_mode=mmap_mode),
+            (
+                np.load(likeness_path, mmap_mode=mmap_mode)
+                if saved["use_morph_likeness"]
+                else None
+            ),
+        )
         return m
 
+    @staticmethod
+    def array_paths(file_path):
+        return f"{file_path}.emission.npy", f"{file_path}.likeness.npy"
+
     def save(self, file_path):
-        e, t, s, c, morph_likeness = (
-            self.morph_emit_probs,
-            self.affix_trans_probs,
-            self.smoothing_const,
-            self.word_counts,
-            self.morph_likeness,
-        )
+        """
+        Pickles the transition probabilities and word counts to file_path, and
+        saves the morpheme index and the emission and likeness arrays next to
+        it as .npy files, so that load can memory-map them.
+        """
+        emission_path, likeness_path = MorphologyHMMParams.array_paths(file_path)
+        self.morpheme_index.save(file_path)
+        np.save(emission_path, self.morph_emit_array)
+        if self.morph_likeness is not None:
+            np.save(likeness_path, self.morph_likeness_array)
         with open(file_path, "wb") as f:
-            pickle.dump((e, t, s, c, morph_likeness), f)
+            pickle.dump(
+                {
+                    "affix_trans_probs": self.affix_trans_probs,
+                    "smoothing_const": self.smoothing_const,
+                    "word_counts": self.word_counts,
+                    "use_morph_likeness": self.morph_likeness is not None,
+                },
+                f,
+            )
+
+
+# Indices of the affix classes that can precede (START and the morpheme
+# classes) and that can emit (the morpheme classes) a morpheme.
+PREV_TAG_IDS = np.array([AFFIX_TAG_IDS[tag] for tag in ["START"] + MORPH_TAGS])
+CUR_TAG_IDS = np.array([AFFIX_TAG_IDS[tag] for tag in MORPH_TAGS])
+# Transitions that the forward-backward algorithm assigns an expectation to.
+SOFT_EM_TRANSITIONS = np.zeros((len(AFFIX_TAGS), len(AFFIX_TAGS)), dtype=bool)
+SOFT_EM_TRANSITIONS[PREV_TAG_IDS[:, None], CUR_TAG_IDS] = True
+SOFT_EM_TRANSITIONS[CUR_TAG_IDS, AFFIX_TAG_IDS["END"]] = True
+
+
+def segment_viterbi_batch(emission_log_probs, transition_log_probs, small_const):
+    """
+    Batched segment-Viterbi for words of the same length n (see
+    MorphologySegmentor.segment_viterbi). The loops over the start and end of
+    a morpheme are replaced by array operations over the previous and current
+    tags of every start index at once.
+    Args:
+        emission_log_probs: [bsz, len(MORPH_TAGS), n + 1, n + 1] emission log
+            probabilities of each word[start:end].
+        transition_log_probs: [len(AFFIX_TAGS), len(AFFIX_TAGS)] array.
+        small_const: log-probability of impossible events.
+    Returns:
+        A list with the (labels, indices) segmentation of every word.
+    """
+    bsz, _, n, _ = emission_log_probs.shape
+    n -= 1
+    num_prev_tags = len(PREV_TAG_IDS)
+    pi = np.empty((bsz, n + 1, len(AFFIX_TAGS)))
+    pi[:, 0] = small_const
+    pi[:, 0, AFFIX_TAG_IDS["START"]] = 0
+    for i in range(1, n + 1):
+        pi[:, i] = (i + 1) * small_const
+    back_starts = np.full((bsz, n + 1, len(AFFIX_TAGS)), -1)
+    back_tags = np.full((bsz, n + 1, len(AFFIX_TAGS)), -1)
+    t = transition_log_probs[np.ix_(PREV_TAG_IDS, CUR_TAG_IDS)]
+
+    for end in range(1, n + 1):
+        # [bsz, start, prev_tag, cur_tag]
+        log_probs = (pi[:, :end, PREV_TAG_IDS, None] + t) + emission_log_probs[
+            :, :, :end, end
+        ].transpose(0, 2, 1)[:, :, None, :]
+        log_probs = log_probs.reshape(bsz, end * num_prev_tags, len(CUR_TAG_IDS))
+        # argmax returns the first (start, prev_tag) pair with the best score,
+        # as the strict comparison of the sequential algorithm does.
+        best = log_probs.argmax(axis=1)
+        best_log_probs = np.take_along_axis(log_probs, best[:, None], axis=1)[:, 0]
+        improved = best_log_probs > pi[:, end, CUR_TAG_IDS]
+        pi[:, end, CUR_TAG_IDS] = np.where(
+            improved, best_log_probs, pi[:, end, CUR_TAG_IDS]
+        )
+        back_starts[:, end, CUR_TAG_IDS] = np.where(improved, best // num_prev_tags, -1)
+        back_tags[:, end, CUR_TAG_IDS] = np.where(
+            improved, PREV_TAG_IDS[best % num_prev_tags], -1
+        )
+
+    final_log_probs = (
+        pi[:, n, CUR_TAG_IDS] + transition_log_probs[CUR_TAG_IDS, AFFIX_TAG_IDS["END"]]
+    )
+    segmentations = []
+    for b in range(bsz):
+        # finalizing the best segmentation.
+        best_score = n * small_const
+        last_tag = None
+        for tag, log_prob in zip(CUR_TAG_IDS, final_log_probs[b]):
+            if log_prob > best_score:
+                best_score, last_tag = log_prob, tag
+        if last_tag is None:
+            # No segmentation beats the threshold: keep the word as one stem.
+            segmentations.append((["stem"], [0, n]))
+            continue
+
+        indices = [n]  # backtracking indices for segmentation.
+        labels = [last_tag]  # backtracking labels for segmentation.
+        while True:
+            last_index, last_label = indices[-1], labels[-1]
+            start_index = back_starts[b, last_index, last_label]
+            indices.append(int(start_index))
+            if start_index == 0:
+                break
+            labels.append(back_tags[b, last_index, last_label])
+
+        # We should now reverse the backtracked list.
+        indices.reverse()
+        labels.reverse()
+        segmentations.append(([AFFIX_TAGS[tag] for tag in labels], indices))
+    return segmentations
+
+
+def forward_backward_batch(emission_probs, transition_probs):
+    """
+    Batched forward-backward algorithm for words of the same length n (see
+    UnsupervisedMorphology.forward_backward). The sums over previous and next
+    tags and over morpheme boundaries are done with array operations.
+    Args:
+        emission_probs: [bsz, len(MORPH_TAGS), n + 1, n + 1] emission
+            probabilities of each word[start:end], zero for empty spans.
+        transition_probs: [len(AFFIX_TAGS), len(AFFIX_TAGS)] array.
+    Returns:
+        emission_expectations: [bsz, len(MORPH_TAGS), n + 1, n + 1] expected
+            count of each (morpheme class, span) pair.
+        transition_expectations: [bsz, len(AFFIX_TAGS), len(AFFIX_TAGS)] array.
+    """
+    bsz, _, n, _ = emission_probs.shape
+    n -= 1
+    end_tag = AFFIX_TAG_IDS["END"]
+    t = transition_probs[np.ix_(PREV_TAG_IDS, CUR_TAG_IDS)]
+
+    # The forward pass is very similar to the Viterbi algorithm. The main
+    # difference is that here we use summation instead of argmax.
+    forward_values = np.zeros((bsz, n + 1, len(AFFIX_TAGS)))
+    forward_values[:, 0, AFFIX_TAG_IDS["START"]] = 1.0
+    for end in range(1, n + 1):
+        forward_values[:, end, CUR_TAG_IDS] = np.einsum(
+            "bsp,pc,bcs->bc",
+            forward_values[:, :end, PREV_TAG_IDS],
+            t,
+            emission_probs[:, :, :end, end],
+        )
+
+    # The backward pass of the valid morpheme classes starts from their
+    # transition to the END state.
+    backward_values = np.zeros((bsz, n + 1, len(MORPH_TAGS)))
+    backward_values[:, n] = transition_probs[CUR_TAG_IDS, end_tag]
+    next_t = transition_probs[np.ix_(CUR_TAG_IDS, CUR_TAG_IDS)]
+    for start in range(n - 1, -1, -1):
+        backward_values[:, start] = np.einsum(
+            "ben,cn,bne->bc",
+            backward_values[:, start + 1 :],
+            next_t,
+            emission_probs[:, :, start, start + 1 :],
+        )
+
+    transition_expectations = np.zeros((bsz, len(AFFIX_TAGS), len(AFFIX_TAGS)))
+    end_probs = (
+        forward_values[:, n, CUR_TAG_IDS] * transition_probs[CUR_TAG_IDS, end_tag]
+    )
+    denominator = end_probs.sum(axis=1)
+    transition_expectations[:, CUR_TAG_IDS, end_tag] = end_probs / denominator[:, None]
+
+    # [bsz, start, cur_tag]: sum over previous tags of forward * transition.
+    forward_transitions = np.einsum(
+        "bsp,pc->bsc", forward_values[:, :, PREV_TAG_IDS], t
+    )
+    # [bsz, cur_tag, start, end]: emission * backward of every span.
+    emission_backward = (
+        emission_probs * backward_values.transpose(0, 2, 1)[:, :, None, :]
+    )
+    emission_expectations = (
+        forward_transitions.transpose(0, 2, 1)[:, :, :, None]
+        * emission_backward
+        / denominator[:, None, None, None]
+    )
+    transition_expectations[:, PREV_TAG_IDS[:, None], CUR_TAG_IDS] = (
+        t
+        * np.einsum(
+            "bsp,bcs->bpc",
+            forward_values[:, :, PREV_TAG_IDS],
+            emission_backward.sum(axis=3),
+        )
+        / denominator[:, None, None]
+    )
+    return emission_expectations, transition_expectations
 
 
 class MorphologySegmentor(object):
     def __init__(self, morphology_hmm_params):
         self.params = morphology_hmm_params
 
-    def initialize_prob_values(self, n):
-        pi = [{} for _ in range(n + 1)]
-        pi[0]["START"] = 0
-        pi[0]["prefix"] = self.params.SMALL_CONST
-        pi[0]["stem"] = self.params.SMALL_CONST
-        pi[0]["suffix"] = self.params.SMALL_CONST
-        pi[0]["END"] = self.params.SMALL_CONST
-        for i in range(1, n + 1):
-            for affix in self.params.affix_trans_probs.keys():
-                pi[i][affix] = (i + 1) * self.params.SMALL_CONST
-        return pi
-
     def segment_viterbi(self, word):
         """
         This is a dynamic programming algorithm for segmenting a word by using a
@@ -456,61 +750,44 @@ class MorphologySegmentor(object):
         A pseudo-code for the vanilla Viterbi algorithm:
         http://www.cs.columbia.edu/~mcollins/hmms-spring2013.pdf#page=18
         """
-        n = len(word)
-        pi = self.initialize_prob_values(n)
-        back_pointer = [{} for _ in range(n + 1)]
-
-        for start in range(n):  # loop over starting indices of morphemes.
-            for end in range(start + 1, n + 1):  # loop over end indices of morphemes.
-                for cur_tag in ["prefix", "stem", "suffix"]:  # loop over possible tags.
-                    for prev_tag in ["START", "prefix", "stem", "suffix"]:
-                        # loop over possible previous tags
-                        t = self.params.transition_log_prob(prev_tag, cur_tag)
-                        e = self.params.emission_log_probs(cur_tag, word[start:end])
-                        log_prob = pi[start][prev_tag] + t + e
-                        if log_prob > pi[end][cur_tag]:
-                            pi[end][cur_tag] = log_prob
-                            # Saving backpointer for previous tag and index.
-                            back_pointer[end][cur_tag] = prev_tag, start
+        return self.segment_viterbi_words([word])[0]
 
-        # finalizing the best segmentation.
-        best_score = n * self.params.SMALL_CONST
-        best_bp = None
-        indices = [n]  # backtracking indices for segmentation.
-        labels = []  # backtracking labels for segmentation.
-        for last_tag in {"prefix", "stem", "suffix"}:
-            t = self.params.transition_log_prob(last_tag, "END")
-            log_prob = pi[n][last_tag] + t
-            if log_prob > best_score:
-                best_score = log_prob
-                best_bp = (
-                    back_pointer[n][last_tag][1],
-                    last_tag,
-                    back_pointer[n][last_tag][0],
+    def segment_viterbi_words(self, words, batch_size=256):
+        """
+        Runs segment_viterbi on a list of words. Words of the same length are
+        segmented together, and emission probabilities are looked up once per
+        distinct substring.
+        """
+        emission_cache = {}
+        transition_log_probs = self.params.to_log_probs(
+            self.params.transition_probs_array()
+        )
+        words_by_length = defaultdict(list)
+        for i, word in enumerate(words):
+            words_by_length[len(word)].append(i)
+
+        segmentations = [None] * len(words)
+        for word_ids in words_by_length.values():
+            for i in range(0, len(word_ids), batch_size):
+                batch = word_ids[i : i + batch_size]
+                emission_log_probs = self.params.to_log_probs(
+                    np.stack(
+                        [
+                            self.params.word_emission_probs(words[j], emission_cache)
+                            for j in batch
+                        ]
+                    )
                 )
-
-        indices.append(best_bp[0])
-        labels.append(best_bp[1])
-        if best_bp[0] > 0:
-            # In cases where the last index is zero, we don't want to backtrack
-            # anymore.
-            labels.append(best_bp[2])
-
-        while True:
-            last_index = indices[-1]
-            last_label = labels[-1]
-            if last_index == 0:
-                break
-            prev_tag, start_index = back_pointer[last_index][last_label]
-            indices.append(start_index)
-            if start_index == 0:
-                break
-            labels.append(prev_tag)
-
-        # We should now reverse the backtracked list.
-        indices.reverse()
-        labels.reverse()
-        return labels, indices
+                for j, segmentation in zip(
+                    batch,
+                    segment_viterbi_batch(
+                        emission_log_probs,
+                        transition_log_probs,
+                        self.params.SMALL_CONST,
+                    ),
+                ):
+                    segmentations[j] = segmentation
+        return segmentations
 
     def segment_word(self, word, add_affix_symbols=False):
         """
@@ -522,6 +799,22 @@ class MorphologySegmentor(object):
             Example: pretokenize --> pre+ token +ize
         """
         labels, indices = self.segment_viterbi(word)
+        return self.format_segmentation(word, labels, indices, add_affix_symbols)
+
+    def segment_words(self, words, add_affix_symbols=False):
+        """
+        Same as segment_word for a list of words, which are segmented in
+        batches with segment_viterbi_words.
+        """
+        return [
+            self.format_segmentation(word, labels, indices, add_affix_symbols)
+            for word, (labels, indices) in zip(
+                words, self.segment_viterbi_words(words)
+            )
+        ]
+
+    @staticmethod
+    def format_segmentation(word, labels, indices, add_affix_symbols=False):
         outputs = []
         for i in range(len(labels)):
             substr = word[indices[i] : indices[i + 1]]
@@ -550,6 +843,8 @@ class UnsupervisedMorphology(object):
         perplexity_slope: float = 1,
         length_threshold: float = 3,
         length_slope: float = 2,
+        max_morph_length: int = None,
+        min_morph_count: int = 1,
     ):
         """
         Args:
@@ -565,6 +860,8 @@ class UnsupervisedMorphology(object):
             perplexity_slope: Used by MorphologyHMMParams constructor.
             length_threshold: Used by MorphologyHMMParams constructor.
             length_slope: Used by MorphologyHMMParams constructor.
+            max_morph_length: Used by MorphologyHMMParams constructor.
+            min_morph_count: Used by MorphologyHMMParams constructor.
         """
         self.params = MorphologyHMMParams(
             smoothing_const=smoothing_const,
@@ -573,6 +870,8 @@ class UnsupervisedMorphology(object):
             perplexity_slope=perplexity_slope,
             length_threshold=length_threshold,
             length_slope=length_slope,
+            max_morph_length=max_morph_length,
+            min_morph_count=min_morph_count,
         )
         self.use_hardEM = use_hardEM
 
@@ -585,75 +884,6 @@ class UnsupervisedMorphology(object):
 
         self.segmentor = MorphologySegmentor(self.params) if self.use_hardEM else None
 
-    @staticmethod
-    def init_forward_values(n):
-        forward_values = [{} for _ in range(n + 1)]
-        forward_values[0]["START"] = 1.0
-        forward_values[0]["prefix"] = 0
-        forward_values[0]["stem"] = 0
-        forward_values[0]["suffix"] = 0
-        forward_values[0]["END"] = 0
-        for i in range(1, len(forward_values)):
-            for cur_tag in ["START", "prefix", "stem", "suffix", "END"]:
-                forward_values[i][cur_tag] = 0
-        return forward_values
-
-    @staticmethod
-    def init_backward_values(n):
-        backward_values = [{} for _ in range(n + 1)]
-
-        backward_values[n]["END"] = 1.0
-
-        for i in range(0, len(backward_values)):
-            for cur_tag in ["START", "prefix", "stem", "suffix", "END"]:
-                backward_values[i][cur_tag] = 0
-        return backward_values
-
-    def forward(self, word):
-        """
-        For the forward pass in the forward-backward algorithm.
-        The forward pass is very similar to the Viterbi algorithm. The main difference
-        is that here we use summation instead of argmax.
-        """
-        n = len(word)
-        forward_values = UnsupervisedMorphology.init_forward_values(n)
-        for start in range(n):
-            for end in range(start + 1, n + 1):
-                for cur_tag in ["prefix", "stem", "suffix"]:
-                    for prev_tag in ["START", "prefix", "stem", "suffix"]:
-                        t = self.params.affix_trans_probs[prev_tag][cur_tag]
-                        e = self.params.emission_prob(cur_tag, word[start:end])
-                        forward_values[end][cur_tag] += (
-                            forward_values[start][prev_tag] * t * e
-                        )
-        return forward_values
-
-    def backward(self, word):
-        """
-        For the backward pass in the forward-backward algorithm.
-        """
-        n = len(word)
-        backward_values = UnsupervisedMorphology.init_backward_values(n)
-
-        # Here we initialize the backward pass of the valid morpheme classes equal
-        # to their transition to the END state.
-        for cur_tag in ["prefix", "stem", "suffix"]:
-            t = self.params.affix_trans_probs[cur_tag]["END"]
-            backward_values[n][cur_tag] = t
-
-        # Here we do regular summation over all possible paths leading to a specific
-        # morpheme class.
-        for start in range(n - 1, -1, -1):
-            for end in range(start + 1, n + 1):
-                for cur_tag in ["prefix", "stem", "suffix"]:
-                    for next_tag in ["prefix", "stem", "suffix"]:
-                        t = self.params.affix_trans_probs[cur_tag][next_tag]
-                        e = self.params.emission_prob(next_tag, word[start:end])
-                        backward_values[start][cur_tag] += (
-                            backward_values[end][next_tag] * t * e
-                        )
-        return backward_values
-
     def forward_backward(self, word):
         """
         The forward-backward algorithm is a dynamic programming algorithm that
@@ -670,43 +900,21 @@ class UnsupervisedMorphology(object):
         http://www.cs.columbia.edu/~mcollins/courses/6998-2012/lectures/lec6.3.pdf
         """
         n = len(word)
-        forward_values = self.forward(word)
-        backward_values = self.backward(word)
+        e, t = forward_backward_batch(
+            self.params.word_emission_probs(word)[None],
+            self.params.transition_probs_array(),
+        )
 
         emission_expectations = defaultdict(float)
         transition_expectations = defaultdict(float)
-
-        for prev_tag in ["prefix", "stem", "suffix"]:
-            transition_expectations[(prev_tag, "END")] += (
-                forward_values[n][prev_tag]
-                * self.params.affix_trans_probs[prev_tag]["END"]
-            )
-        denominator = sum(
-            transition_expectations[(prev_tag, "END")]
-            for prev_tag in ["prefix", "stem", "suffix"]
-        )
-        for prev_tag in ["prefix", "stem", "suffix"]:
-            transition_expectations[(prev_tag, "END")] /= denominator
-
         for start in range(n):
             for end in range(start + 1, n + 1):
-                substr = word[start:end]
-                for prev_tag in ["START", "prefix", "stem", "suffix"]:
-                    for cur_tag in ["prefix", "stem", "suffix"]:
-                        t = self.params.affix_trans_probs[prev_tag][cur_tag]
-                        e = self.params.emission_prob(cur_tag, substr)
-                        emission_expectations[(cur_tag, substr)] += (
-                            forward_values[start][prev_tag]
-                            * t
-                            * e
-                            * backward_values[end][cur_tag]
-                        ) / denominator
-                        transition_expectations[(prev_tag, cur_tag)] += (
-                            forward_values[start][prev_tag]
-                            * t
-                            * e
-                            * backward_values[end][cur_tag]
-                        ) / denominator
+                for i, cur_tag in enumerate(MORPH_TAGS):
+                    emission_expectations[(cur_tag, word[start:end])] += e[
+                        0, i, start, end
+                    ]
+        for i, j in zip(*np.nonzero(SOFT_EM_TRANSITIONS)):
+            transition_expectations[(AFFIX_TAGS[i], AFFIX_TAGS[j])] = t[0, i, j]
 
         return emission_expectations, transition_expectations
 
@@ -737,72 +945,183 @@ class UnsupervisedMorphology(object):
 
         return emission_expectations, transition_expectations
 
-    def expectation_substep(self, words):
+    def build_morpheme_vocab(self):
         """
-        This method is subprocess for the expectation method.
+        The morphemes the expectation step can assign a count to are the ids of
+        the morpheme index of the parameters, plus one id (unknown_morph_id)
+        shared by the substrings that were pruned from the index. Parameters and
+        expectations are exchanged with the expectation workers as arrays
+        indexed by these ids.
         """
-        emission_expectations = defaultdict(float)
-        transition_expectations = defaultdict(float)
-        for wf in words:
-            if wf is None:
-                continue
-            (word, freq) = wf
-
-            if self.use_hardEM:
-                e, t = self.get_expectations_from_viterbi(word)
-            else:
-                e, t = self.forward_backward(word)
+        morpheme_index = self.params.morpheme_index
+        self.unknown_morph_id = len(morpheme_index)
+        self.num_morphs = len(morpheme_index) + 1
+        # Ids of the morphemes of each class, in the order of morph_emit_probs.
+        self.emission_ids = {
+            morpheme_class: self.params.morph_emit_probs[morpheme_class].ids
+            for morpheme_class in MORPH_TAGS
+        }
+        # Morph likeness values do not change during training.
+        self.morph_likeness_table = np.ones((len(MORPH_TAGS), self.num_morphs))
+        if self.params.morph_likeness is not None:
+            self.morph_likeness_table[:, : len(morpheme_index)] = (
+                self.params.morph_likeness_array
+            )
+            self.morph_likeness_table[:, self.unknown_morph_id] = 0.0
 
-            for e_key in e.keys():
-                emission_expectations[e_key] += e[e_key] * freq
-            for t_key in t.keys():
-                transition_expectations[t_key] += t[t_key] * freq
-            del e
-            del t
+    def build_train_batches(self, train_words, batch_size=256):
+        """
+        Groups the training words by length and precomputes the morpheme id of
+        each of their substrings, so that the expectation step only works on
+        arrays. Returns a list of ([bsz, n + 1, n + 1] substring ids, [bsz] word
+        frequencies) pairs, where empty spans have the id -1.
+        """
+        words_by_length = defaultdict(list)
+        for word, freq in train_words:
+            words_by_length[len(word)].append((word, freq))
+
+        batches = []
+        for n, words in sorted(words_by_length.items()):
+            for i in range(0, len(words), batch_size):
+                batch = words[i : i + batch_size]
+                substring_ids = np.full((len(batch), n + 1, n + 1), -1, dtype=np.int32)
+                starts, ends = np.triu_indices(n + 1, k=1)
+                for b, (word, _) in enumerate(batch):
+                    ids = self.params.morpheme_index.lookup(
+                        [word[start:end] for start, end in zip(starts, ends)]
+                    )
+                    ids[ids < 0] = self.unknown_morph_id
+                    substring_ids[b, starts, ends] = ids
+                freqs = np.array([freq for _, freq in batch], dtype=np.float64)
+                batches.append((substring_ids, freqs))
+        return batches
+
+    def attach_shared_params(self, emission_buffer, transition_buffer):
+        self.shared_emission = np.frombuffer(emission_buffer).reshape(
+            len(MORPH_TAGS), -1
+        )
+        self.shared_transition = np.frombuffer(transition_buffer).reshape(
+            len(AFFIX_TAGS), len(AFFIX_TAGS)
+        )
 
-        return emission_expectations, transition_expectations
+    def write_shared_params(self):
+        """
+        Broadcasts the current parameters to the expectation workers.
+        """
+        self.shared_emission[:, : self.unknown_morph_id] = self.params.morph_emit_array
+        self.shared_transition[:] = self.params.transition_probs_array()
 
-    def expectation(self, pool, train_words_chunks):
+    def emission_probs_table(self):
+        """
+        Returns the [len(MORPH_TAGS), num_morphs] emission probabilities of all
+        interned morphemes under the broadcast parameters, with the same
+        smoothing and likeness values as MorphologyHMMParams.emission_prob.
+        """
+        smoothing_const = self.params.smoothing_const
+        table = np.zeros_like(self.morph_likeness_table)
+        for i, morpheme_class in enumerate(MORPH_TAGS):
+            ids = self.emission_ids[morpheme_class]
+            if len(ids) > 0:
+                table[i] = smoothing_const / (len(ids) * (1 + smoothing_const))
+            table[i, ids] = self.shared_emission[i, ids]
+        return self.morph_likeness_table * table
+
+    def expectation_substep(self, batches):
         """
-        This method runs the expectation step with a chunked list of training words.
+        This method is subprocess for the expectation method. It returns the
+        emission expectations as flat (morpheme class, morpheme id) indices and
+        values, the transition expectations as an array, and a mask of the
+        transitions that were visited.
         Args:
-            pool: Pool object for multi-threading.
-            train_words_chunks: a list of word+frequency-lists
-                                (chunked for multi-threading).
+            batches: training batches from build_train_batches.
         """
-        expectations = pool.map(self.expectation_substep, train_words_chunks)
+        num_morphs = self.num_morphs
+        emission_probs = self.emission_probs_table()
+        transition_probs = self.shared_transition
+        emission_log_probs = self.params.to_log_probs(emission_probs)
+        transition_log_probs = self.params.to_log_probs(transition_probs)
+        class_offsets = np.arange(len(MORPH_TAGS))[:, None, None] * num_morphs
+
+        emission_indices, emission_values = [], []
+        transition_expectations = np.zeros((len(AFFIX_TAGS), len(AFFIX_TAGS)))
+        for substring_ids, freqs in batches:
+            if self.use_hardEM:
+                segmentations = segment_viterbi_batch(
+                    emission_log_probs[:, substring_ids].transpose(1, 0, 2, 3),
+                    transition_log_probs,
+                    self.params.SMALL_CONST,
+                )
+                for b, (labels, indices) in enumerate(segmentations):
+                    tags = [AFFIX_TAG_IDS[tag] for tag in ["START"] + labels + ["END"]]
+                    np.add.at(transition_expectations, (tags[:-1], tags[1:]), freqs[b])
+                    emission_indices.append(
+                        [
+                            MORPH_TAG_IDS[label] * num_morphs
+                            + substring_ids[b, start, end]
+                            for label, start, end in zip(
+                                labels, indices[:-1], indices[1:]
+                            )
+                        ]
+                    )
+                    emission_values.append(np.full(len(labels), freqs[b]))
+            else:
+                valid = (substring_ids >= 0)[:, None]
+                e, t = forward_backward_batch(
+                    emission_probs[:, substring_ids].transpose(1, 0, 2, 3) * valid,
+                    transition_probs,
+                )
+                valid = np.broadcast_to(valid, e.shape)
+                emission_indices.append((class_offsets + substring_ids[:, None])[valid])
+                emission_values.append((e * freqs[:, None, None, None])[valid])
+                transition_expectations += np.einsum("b,bij->ij", freqs, t)
 
-        emission_expectations = {"prefix": {}, "stem": {}, "suffix": {}}
-        transition_expectations = {
-            "prefix": {},
-            "stem": {},
-            "suffix": {},
-            "START": {},
-            "END": {},
-        }
+        emission_indices, inverse = np.unique(
+            np.concatenate(emission_indices).astype(np.int64), return_inverse=True
+        )
+        emission_values = np.bincount(
+            inverse.reshape(-1), weights=np.concatenate(emission_values)
+        )
+        if self.use_hardEM:
+            transition_seen = transition_expectations > 0
+        else:
+            transition_seen = SOFT_EM_TRANSITIONS.copy()
+        return (
+            emission_indices,
+            emission_values,
+            transition_expectations,
+            transition_seen,
+        )
 
-        for e_key in set(chain(*[list(e[0].keys()) for e in expectations])):
-            emission_expectations[e_key[0]][e_key[1]] = sum(
-                e[0][e_key] for e in expectations
-            )
-        for t_key in set(chain(*[list(t[1].keys()) for t in expectations])):
-            transition_expectations[t_key[0]][t_key[1]] = sum(
-                t[1][t_key] for t in expectations
-            )
+    def expectation(self, pool, train_batches_chunks):
+        """
+        This method runs the expectation step on the persistent worker pool
+        created by expectation_maximization.
+        Args:
+            pool: Pool object for multi-processing.
+            train_batches_chunks: a list of lists of indices into train_batches
+                (chunked for multi-processing).
+        """
+        self.write_shared_params()
+
+        num_morphs = self.num_morphs
+        emission_expectations = np.zeros(len(MORPH_TAGS) * num_morphs)
+        transition_expectations = np.zeros((len(AFFIX_TAGS), len(AFFIX_TAGS)))
+        transition_seen = np.zeros((len(AFFIX_TAGS), len(AFFIX_TAGS)), dtype=bool)
+        for e_ids, e_values, t, t_seen in pool.imap(
+            _run_expectation_worker, train_batches_chunks
+        ):
+            # Ids are unique within a chunk, so fancy indexing accumulates them.
+            emission_expectations[e_ids] += e_values
+            transition_expectations += t
+            transition_seen |= t_seen
+        emission_expectations = emission_expectations.reshape(len(MORPH_TAGS), -1)
 
-        emission_denoms = {
-            e: sum(v for v in emission_expectations[e].values())
-            for e in emission_expectations.keys()
-        }
-        transition_denoms = {
-            t: sum(v for v in transition_expectations[t].values())
-            for t in transition_expectations.keys()
-        }
         return (
             emission_expectations,
-            emission_denoms,
+            emission_expectations.sum(axis=1),
             transition_expectations,
-            transition_denoms,
+            transition_expectations.sum(axis=1),
+            transition_seen,
         )
 
     def maximization(
@@ -811,45 +1130,45 @@ class UnsupervisedMorphology(object):
         emission_denoms,
         transition_expectations,
         transition_denoms,
+        transition_seen,
     ):
         """
         Runs the maximization algorithm.
         Args:
-            emission_expectations: the expected counts for each affix-morpheme pair.
+            emission_expectations: the expected counts for each affix-morpheme pair,
+                                   as a [morpheme class, morpheme id] array.
             emission_denoms: the sum-expected count of each morpheme class.
             transition_expectations: the expected counts for each affix-affix pair
-                                     for transition.
+                                     for transition, as an array over AFFIX_TAGS.
             transition_denoms: the sum-expected count of each morpheme class as
                                conditional in transition.
+            transition_seen: mask of the affix-affix pairs that were visited in
+                             the expectation step.
         """
         smoothing_const = self.params.smoothing_const
-        for morpheme_class in self.params.morph_emit_probs.keys():
-            num_morphs = len(self.params.morph_emit_probs[morpheme_class])
-            d = emission_denoms[morpheme_class]
-            for morpheme in self.params.morph_emit_probs[morpheme_class].keys():
-                e = 0
-                if morpheme in emission_expectations[morpheme_class]:
-                    e = emission_expectations[morpheme_class][morpheme]
-                if d > 0 or smoothing_const > 0:
-                    self.params.morph_emit_probs[morpheme_class][morpheme] = (
-                        e + smoothing_const
-                    ) / ((num_morphs * smoothing_const) + d)
-                else:  # for cases of underflowing
-                    self.params.morph_emit_probs[morpheme_class][morpheme] = (
-                        1.0 / num_morphs
-                    )
+        for i, morpheme_class in enumerate(MORPH_TAGS):
+            ids = self.emission_ids[morpheme_class]
+            num_morphs = len(ids)
+            if num_morphs == 0:
+                continue
+            d = emission_denoms[i]
+            e = emission_expectations[i, ids]
+            if d > 0 or smoothing_const > 0:
+                probs = (e + smoothing_const) / ((num_morphs * smoothing_const) + d)
+            else:  # for cases of underflowing
+                probs = np.full(num_morphs, 1.0 / num_morphs)
+            self.params.morph_emit_array[i, ids] = probs
 
         for m1 in self.params.affix_trans_probs.keys():
             if m1 == "END":
                 continue  # "END" has zero probs for all.
+            i = AFFIX_TAG_IDS[m1]
             for m2 in self.params.affix_trans_probs[m1].keys():
-                if m2 in transition_expectations[m1]:
-                    if transition_denoms[m1] > 0:
-                        t = 0
-                        if m2 in transition_expectations[m1]:
-                            t = transition_expectations[m1][m2]
-                        self.params.affix_trans_probs[m1][m2] = (
-                            t / transition_denoms[m1]
+                j = AFFIX_TAG_IDS[m2]
+                if transition_seen[i, j]:
+                    if transition_denoms[i] > 0:
+                        self.params.affix_trans_probs[m1][m2] = float(
+                            transition_expectations[i, j] / transition_denoms[i]
                         )
                     else:  # for cases of underflow.
                         self.params.affix_trans_probs[m1][m2] = 1.0 / len(
@@ -865,25 +1184,60 @@ class UnsupervisedMorphology(object):
             num_iters: Number of EM epochs.
             num_cpus: Number of cpus for parallel executation of the E step.
         """
-        pool = Pool(num_cpus)
         train_words = [
             (word, self.params.word_counts[word])
             for word in self.params.word_counts.keys()
         ]
-        chunk_size = math.ceil(float(len(train_words)) / num_cpus)
-        train_words_chunks = UnsupervisedMorphology.group_to(chunk_size, train_words)
-        for epoch in range(num_iters):
-            print("starting epoch %i" % epoch)
-            self.em_step(pool, train_words_chunks, model_path)
+        self.build_morpheme_vocab()
+        self.train_batches = self.build_train_batches(train_words)
+        # Batches are sorted by word length, so they are dealt round-robin to
+        # the chunks to balance the work.
+        num_chunks = min(num_cpus, len(self.train_batches))
+        train_batches_chunks = [
+            range(i, len(self.train_batches), num_chunks) for i in range(num_chunks)
+        ]
 
-    def em_step(self, pool, train_words_chunks, model_path):
+        # The workers are started once with the model and the training batches.
+        # After that, each EM step only broadcasts the parameter values through
+        # shared memory and gathers the expectations as arrays.
+        emission_buffer = RawArray("d", len(MORPH_TAGS) * self.num_morphs)
+        transition_buffer = RawArray("d", len(AFFIX_TAGS) * len(AFFIX_TAGS))
+        self.attach_shared_params(emission_buffer, transition_buffer)
+        with Pool(
+            num_cpus,
+            initializer=_init_expectation_worker,
+            initargs=(self, emission_buffer, transition_buffer),
+        ) as pool:
+            for epoch in range(num_iters):
+                print("starting epoch %i" % epoch)
+                self.em_step(pool, train_batches_chunks, model_path)
+        self.shared_emission = self.shared_transition = None
+        self.train_batches = None
+
+    def em_step(self, pool, train_batches_chunks, model_path):
         """
         One EM step of the EM algorithm.
         """
         print("starting expectation step")
-        ee, ed, te, td = self.expectation(pool, train_words_chunks)
+        ee, ed, te, td, ts = self.expectation(pool, train_batches_chunks)
         print("starting maximization step")
-        self.maximization(ee, ed, te, td)
+        self.maximization(ee, ed, te, td, ts)
         print("updated parameters after maximization")
         if model_path is not None:
-            self.save(model_path)
+            self.params.save(model_path)
+
+
+# The model of an expectation worker process, set once by
+# _init_expectation_worker when the pool starts.
+_expectation_worker_model = None
+
+
+def _init_expectation_worker(model, emission_buffer, transition_buffer):
+    global _expectation_worker_model
+    model.attach_shared_params(emission_buffer, transition_buffer)
+    _expectation_worker_model = model
+
+
+def _run_expectation_worker(batch_indices):
+    model = _expectation_worker_model
+    return model.expectation_substep([model.train_batches[i] for i in batch_indices])
@@ -4,8 +4,10 @@ import copy
 import math
 
 import torch
-from fairseq import bleu, utils
+import torch.nn.functional as F
+from fairseq import utils
 from fairseq.criterions import FairseqCriterion, register_criterion
+from fairseq.data import data_utils
 from pytorch_translate import generate
 
 
@@ -14,13 +16,99 @@ from pytorch_translate import generate
 """
 
 
+def sentence_bleu(hypos, refs, pad, eos, unk, order=4):
+    """Sentence-level BLEU of every hypothesis against its reference, computed
+    for the whole batch at once on the tensors' device.
+
+    Gives the same scores as resetting a fairseq bleu.Scorer, adding the pair
+    and calling score() for every row: leading padding and trailing EOS and
+    padding are trimmed, unk in the reference never matches, and n-gram
+    matches are clipped by the reference counts.
+
+    N-grams are counted without a per-sentence map. Each n-gram gets an id by
+    combining the id of its (n-1)-gram prefix with its last token and
+    compacting the result with `unique`. Matches come from `bincount` over
+    (sentence, n-gram id) keys of the hypotheses and references.
+
+    Args:
+        hypos: [N, hypo_len] int tensor of hypotheses
+        refs: [N, ref_len] int tensor with the reference of every hypothesis
+
+    Returns:
+        A [N] float tensor of BLEU scores in [0, 100].
+    """
+    num_sentences = hypos.size(0)
+    refs = refs.long().masked_fill(refs == unk, -1)
+    max_len = max(hypos.size(1), refs.size(1))
+    tokens = torch.cat(
+        [
+            F.pad(hypos.long(), (0, max_len - hypos.size(1)), value=pad),
+            F.pad(refs, (0, max_len - refs.size(1)), value=pad),
+        ]
+    )
+    positions = torch.arange(max_len, device=tokens.device).expand_as(tokens)
+    # Sentences are trimmed on the left up to the first token which isn't
+    # padding, and on the right down to the last one which isn't EOS or
+    # padding (but never to less than one token)
+    starts = positions.masked_fill(tokens == pad, max_len).min(dim=1)[0]
+    ends = positions.masked_fill((tokens == pad) | (tokens == eos), -1).max(dim=1)[0]
+    ends = torch.max(ends + 1, (starts + 1).clamp(max=max_len))
+    lengths = ends - starts
+    hypo_lengths = lengths[:num_sentences].float()
+    ref_lengths = lengths[num_sentences:].float()
+    sentence_idx = torch.arange(2 * num_sentences, device=tokens.device)
+    sentence_idx = sentence_idx % num_sentences
+
+    # n-gram ids, compacted to [0, number of distinct n-grams)
+    token_ids = tokens + 1  # unk in references is -1
+    ngram_ids = token_ids
+    vocab_size = int(token_ids.max()) + 1
+    log_precisions = []
+    for n in range(1, order + 1):
+        if n > 1:
+            if max_len < n:
+                log_precisions.append(
+                    hypo_lengths.new_full(hypo_lengths.size(), -math.inf)
+                )
+                continue
+            ngram_ids = ngram_ids[:, :-1] * vocab_size + token_ids[:, n - 1 :]
+            _, ngram_ids = torch.unique(ngram_ids, return_inverse=True)
+        num_ngram_ids = int(ngram_ids.max()) + 1
+        ngram_starts = positions[:, : ngram_ids.size(1)]
+        valid = (ngram_starts >= starts.unsqueeze(1)) & (
+            ngram_starts + n <= ends.unsqueeze(1)
+        )
+        keys = sentence_idx.unsqueeze(1) * num_ngram_ids + ngram_ids
+        hypo_keys = keys[:num_sentences][valid[:num_sentences]]
+        ref_keys = keys[num_sentences:][valid[num_sentences:]]
+        unique_keys, inverse = torch.unique(
+            torch.cat([hypo_keys, ref_keys]), return_inverse=True
+        )
+        hypo_counts = torch.bincount(
+            inverse[: hypo_keys.numel()], minlength=unique_keys.numel()
+        )
+        ref_counts = torch.bincount(
+            inverse[hypo_keys.numel() :], minlength=unique_keys.numel()
+        )
+        matches = hypo_lengths.new_zeros(num_sentences).index_add_(
+            0,
+            unique_keys // num_ngram_ids,
+            torch.min(hypo_counts, ref_counts).float(),
+        )
+        counts = (hypo_lengths - n + 1).clamp(min=0)
+        log_precisions.append(torch.log(matches / counts.clamp(min=1)))
+    brevity = torch.exp(1 - ref_lengths / hypo_lengths.clamp(min=1)).clamp(max=1)
+    return brevity * torch.exp(torch.stack(log_precisions).mean(dim=0)) * 100
+
+
 class BaseSequenceLossCriterion(FairseqCriterion):
     """Base class for criteria with need to run beam search."""
 
     def __init__(self, args, src_dict, dst_dict):
         super().__init__(args, src_dict, dst_dict)
         self.translator = None
-        self.scorer = bleu.Scorer(dst_dict.pad(), dst_dict.eos(), dst_dict.unk())
+        self.eos = dst_dict.eos()
+        self.unk = dst_dict.unk()
 
     def get_translator(self, model):
         """Get lazy singleton translator instance."""
@@ -31,65 +119,92 @@ class BaseSequenceLossCriterion(FairseqCriterion):
             self.translator = generate.build_sequence_generator(args_clone, [model])
         return self.translator
 
-    def generate_translations(self, model, sample):
+    def encode(self, model, sample):
+        """Run the encoder once over the batch. The output is reused by
+        generate_translations() and compute_nll(), so beam search sees the same
+        encoding (with dropout, in training mode) that the loss is computed
+        on."""
+        return model.encoder(
+            sample["net_input"]["src_tokens"], sample["net_input"]["src_lengths"]
+        )
+
+    def generate_translations(self, model, sample, encoder_out=None):
         """Run beam search to generate translations from the current model.
 
         Args:
             model: FairseqModel to use (passed via FairseqCriterion.forward())
             sample: Training batch (passed via FairseqCriterion.forward())
+            encoder_out: optional output of encode() for the sample, so that
+                beam search doesn't run the encoder again
 
         Returns:
             A tuple (tokens, bleu) of tensors. `tokens` is a [bsz, beam_size,
             max_translation_length] int tensor with generated translations (with
-            EOS). `bleu` is a [bsz, beam_size] float tensor with BLEU scores.
+            EOS), sorted by decreasing BLEU. `bleu` is a [bsz, beam_size] float
+            tensor with BLEU scores. Both are on the device of the sample.
             `tokens` corresponds to U(x) in Edunov et al., 2017.
         """
+        # encoder_out was computed in training mode (with dropout), so beam
+        # search decodes from that encoding even though the model is in eval
         model.eval()  # Set to eval mode
         enc_input = (
             sample["net_input"]["src_tokens"],
             sample["net_input"]["src_lengths"],
         )
-        trg_lens = sample["target"].size(1) - torch.sum(
-            sample["target"] <= self.scorer.eos, dim=1
-        )
-        max_trans_len = 0
-        all_translations = []
-        for batch_idx, batch_trans in enumerate(
-            self._batch_translations(model, enc_input)
-        ):
-            ref = sample["target"][batch_idx, : trg_lens[batch_idx] + 1].int().cpu()
-            batch_translations = []
-            for trans in batch_trans:
-                max_trans_len = max(max_trans_len, trans["tokens"].size(0))
-                self.scorer.reset()
-                self.scorer.add(ref, trans["tokens"].int().cpu())
-                batch_translations.append((self.scorer.score(), trans["tokens"]))
-            batch_translations.sort(key=lambda x: -x[0])
-            all_translations.append(batch_translations)
-        bsz = len(all_translations)
         beam_size = self.get_translator(model).beam_size
-        tokens_tensor = trans["tokens"].new_full(
-            (bsz, beam_size, max_trans_len), self.scorer.pad
+        tokens = data_utils.collate_tokens(
+            [
+                trans["tokens"]
+                for trans in self._batch_translations(model, enc_input, encoder_out)
+            ],
+            pad_idx=self.padding_idx,
+            eos_idx=self.eos,
+            left_pad=False,
         )
-        bleu_tensor = torch.zeros(bsz, beam_size)
-        for batch_idx, batch_translations in enumerate(all_translations):
-            for trans_idx, (bleu_score, tokens) in enumerate(batch_translations):
-                tokens_tensor[batch_idx, trans_idx, : tokens.size(0)] = tokens
-                bleu_tensor[batch_idx, trans_idx] = bleu_score
+        bsz = tokens.size(0) // beam_size
+        bleu_scores = sentence_bleu(
+            tokens,
+            sample["target"].repeat_interleave(beam_size, dim=0),
+            pad=self.padding_idx,
+            eos=self.eos,
+            unk=self.unk,
+        ).view(bsz, beam_size)
+        # Ties are broken arbitrarily
+        bleu_scores, order = bleu_scores.sort(dim=1, descending=True)
+        tokens = tokens.view(bsz, beam_size, -1)
+        tokens = tokens.gather(1, order.unsqueeze(2).expand_as(tokens))
         model.train()  # Set back to train mode
-        return tokens_tensor, bleu_tensor
+        return tokens, bleu_scores
 
-    def _batch_translations(self, model, enc_input):
-        """Use beam_size times smaller batch size for translation."""
+    def _batch_translations(self, model, enc_input, encoder_out=None):
+        """Use beam_size times smaller batch size for translation. Yields the
+        beam_size hypotheses of every sentence, in order."""
         translator = self.get_translator(model)
         bsz = enc_input[1].size(0)
-        gen_bsz = bsz // translator.beam_size + 1
+        gen_bsz = max(bsz // translator.beam_size, 1)
         for f in range(0, bsz, gen_bsz):
             t = min(f + gen_bsz, bsz)
-            for trans in translator.generate((enc_input[0][f:t], enc_input[1][f:t])):
-                yield trans
+            encoder_input = {
+                "src_tokens": enc_input[0][f:t],
+                "src_lengths": enc_input[1][f:t],
+            }
+            encoder_outs = None
+            if encoder_out is not None:
+                # beam search needs no gradients through the shared encoding
+                with torch.no_grad():
+                    encoder_outs = [
+                        model.encoder.reorder_encoder_out(
+                            encoder_out,
+                            torch.arange(f, t, device=enc_input[1].device),
+                        )
+                    ]
+            for sentence_hypos in translator.generate(
+                encoder_input, encoder_outs=encoder_outs
+            ):
+                assert len(sentence_hypos) == translator.beam_size
+                yield from sentence_hypos
 
-    def compute_nll(self, model, sample, translations):
+    def compute_nll(self, model, sample, translations, encoder_out=None):
         """Compute negative log-likelihoods for the translations.
 
         This function computes p(u|x) for each element in U(x) (see Edunov et
@@ -100,25 +215,26 @@ class BaseSequenceLossCriterion(FairseqCriterion):
             sample: Training batch (passed via FairseqCriterion.forward())
             translations: A [batch_size, beam_size, max_trg_len] int tensor of
                 generated translation (as produced by generate_translations())
+            encoder_out: optional output of encode() for the sample. The
+                encoder is run only once either way; its output is expanded
+                to the beam_size translations of every sentence with
+                reorder_encoder_out().
 
         Returns:
             A [bsz, beam_size] float tensor containing the negative loglikelihoods
             of the sentences in `translations`.
         """
+        if encoder_out is None:
+            encoder_out = self.encode(model, sample)
         bsz, beam_size, max_trans_len = translations.size()
         total = bsz * beam_size
         translations = translations.view(total, max_trans_len)
         prev_output_tokens = translations.new(total, max_trans_len)
-        prev_output_tokens[:, 0] = self.scorer.eos
+        prev_output_tokens[:, 0] = self.eos
         prev_output_tokens[:, 1:] = translations[:, :-1]
-        src_tokens = (
-            sample["net_input"]["src_tokens"]
-            .unsqueeze(1)
-            .repeat(1, beam_size, 1)
-            .view(total, -1)
-        )
-        src_lengths = (
-            sample["net_input"]["src_lengths"]
+        # sentence of each translation
+        new_order = (
+            torch.arange(bsz, device=translations.device)
             .unsqueeze(1)
             .repeat(1, beam_size)
             .view(total)
@@ -126,10 +242,9 @@ class BaseSequenceLossCriterion(FairseqCriterion):
         all_losses = []
         for f in range(0, total, bsz):
             t = min(f + bsz, total)
-            net_output = model(
-                src_tokens=src_tokens[f:t],
-                src_lengths=src_lengths[f:t],
-                prev_output_tokens=prev_output_tokens[f:t],
+            net_output = model.decoder(
+                prev_output_tokens[f:t],
+                model.encoder.reorder_encoder_out(encoder_out, new_order[f:t]),
             )
             lprobs = model.get_normalized_probs(net_output, log_probs=True)
             nll_loss = -lprobs.gather(dim=-1, index=translations[f:t].unsqueeze(2))
@@ -165,8 +280,11 @@ class SequenceNegativeLoglikelihoodCriterion(BaseSequenceLossCriterion):
         2) the sample size, which is used as the denominator for the gradient
         3) logging outputs to display while training
         """
-        translations, bleu_scores = self.generate_translations(model, sample)
-        nll_loss = self.compute_nll(model, sample, translations)
+        encoder_out = self.encode(model, sample)
+        translations, bleu_scores = self.generate_translations(
+            model, sample, encoder_out
+        )
+        nll_loss = self.compute_nll(model, sample, translations, encoder_out)
         loss = nll_loss[:, 0] + torch.logsumexp(-nll_loss, 1)
         if reduce:
             loss = loss.sum()
@@ -194,11 +312,14 @@ class SequenceRiskCriterion(BaseSequenceLossCriterion):
         2) the sample size, which is used as the denominator for the gradient
         3) logging outputs to display while training
         """
-        translations, bleu_scores = self.generate_translations(model, sample)
-        nll_loss = self.compute_nll(model, sample, translations)
+        encoder_out = self.encode(model, sample)
+        translations, bleu_scores = self.generate_translations(
+            model, sample, encoder_out
+        )
+        nll_loss = self.compute_nll(model, sample, translations, encoder_out)
         partition = torch.logsumexp(-nll_loss, 1)
         probs = torch.exp(-nll_loss - partition.unsqueeze(1))
-        loss = torch.sum((1 - bleu_scores.cuda() / 100) * probs, dim=1)
+        loss = torch.sum((1 - bleu_scores / 100) * probs, dim=1)
         if reduce:
             loss = loss.sum()
         sample_size = (
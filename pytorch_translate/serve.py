@@ -0,0 +1,625 @@
+#!/usr/bin/env python3
+
+"""
+Lightweight local serving for CPU inference.
+
+The ensemble is loaded once in the parent process. Worker processes are forked
+afterwards, so they share the weights read-only through copy-on-write pages.
+Newline-delimited source sentences are read from stdin, or from connections to
+a Unix domain socket. A dispatcher thread in the parent forms dynamic batches
+of up to --max-batch-size sentences, waiting at most --max-wait-ms after the
+first sentence of a batch, or with --scheduler deadline groups them by source
+length and starts them in time for --deadline-ms (see batch_scheduler.py).
+Batches are formed when a worker is idle and handed to it. Translations are
+written back one per line, in request order. A latency and throughput summary
+is printed to stderr on exit.
+
+    python pytorch_translate/serve.py --path model.pt --beam 4 \
+        --serve-workers 4 --threads-per-worker 2 --max-batch-size 16 \
+        --max-wait-ms 10 < source.txt > translations.txt
+"""
+
+import math
+import multiprocessing
+import os
+import queue
+import socket
+import sys
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional
+
+import numpy as np
+import torch
+from fairseq import data, options, tokenizer
+from pytorch_translate import hybrid_transformer_rnn  # noqa
+from pytorch_translate import rnn  # noqa
+from pytorch_translate import transformer  # noqa
+from pytorch_translate import (
+    batch_scheduler,
+    char_source_hybrid,
+    char_source_model,
+    char_source_transformer_model,
+    generate as pytorch_translate_generate,
+    options as pytorch_translate_options,
+    utils as pytorch_translate_utils,
+)
+
+
+class Request(NamedTuple):
+    client_id: int
+    request_id: int
+    text: str
+    arrival_time: float
+
+
+class Response(NamedTuple):
+    client_id: int
+    request_id: int
+    text: str
+    arrival_time: float
+    # time spent waiting for a worker and for the batch to fill up
+    queue_ms: float
+    # time spent translating the batch the request was part of
+    compute_ms: float
+    batch_size: int
+
+
+def get_parser_with_args():
+    parser = options.get_parser("Serving", default_task="pytorch_translate")
+    pytorch_translate_options.add_verbosity_args(parser)
+    generation_group = options.add_generation_args(parser)
+    pytorch_translate_options.expand_generation_args(generation_group)
+    add_serving_args(parser)
+    return parser
+
+
+def add_serving_args(parser):
+    group = parser.add_argument_group("Serving")
+    group.add_argument(
+        "--socket-path",
+        default="",
+        metavar="FILE",
+        help="Unix domain socket to accept newline-delimited requests on. "
+        "Each connection gets its translations back in order, one per line. "
+        "If empty, requests are read from stdin and written to stdout.",
+    )
+    group.add_argument(
+        "--serve-workers",
+        default=1,
+        type=int,
+        metavar="N",
+        help="Number of forked worker processes sharing the loaded ensemble.",
+    )
+    group.add_argument(
+        "--threads-per-worker",
+        default=1,
+        type=int,
+        metavar="N",
+        help="torch.set_num_threads() value for each worker.",
+    )
+    group.add_argument(
+        "--pin-workers",
+        action="store_true",
+        help="Pin each worker to its own set of --threads-per-worker CPUs.",
+    )
+    batch_scheduler.add_scheduler_args(parser)
+    return group
+
+
+class BatchTranslator:
+    """
+    Numberizes raw source sentences, decodes them as one batch with
+    SequenceGenerator.generate and returns the best hypothesis of each as a
+    string, in input order.
+    """
+
+    def __init__(self, args, task, models, append_eos_to_source, reverse_source):
+        self.args = args
+        self.task = task
+        self.append_eos_to_source = append_eos_to_source
+        self.reverse_source = reverse_source
+        self.translator = pytorch_translate_generate.build_sequence_generator(
+            args, task, models
+        )
+
+    def numberize(self, line):
+        src_dict = self.task.source_dictionary
+        inds = [src_dict.index(w) for w in tokenizer.tokenize_line(line)]
+        if self.reverse_source:
+            inds.reverse()
+        if self.append_eos_to_source:
+            inds.append(src_dict.eos())
+        return torch.LongTensor(inds)
+
+    def maxlen(self, srclen):
+        return int(self.args.max_len_a * srclen + self.args.max_len_b)
+
+    def translate_tokens(self, tokens: List[torch.Tensor]) -> List[str]:
+        translations = [""] * len(tokens)
+        # Encoders expect the batch sorted by decreasing source length
+        order = sorted(
+            (i for i, t in enumerate(tokens) if t.numel() > 0),
+            key=lambda i: tokens[i].numel(),
+            reverse=True,
+        )
+        if len(order) == 0:
+            return translations
+        src_dict = self.task.source_dictionary
+        src_tokens = data.data_utils.collate_tokens(
+            [tokens[i] for i in order], src_dict.pad(), src_dict.eos(), left_pad=False
+        )
+        src_lengths = torch.LongTensor([tokens[i].numel() for i in order])
+        hypos = self.translator.generate(
+            {"src_tokens": src_tokens, "src_lengths": src_lengths},
+            maxlen=self.maxlen(src_tokens.size(1)),
+        )
+        for i, sentence_hypos in zip(order, hypos):
+            translations[i] = self.task.target_dictionary.string(
+                sentence_hypos[0]["tokens"].int().cpu(), self.args.remove_bpe
+            )
+        return translations
+
+    def translate(self, lines: List[str]) -> List[str]:
+        return self.translate_tokens([self.numberize(line) for line in lines])
+
+
+class MicroBatcher:
+    """
+    Forms dynamic batches from a queue of Requests: blocks until a request is
+    available, then adds requests until max_batch_size is reached or
+    max_wait_ms have passed since the first one was taken. A None on the queue
+    closes the batcher after the current batch.
+    """
+
+    def __init__(self, request_queue, max_batch_size=8, max_wait_ms=10.0):
+        self.request_queue = request_queue
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.closed = False
+
+    def next_batch(self) -> Optional[List[Request]]:
+        if self.closed:
+            return None
+        first = self.request_queue.get()
+        if first is None:
+            self.closed = True
+            return None
+        batch = [first]
+        deadline = time.time() + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_size:
+            try:
+                timeout = deadline - time.time()
+                if timeout > 0:
+                    request = self.request_queue.get(timeout=timeout)
+                else:
+                    request = self.request_queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                self.closed = True
+                break
+            batch.append(request)
+        return batch
+
+    def observe(self, batch, compute_ms):
+        pass
+
+
+class SchedulingBatcher:
+    """
+    Same interface as MicroBatcher, but leaves the decision of which requests
+    to batch, and when, to a batch_scheduler scheduler. Requests are pulled off
+    the queue as they arrive and given a deadline of deadline_ms after their
+    arrival.
+    """
+
+    def __init__(self, request_queue, scheduler, length_fn, deadline_ms):
+        self.request_queue = request_queue
+        self.scheduler = scheduler
+        self.length_fn = length_fn
+        self.deadline_ms = deadline_ms
+        self.closed = False
+        # scheduled batches, by the (client_id, request_id) of their first
+        # request, until their compute time is observed
+        self.scheduled_batches = {}
+
+    def add(self, request: Request):
+        self.scheduler.add(
+            batch_scheduler.ScheduledRequest(
+                request_id=request.request_id,
+                src_length=self.length_fn(request.text),
+                arrival_time=request.arrival_time,
+                deadline=request.arrival_time + self.deadline_ms / 1000,
+                payload=request,
+            )
+        )
+
+    def add_request(self, request: Optional[Request]):
+        if request is None:
+            self.closed = True
+        else:
+            self.add(request)
+
+    def next_batch(self) -> Optional[List[Request]]:
+        while True:
+            # Requests which arrived while all workers were busy are
+            # scheduled first
+            while not self.closed:
+                try:
+                    self.add_request(self.request_queue.get_nowait())
+                except queue.Empty:
+                    break
+            if self.closed and len(self.scheduler) == 0:
+                return None
+            now = time.time()
+            # Once closed, flush everything that is left
+            batch = self.scheduler.next_batch(math.inf if self.closed else now)
+            if batch:
+                requests = [r.payload for r in batch]
+                first = requests[0]
+                self.scheduled_batches[(first.client_id, first.request_id)] = batch
+                return requests
+            wakeup = self.scheduler.next_wakeup(now)
+            try:
+                if wakeup is None:
+                    request = self.request_queue.get()
+                else:
+                    request = self.request_queue.get(timeout=max(wakeup - now, 0))
+            except queue.Empty:
+                continue
+            self.add_request(request)
+
+    def observe(self, batch, compute_ms):
+        # Only the scheduler knows the source lengths it batched on
+        first = batch[0]
+        self.scheduler.observe(
+            self.scheduled_batches.pop((first.client_id, first.request_id)),
+            compute_ms,
+        )
+
+
+def build_batcher(args, batch_translator, request_queue):
+    if args.scheduler == "deadline":
+        return SchedulingBatcher(
+            request_queue,
+            batch_scheduler.build_scheduler(args),
+            lambda text: max(batch_translator.numberize(text).numel(), 1),
+            args.deadline_ms,
+        )
+    return MicroBatcher(request_queue, args.max_batch_size, args.max_wait_ms)
+
+
+class Dispatcher:
+    """
+    Runs a batcher in a thread of the parent process, so that a single
+    scheduler sees every request and the compute time of every batch, as in
+    batch_scheduler.simulate. A batch is only formed once a worker is idle;
+    it is then put on batch_queue for the workers. batch_done() must be called
+    when a worker has finished a batch. Closing the batcher sends a None to
+    every worker.
+    """
+
+    def __init__(self, batcher, batch_queue, num_workers):
+        self.batcher = batcher
+        self.batch_queue = batch_queue
+        self.num_workers = num_workers
+        self.idle_workers = threading.Semaphore(num_workers)
+        self.in_flight: Dict[int, List[Request]] = {}
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def is_alive(self):
+        return self.thread.is_alive()
+
+    def run(self):
+        batch_id = 0
+        while True:
+            self.idle_workers.acquire()
+            batch = self.batcher.next_batch()
+            if batch is None:
+                break
+            self.in_flight[batch_id] = batch
+            self.batch_queue.put((batch_id, batch))
+            batch_id += 1
+        for _ in range(self.num_workers):
+            self.batch_queue.put(None)
+
+    def batch_done(self, batch_id, compute_ms):
+        self.batcher.observe(self.in_flight.pop(batch_id), compute_ms)
+        self.idle_workers.release()
+
+
+def set_worker_threads(worker_id, threads_per_worker, pin_workers):
+    torch.set_num_threads(threads_per_worker)
+    if pin_workers and hasattr(os, "sched_setaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+        start = (worker_id * threads_per_worker) % len(cpus)
+        os.sched_setaffinity(
+            0, {cpus[(start + i) % len(cpus)] for i in range(threads_per_worker)}
+        )
+
+
+def worker_main(worker_id, args, batch_translator, batch_queue, response_queue):
+    """
+    Translates the batches of the dispatcher. The responses to a batch are put
+    on response_queue together, as (batch_id, compute_ms, responses).
+    """
+    set_worker_threads(worker_id, args.threads_per_worker, args.pin_workers)
+    while True:
+        item = batch_queue.get()
+        if item is None:
+            break
+        batch_id, batch = item
+        start = time.time()
+        translations = batch_translator.translate([r.text for r in batch])
+        compute_ms = (time.time() - start) * 1000
+        responses = [
+            Response(
+                client_id=request.client_id,
+                request_id=request.request_id,
+                text=translation,
+                arrival_time=request.arrival_time,
+                queue_ms=(start - request.arrival_time) * 1000,
+                compute_ms=compute_ms,
+                batch_size=len(batch),
+            )
+            for request, translation in zip(batch, translations)
+        ]
+        response_queue.put((batch_id, compute_ms, responses))
+
+
+class OrderedWriter:
+    """Writes the responses of one client in request order."""
+
+    def __init__(self, write_fn):
+        self.write_fn = write_fn
+        self.next_request_id = 0
+        self.pending: Dict[int, str] = {}
+
+    def add(self, request_id, text):
+        self.pending[request_id] = text
+        while self.next_request_id in self.pending:
+            self.write_fn(self.pending.pop(self.next_request_id) + "\n")
+            self.next_request_id += 1
+
+
+class ServingStats:
+    def __init__(self, deadline_ms=0.0):
+        self.deadline_ms = deadline_ms
+        self.queue_ms = []
+        self.compute_ms = []
+        self.total_ms = []
+        self.batch_sizes = []
+        self.start_time = time.time()
+
+    def add(self, response: Response):
+        self.queue_ms.append(response.queue_ms)
+        self.compute_ms.append(response.compute_ms)
+        self.total_ms.append((time.time() - response.arrival_time) * 1000)
+        self.batch_sizes.append(response.batch_size)
+
+    def print_summary(self, file=sys.stderr):
+        if not self.total_ms:
+            return
+        elapsed = time.time() - self.start_time
+
+        def percentiles(values):
+            p50, p90, p99 = np.percentile(values, [50, 90, 99])
+            return f"p50 {p50:.1f} ms, p90 {p90:.1f} ms, p99 {p99:.1f} ms"
+
+        print(
+            f"| Served {len(self.total_ms)} sentences in {elapsed:.1f}s "
+            f"({len(self.total_ms) / elapsed:.2f} sentences/s), "
+            f"mean batch size {np.mean(self.batch_sizes):.1f}",
+            file=file,
+        )
+        print(f"| end-to-end latency: {percentiles(self.total_ms)}", file=file)
+        print(f"| queueing delay: {percentiles(self.queue_ms)}", file=file)
+        print(f"| batch compute: {percentiles(self.compute_ms)}", file=file)
+        if self.deadline_ms > 0:
+            missed = sum(t > self.deadline_ms for t in self.total_ms)
+            print(
+                f"| {missed / len(self.total_ms):.1%} of requests missed the "
+                f"{self.deadline_ms:.0f} ms deadline",
+                file=file,
+            )
+
+
+def start_workers(args, batch_translator):
+    """
+    Returns the forked workers, the dispatcher, the queue to put Requests on
+    and the queue the workers put their responses on.
+    """
+    # fork (rather than spawn) so that workers share the loaded weights
+    context = multiprocessing.get_context("fork")
+    batch_queue = context.Queue()
+    response_queue = context.Queue()
+    workers = []
+    for worker_id in range(args.serve_workers):
+        worker = context.Process(
+            target=worker_main,
+            args=(worker_id, args, batch_translator, batch_queue, response_queue),
+            daemon=True,
+        )
+        worker.start()
+        workers.append(worker)
+    request_queue = queue.Queue()
+    dispatcher = Dispatcher(
+        build_batcher(args, batch_translator, request_queue),
+        batch_queue,
+        args.serve_workers,
+    )
+    dispatcher.start()
+    return workers, dispatcher, request_queue, response_queue
+
+
+def stop_workers(workers, dispatcher, request_queue, response_queue):
+    request_queue.put(None)
+    # The batches left in the batcher are flushed as workers become idle
+    while dispatcher.is_alive():
+        try:
+            batch_id, compute_ms, _ = response_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        dispatcher.batch_done(batch_id, compute_ms)
+    for worker in workers:
+        worker.join()
+
+
+def serve_stdin(args, batch_translator, input_file=sys.stdin, output_file=sys.stdout):
+    workers, dispatcher, request_queue, response_queue = start_workers(
+        args, batch_translator
+    )
+    num_requests = [None]
+
+    def read_requests():
+        request_id = 0
+        for line in input_file:
+            request_queue.put(Request(0, request_id, line.rstrip("\n"), time.time()))
+            request_id += 1
+        num_requests[0] = request_id
+
+    reader = threading.Thread(target=read_requests, daemon=True)
+    reader.start()
+
+    stats = ServingStats(args.deadline_ms)
+    writer = OrderedWriter(output_file.write)
+    num_responses = 0
+    while num_requests[0] is None or num_responses < num_requests[0]:
+        try:
+            batch_id, compute_ms, responses = response_queue.get(timeout=0.1)
+        except queue.Empty:
+            exit_codes = [w.exitcode for w in workers if not w.is_alive()]
+            if exit_codes:
+                raise RuntimeError(
+                    f"Serving worker exited with code {exit_codes[0]} before "
+                    f"all requests were translated"
+                )
+            continue
+        dispatcher.batch_done(batch_id, compute_ms)
+        for response in responses:
+            writer.add(response.request_id, response.text)
+            stats.add(response)
+        output_file.flush()
+        num_responses += len(responses)
+
+    stop_workers(workers, dispatcher, request_queue, response_queue)
+    stats.print_summary()
+    return stats
+
+
+def serve_socket(args, batch_translator):
+    if os.path.exists(args.socket_path):
+        os.remove(args.socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(args.socket_path)
+    server.listen()
+    workers, dispatcher, request_queue, response_queue = start_workers(
+        args, batch_translator
+    )
+    writers: Dict[int, OrderedWriter] = {}
+    writers_lock = threading.Lock()
+    stats = ServingStats(args.deadline_ms)
+
+    def handle_connection(client_id, connection):
+        connection_file = connection.makefile("rw")
+
+        def write(text):
+            connection_file.write(text)
+            connection_file.flush()
+
+        with writers_lock:
+            writers[client_id] = OrderedWriter(write)
+        for request_id, line in enumerate(connection_file):
+            request_queue.put(
+                Request(client_id, request_id, line.rstrip("\n"), time.time())
+            )
+
+    def accept_connections():
+        client_id = 0
+        while True:
+            connection, _ = server.accept()
+            threading.Thread(
+                target=handle_connection, args=(client_id, connection), daemon=True
+            ).start()
+            client_id += 1
+
+    threading.Thread(target=accept_connections, daemon=True).start()
+    print(f"| Serving on {args.socket_path}", file=sys.stderr, flush=True)
+    try:
+        while True:
+            batch_id, compute_ms, responses = response_queue.get()
+            dispatcher.batch_done(batch_id, compute_ms)
+            for response in responses:
+                with writers_lock:
+                    writer = writers[response.client_id]
+                try:
+                    writer.add(response.request_id, response.text)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client went away. Its remaining responses are dropped.
+                    pass
+                stats.add(response)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.remove(args.socket_path)
+        stop_workers(workers, dispatcher, request_queue, response_queue)
+        stats.print_summary()
+
+
+def build_batch_translator(args):
+    models, model_args, task = pytorch_translate_utils.load_diverse_ensemble_for_inference(
+        args.path.split(":"), inference_dtype=args.inference_dtype
+    )
+    for model in models:
+        if isinstance(
+            model,
+            (
+                char_source_model.CharSourceModel,
+                char_source_transformer_model.CharSourceTransformerModel,
+                char_source_hybrid.CharSourceHybridModel,
+            ),
+        ):
+            raise ValueError("Serving does not support char-source models yet.")
+        model.eval()
+        model.make_generation_fast_(
+            beamable_mm_beam_size=None if args.no_beamable_mm else args.beam,
+            need_attn=True,
+        )
+    append_eos_to_source = model_args[0].append_eos_to_source
+    reverse_source = model_args[0].reverse_source
+    assert all(
+        a.append_eos_to_source == append_eos_to_source
+        and a.reverse_source == reverse_source
+        for a in model_args
+    )
+    return BatchTranslator(args, task, models, append_eos_to_source, reverse_source)
+
+
+def validate_args(args):
+    pytorch_translate_options.validate_generation_args(args)
+    assert args.path is not None, "--path required for serving!"
+    assert args.serve_workers >= 1, "--serve-workers must be >= 1."
+    assert args.threads_per_worker >= 1, "--threads-per-worker must be >= 1."
+    assert args.max_batch_size >= 1, "--max-batch-size must be >= 1."
+
+
+def main():
+    parser = get_parser_with_args()
+    args = options.parse_args_and_arch(parser)
+    validate_args(args)
+    # This is a CPU serving mode
+    args.cpu = True
+    batch_translator = build_batch_translator(args)
+    if args.socket_path:
+        serve_socket(args, batch_translator)
+    else:
+        serve_stdin(args, batch_translator)
+
+
+if __name__ == "__main__":
+    main()
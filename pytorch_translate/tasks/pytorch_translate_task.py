@@ -5,6 +5,7 @@ from collections import OrderedDict
 from typing import List, Optional
 
 from fairseq import data, options
+from fairseq.data import data_utils as fairseq_data_utils, iterators
 from fairseq.tasks import FairseqTask, register_task
 from pytorch_translate import (
     char_data,
@@ -13,6 +14,7 @@ from pytorch_translate import (
     dictionary as pytorch_translate_dictionary,
     weighted_data,
 )
+from pytorch_translate.research.knowledge_distillation import teacher_cache
 from pytorch_translate.research.multisource import multisource_data
 
 
@@ -154,6 +156,12 @@ class PytorchTranslateTask(FairseqTask):
                 left_pad_source=False,
             )
 
+        teacher_cache_path = getattr(self.args, "teacher_topk_cache_path", "")
+        if teacher_cache_path and split == self.args.train_subset:
+            self.datasets[split] = teacher_cache.TeacherTopKDataset(
+                self.datasets[split], teacher_cache.TeacherTopKCache(teacher_cache_path)
+            )
+
         if self.args.log_verbose:
             print("Finished loading dataset", flush=True)
 
@@ -398,6 +406,68 @@ class PytorchTranslateMultilingualTask(PytorchTranslateTask):
         )
         print(f"| {split} {len(self.datasets[split])} examples")
 
+    def get_batch_iterator(
+        self,
+        dataset,
+        max_tokens=None,
+        max_sentences=None,
+        max_positions=None,
+        ignore_invalid_inputs=False,
+        required_batch_size_multiple=1,
+        seed=1,
+        num_shards=1,
+        shard_id=0,
+        num_workers=0,
+    ):
+        if not getattr(self.args, "multiling_group_by_target_lang", False):
+            return super().get_batch_iterator(
+                dataset=dataset,
+                max_tokens=max_tokens,
+                max_sentences=max_sentences,
+                max_positions=max_positions,
+                ignore_invalid_inputs=ignore_invalid_inputs,
+                required_batch_size_multiple=required_batch_size_multiple,
+                seed=seed,
+                num_shards=num_shards,
+                shard_id=shard_id,
+                num_workers=num_workers,
+            )
+        assert isinstance(dataset, data.FairseqDataset)
+
+        # get indices ordered by example size
+        with fairseq_data_utils.numpy_seed(seed):
+            indices = dataset.ordered_indices()
+
+        # filter examples that are too large
+        indices = fairseq_data_utils.filter_by_size(
+            indices,
+            dataset.size,
+            max_positions,
+            raise_exception=(not ignore_invalid_inputs),
+        )
+
+        # create mini-batches with a single target language each, so that
+        # MultilingualDecoder runs exactly one decoder per batch
+        batch_sampler = data_utils.batch_by_size_and_lang(
+            indices,
+            data_utils.get_target_lang_ids(dataset),
+            dataset.num_tokens,
+            max_tokens=max_tokens,
+            max_sentences=max_sentences,
+            required_batch_size_multiple=required_batch_size_multiple,
+        )
+
+        # return a reusable, sharded iterator
+        return iterators.EpochBatchIterator(
+            dataset=dataset,
+            collate_fn=dataset.collater,
+            batch_sampler=batch_sampler,
+            seed=seed,
+            num_shards=num_shards,
+            shard_id=shard_id,
+            num_workers=num_workers,
+        )
+
     def set_encoder_langs(self, encoder_langs):
         self.encoder_langs = encoder_langs
 
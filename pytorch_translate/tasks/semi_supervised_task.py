@@ -2,11 +2,13 @@
 
 import json
 import os
+import time
 from collections import OrderedDict
-from typing import Optional
+from typing import Any, Callable, Dict, NamedTuple, Optional
 
+import numpy as np
 import torch
-from fairseq import models
+from fairseq import distributed_utils, models, utils
 from fairseq.data import (
     BacktranslationDataset,
     FairseqDataset,
@@ -123,6 +125,42 @@ class WeightedEpochBatchIterator(iterators.EpochBatchIterator):
         return self._cur_epoch_itr
 
 
+class BacktranslationMeter:
+    """Counts the tokens generated by back-translation and the time spent
+    generating them."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.num_tokens = 0
+        self.seconds = 0.0
+
+    def update(self, num_tokens, seconds):
+        self.num_tokens += num_tokens
+        self.seconds += seconds
+
+    def pop_tokens_per_sec(self) -> Optional[float]:
+        """Tokens/sec since the last call, or None if nothing was generated."""
+        if self.seconds == 0:
+            return None
+        tokens_per_sec = self.num_tokens / self.seconds
+        self.reset()
+        return tokens_per_sec
+
+
+class BacktranslationInput(NamedTuple):
+    """What is needed to (re)generate the synthetic side of one monolingual
+    dataset: the monolingual sentences, the collater that turns them into
+    model input and the function that translates a batch of model input."""
+
+    monolingual_dataset: LanguagePairDataset
+    collater: Callable
+    generate_fn: Callable
+    src_dict: Any
+    tgt_dict: Any
+
+
 @register_task(constants.SEMI_SUPERVISED_TASK)
 class PytorchTranslateSemiSupervised(PytorchTranslateTask):
     def __init__(self, args, dicts, training):
@@ -154,6 +192,13 @@ class PytorchTranslateSemiSupervised(PytorchTranslateTask):
         # MultilingualTranslationTask
         self.args.lang_pairs = self.lang_pairs
         self.model = None
+        self.backtranslation_meter = BacktranslationMeter()
+        # {split: {dataset_key: BacktranslationInput}}, only populated when
+        # back-translations are cached with --backtranslation-cache-dir
+        self.backtranslation_inputs: Dict[str, Dict[str, BacktranslationInput]] = {}
+        # Splits whose cached back-translations are placeholders and have to
+        # be generated before training on them
+        self.stale_backtranslations = set()
         # TODO: Expose this as easy-to-use command line argument
         """
         loss_weights refers to weights given to training loss for constituent
@@ -222,6 +267,62 @@ class PytorchTranslateSemiSupervised(PytorchTranslateTask):
             help="JSON representation of `loss_weights`:"
             "[[num_epochs, {'model_key': weight, ...}], ...]",
         )
+        parser.add_argument(
+            "--backtranslation-search",
+            default="beam",
+            choices=["beam", "greedy", "sampling"],
+            help="How back-translations are generated: beam search with "
+            "--backtranslation-beam-size, greedy decoding, or sampling "
+            "from the model distribution. greedy and sampling use a batched "
+            "decoding loop without beam search bookkeeping.",
+        )
+        parser.add_argument(
+            "--backtranslation-beam-size",
+            default=1,
+            type=int,
+            metavar="N",
+            help="Beam size for --backtranslation-search=beam.",
+        )
+        parser.add_argument(
+            "--backtranslation-sampling-topk",
+            default=-1,
+            type=int,
+            metavar="K",
+            help="For --backtranslation-search=sampling, only sample from the "
+            "K most likely tokens. -1 samples from the full distribution.",
+        )
+        parser.add_argument(
+            "--backtranslation-sampling-temperature",
+            default=1.0,
+            type=float,
+            metavar="T",
+            help="For --backtranslation-search=sampling, temperature of the "
+            "distribution sampled from.",
+        )
+        parser.add_argument(
+            "--backtranslation-cache-dir",
+            default="",
+            help="If set, the monolingual corpora are back-translated in a bulk "
+            "generation pass before training instead of on the fly for every "
+            "batch. The synthetic sentences are stored in this directory and "
+            "reused when training is resumed.",
+        )
+        parser.add_argument(
+            "--backtranslation-refresh-epochs",
+            default=0,
+            type=int,
+            metavar="N",
+            help="With --backtranslation-cache-dir, regenerate the "
+            "back-translations with the current models every N epochs. "
+            "0 back-translates only once.",
+        )
+        parser.add_argument(
+            "--backtranslation-batch-size",
+            default=64,
+            type=int,
+            metavar="N",
+            help="Number of sentences per batch in the bulk back-translation pass.",
+        )
 
     @staticmethod
     def parse_loss_weights(loss_weights_json: str):
@@ -379,53 +480,114 @@ class PytorchTranslateSemiSupervised(PytorchTranslateTask):
                         self.args.max_len_a * net_input["src_tokens"].size(1)
                         + self.args.max_len_b
                     )
-                    return generator.generate(net_input, maxlen=maxlen)
+                    start = time.time()
+                    search = getattr(self.args, "backtranslation_search", "beam")
+                    if search == "beam":
+                        hypos = generator.generate(
+                            net_input,
+                            beam_size=getattr(
+                                self.args, "backtranslation_beam_size", None
+                            ),
+                            maxlen=maxlen,
+                        )
+                    else:
+                        hypos = generator.sample(
+                            net_input,
+                            maxlen=maxlen,
+                            greedy=search == "greedy",
+                            sampling_topk=self.args.backtranslation_sampling_topk,
+                            sampling_temperature=(
+                                self.args.backtranslation_sampling_temperature
+                            ),
+                        )
+                    self.backtranslation_meter.update(
+                        sum(hypo[0]["tokens"].numel() for hypo in hypos),
+                        time.time() - start,
+                    )
+                    return hypos
 
                 return _generate_fn
 
-            dataset_map[
-                f"{self.source_lang}-"
-                f"{self.target_lang}_{constants.MONOLINGUAL_DATA_IDENTIFIER}"
-            ] = weighted_data.WeightedBacktranslationDataset(
-                dataset=BacktranslationDataset(
-                    tgt_dataset=TransformEosDataset(
-                        dataset=tgt_dataset,
-                        eos=self.target_dictionary.eos(),
-                        # Remove EOS from the input before backtranslation.
-                        remove_eos_from_src=True,
-                    ),
-                    backtranslation_fn=generate_fn(bwd_generator),
-                    output_collater=TransformEosDataset(
-                        dataset=tgt_dataset,
-                        eos=self.target_dictionary.eos(),
-                        # The original input (now the target) doesn't have
-                        # an EOS, so we need to add one. The generated
-                        # backtranslation (now the source) will have an EOS,
-                        # so we want to remove it.
-                        append_eos_to_tgt=True,
-                        remove_eos_from_src=True,
-                    ).collater,
+            if getattr(self.args, "backtranslation_cache_dir", ""):
+                backtranslation_inputs = OrderedDict(
+                    [
+                        (
+                            f"{self.source_lang}-{self.target_lang}_"
+                            f"{constants.MONOLINGUAL_DATA_IDENTIFIER}",
+                            BacktranslationInput(
+                                monolingual_dataset=tgt_dataset,
+                                collater=TransformEosDataset(
+                                    dataset=tgt_dataset,
+                                    eos=self.target_dictionary.eos(),
+                                    remove_eos_from_src=True,
+                                ).collater,
+                                generate_fn=generate_fn(bwd_generator),
+                                src_dict=self.source_dictionary,
+                                tgt_dict=self.target_dictionary,
+                            ),
+                        ),
+                        (
+                            f"{self.target_lang}-{self.source_lang}_"
+                            f"{constants.MONOLINGUAL_DATA_IDENTIFIER}",
+                            BacktranslationInput(
+                                monolingual_dataset=src_dataset,
+                                collater=src_dataset.collater,
+                                generate_fn=generate_fn(fwd_generator),
+                                src_dict=self.target_dictionary,
+                                tgt_dict=self.source_dictionary,
+                            ),
+                        ),
+                    ]
                 )
-            )
-            dataset_map[
-                f"{self.target_lang}-"
-                f"{self.source_lang}_{constants.MONOLINGUAL_DATA_IDENTIFIER}"
-            ] = weighted_data.WeightedBacktranslationDataset(
-                dataset=BacktranslationDataset(
-                    tgt_dataset=src_dataset,
-                    backtranslation_fn=generate_fn(fwd_generator),
-                    output_collater=TransformEosDataset(
-                        dataset=src_dataset,
-                        eos=self.source_dictionary.eos(),
-                        # The original input (now the target) doesn't have
-                        # an EOS, so we need to add one. The generated
-                        # backtranslation (now the source) will have an EOS,
-                        # so we want to remove it.
-                        append_eos_to_tgt=True,
-                        remove_eos_from_src=True,
-                    ).collater,
+                self.backtranslation_inputs[split] = backtranslation_inputs
+                for key, backtranslation_input in backtranslation_inputs.items():
+                    dataset_map[key] = self.load_cached_backtranslations(
+                        split, key, backtranslation_input
+                    )
+            else:
+                dataset_map[
+                    f"{self.source_lang}-"
+                    f"{self.target_lang}_{constants.MONOLINGUAL_DATA_IDENTIFIER}"
+                ] = weighted_data.WeightedBacktranslationDataset(
+                    dataset=BacktranslationDataset(
+                        tgt_dataset=TransformEosDataset(
+                            dataset=tgt_dataset,
+                            eos=self.target_dictionary.eos(),
+                            # Remove EOS from the input before backtranslation.
+                            remove_eos_from_src=True,
+                        ),
+                        backtranslation_fn=generate_fn(bwd_generator),
+                        output_collater=TransformEosDataset(
+                            dataset=tgt_dataset,
+                            eos=self.target_dictionary.eos(),
+                            # The original input (now the target) doesn't have
+                            # an EOS, so we need to add one. The generated
+                            # backtranslation (now the source) will have an EOS,
+                            # so we want to remove it.
+                            append_eos_to_tgt=True,
+                            remove_eos_from_src=True,
+                        ).collater,
+                    )
+                )
+                dataset_map[
+                    f"{self.target_lang}-"
+                    f"{self.source_lang}_{constants.MONOLINGUAL_DATA_IDENTIFIER}"
+                ] = weighted_data.WeightedBacktranslationDataset(
+                    dataset=BacktranslationDataset(
+                        tgt_dataset=src_dataset,
+                        backtranslation_fn=generate_fn(fwd_generator),
+                        output_collater=TransformEosDataset(
+                            dataset=src_dataset,
+                            eos=self.source_dictionary.eos(),
+                            # The original input (now the target) doesn't have
+                            # an EOS, so we need to add one. The generated
+                            # backtranslation (now the source) will have an EOS,
+                            # so we want to remove it.
+                            append_eos_to_tgt=True,
+                            remove_eos_from_src=True,
+                        ).collater,
+                    )
                 )
-            )
 
         # print before loading RoundRobinZipDatasets to help catch any bugs
         for dataset_key, dataset in dataset_map.items():
@@ -439,6 +601,232 @@ class PytorchTranslateSemiSupervised(PytorchTranslateTask):
         if self.args.log_verbose:
             print("Finished loading dataset", flush=True)
 
+    def backtranslation_cache_path(self, split, key, shard_id=None):
+        shard = "" if shard_id is None else f".shard{shard_id}"
+        return os.path.join(
+            self.args.backtranslation_cache_dir, f"{split}.{key}{shard}.npz"
+        )
+
+    def build_backtranslated_dataset(
+        self, synthetic_source, backtranslation_input: BacktranslationInput
+    ):
+        """
+        Pairs the synthetic source sentences with the monolingual sentences
+        they were generated from. As with BacktranslationDataset, neither side
+        has an EOS and one is appended to the target.
+        """
+        monolingual_dataset = backtranslation_input.monolingual_dataset
+        eos = backtranslation_input.tgt_dict.eos()
+        target = ptt_data.InMemoryNumpyDataset()
+        target.load_from_sequences(
+            [
+                strip_eos(monolingual_dataset[i]["source"], eos)
+                for i in range(len(monolingual_dataset))
+            ]
+        )
+        return weighted_data.WeightedLanguagePairDataset(
+            src=synthetic_source,
+            src_sizes=synthetic_source.sizes,
+            src_dict=backtranslation_input.src_dict,
+            tgt=target,
+            tgt_sizes=target.sizes,
+            tgt_dict=backtranslation_input.tgt_dict,
+            remove_eos_from_source=False,
+            append_eos_to_target=True,
+        )
+
+    def load_cached_backtranslations(
+        self, split, key, backtranslation_input: BacktranslationInput
+    ):
+        """
+        Loads the synthetic source sentences of a previous bulk
+        back-translation pass. If there are none, every source sentence is a
+        single <unk> until refresh_backtranslations() is called; this avoids
+        decoding with models whose weights have not been restored yet.
+        """
+        num_examples = len(backtranslation_input.monolingual_dataset)
+        path = self.backtranslation_cache_path(split, key)
+        synthetic_source = None
+        if os.path.isfile(path):
+            synthetic_source = ptt_data.InMemoryNumpyDataset.create_from_file(path)
+            if len(synthetic_source) != num_examples:
+                print(
+                    f"| Ignoring {path}: it has {len(synthetic_source)} "
+                    f"back-translations for {num_examples} monolingual examples"
+                )
+                synthetic_source = None
+        if synthetic_source is None:
+            synthetic_source = ptt_data.InMemoryNumpyDataset()
+            synthetic_source.load_from_sequences(
+                [[backtranslation_input.src_dict.unk()]] * num_examples
+            )
+            self.stale_backtranslations.add(split)
+        return self.build_backtranslated_dataset(
+            synthetic_source, backtranslation_input
+        )
+
+    def backtranslation_shard_ids(self, monolingual_dataset, num_shards, shard_id):
+        """
+        Ids of the monolingual examples in a shard of the bulk back-translation
+        pass, in the order they are translated. The examples are sorted by
+        length and cut into batches of --backtranslation-batch-size, which are
+        dealt to the shards in turn.
+        """
+        batch_size = self.args.backtranslation_batch_size
+        indices = np.argsort(monolingual_dataset.src_sizes, kind="mergesort")
+        return [
+            i
+            for start in range(
+                shard_id * batch_size, len(indices), num_shards * batch_size
+            )
+            for i in indices[start : start + batch_size]
+        ]
+
+    def backtranslate(
+        self, backtranslation_input: BacktranslationInput, num_shards=1, shard_id=0
+    ):
+        """
+        Translates the examples of a shard of the monolingual dataset (all of
+        them by default) in batches of --backtranslation-batch-size sentences
+        of similar length. Returns a list with the best hypothesis without EOS
+        of every example, in the order of the monolingual dataset, and None
+        for the examples of other shards.
+        """
+        monolingual_dataset = backtranslation_input.monolingual_dataset
+        eos = backtranslation_input.src_dict.eos()
+        unk = backtranslation_input.src_dict.unk()
+        use_cuda = torch.cuda.is_available() and not getattr(self.args, "cpu", False)
+        batch_size = self.args.backtranslation_batch_size
+        translations = [None] * len(monolingual_dataset)
+        shard_ids = self.backtranslation_shard_ids(
+            monolingual_dataset, num_shards, shard_id
+        )
+        for start in range(0, len(shard_ids), batch_size):
+            sample = backtranslation_input.collater(
+                [monolingual_dataset[i] for i in shard_ids[start : start + batch_size]]
+            )
+            net_input = sample["net_input"]
+            if use_cuda:
+                net_input = utils.move_to_cuda(net_input)
+            hypos = backtranslation_input.generate_fn(net_input)
+            for id, hypo in zip(sample["id"].tolist(), hypos):
+                tokens = strip_eos(hypo[0]["tokens"].cpu(), eos)
+                # Empty sources can't be encoded
+                translations[id] = tokens if len(tokens) > 0 else [unk]
+        return translations
+
+    def gather_backtranslation_shards(
+        self, split, key, backtranslation_input: BacktranslationInput, translations
+    ):
+        """
+        Fills in the back-translations of the other distributed ranks. Every
+        rank writes its shard to --backtranslation-cache-dir, which all ranks
+        already share for resuming, and reads the shards of the others.
+        """
+        rank = self.args.distributed_rank
+        num_shards = self.args.distributed_world_size
+        monolingual_dataset = backtranslation_input.monolingual_dataset
+        shard_ids = self.backtranslation_shard_ids(
+            monolingual_dataset, num_shards, rank
+        )
+        shard_path = self.backtranslation_cache_path(split, key, shard_id=rank)
+        # Ranks past the last batch have an empty shard and write nothing
+        if shard_ids:
+            shard = ptt_data.InMemoryNumpyDataset()
+            shard.load_from_sequences([translations[i] for i in shard_ids])
+            os.makedirs(os.path.dirname(shard_path), exist_ok=True)
+            shard.save(shard_path)
+        # Wait until every shard is written
+        distributed_utils.all_gather_list(None)
+        for shard_id in range(num_shards):
+            if shard_id == rank:
+                continue
+            shard_ids = self.backtranslation_shard_ids(
+                monolingual_dataset, num_shards, shard_id
+            )
+            if not shard_ids:
+                continue
+            shard = ptt_data.InMemoryNumpyDataset.create_from_file(
+                self.backtranslation_cache_path(split, key, shard_id=shard_id)
+            )
+            for i, id in enumerate(shard_ids):
+                translations[id] = shard[i].numpy()
+        # Wait until every shard is read before removing them
+        distributed_utils.all_gather_list(None)
+        if os.path.isfile(shard_path):
+            os.remove(shard_path)
+        return translations
+
+    def refresh_backtranslations(self, split):
+        """
+        Regenerates the back-translations of all monolingual datasets of the
+        split with the current models, saves them to
+        --backtranslation-cache-dir and swaps them into the split's dataset.
+        In distributed training, each rank translates a shard of every
+        dataset. The batch iterator over the split has to be rebuilt
+        afterwards.
+        """
+        rank = getattr(self.args, "distributed_rank", 0)
+        num_shards = getattr(self.args, "distributed_world_size", 1)
+        dataset_map = OrderedDict(self.datasets[split].datasets)
+        for key, backtranslation_input in self.backtranslation_inputs[split].items():
+            start = time.time()
+            translations = self.backtranslate(
+                backtranslation_input, num_shards=num_shards, shard_id=rank
+            )
+            tokens_per_sec = self.backtranslation_meter.pop_tokens_per_sec() or 0.0
+            if num_shards > 1:
+                translations = self.gather_backtranslation_shards(
+                    split, key, backtranslation_input, translations
+                )
+            synthetic_source = ptt_data.InMemoryNumpyDataset()
+            synthetic_source.load_from_sequences(translations)
+            print(
+                f"| {split}: back-translated {len(synthetic_source)} sentences "
+                f"for {key} in {time.time() - start:.1f}s "
+                f"({tokens_per_sec:.1f} tokens/s in generation)",
+                flush=True,
+            )
+            if rank == 0:
+                path = self.backtranslation_cache_path(split, key)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # Write then rename, so that an interrupted pass never leaves
+                # a truncated cache behind
+                temp_path = f"{path}.tmp.npz"
+                synthetic_source.save(temp_path)
+                os.replace(temp_path, path)
+            dataset_map[key] = self.build_backtranslated_dataset(
+                synthetic_source, backtranslation_input
+            )
+        self.datasets[split] = RoundRobinZipDatasets(dataset_map)
+        self.stale_backtranslations.discard(split)
+
+    def maybe_refresh_backtranslations(self, split, extra_state) -> bool:
+        """
+        Called at the start of every epoch. Regenerates the cached
+        back-translations if they are placeholders, were produced by a
+        different training run, or are --backtranslation-refresh-epochs old.
+        The epoch they were generated in is tracked in
+        extra_state["backtranslation_epoch"]. Returns whether the split's
+        dataset was replaced.
+        """
+        if split not in self.backtranslation_inputs:
+            return False
+        last_epoch = extra_state.get("backtranslation_epoch")
+        refresh_epochs = self.args.backtranslation_refresh_epochs
+        if (
+            split not in self.stale_backtranslations
+            and last_epoch is not None
+            and (
+                refresh_epochs <= 0
+                or extra_state["epoch"] - last_epoch < refresh_epochs
+            )
+        ):
+            return False
+        self.refresh_backtranslations(split)
+        extra_state["backtranslation_epoch"] = extra_state["epoch"]
+        return True
+
     def build_model(self, args):
         model = models.build_model(args, self)
         self.model = model
@@ -606,3 +994,10 @@ class PytorchTranslateSemiSupervised(PytorchTranslateTask):
     @property
     def target_dictionary(self):
         return self.dicts[self.target_lang]
+
+
+def strip_eos(tokens, eos):
+    tokens = tokens.numpy() if torch.is_tensor(tokens) else np.asarray(tokens)
+    if len(tokens) > 0 and tokens[-1] == eos:
+        return tokens[:-1]
+    return tokens
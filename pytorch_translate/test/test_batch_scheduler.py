@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+import unittest
+
+from pytorch_translate import batch_scheduler
+
+
+def request(request_id, src_length, arrival_time=0.0, deadline=1.0):
+    return batch_scheduler.ScheduledRequest(
+        request_id=request_id,
+        src_length=src_length,
+        arrival_time=arrival_time,
+        deadline=deadline,
+    )
+
+
+class TestBatchScheduler(unittest.TestCase):
+    def test_fifo_scheduler(self):
+        scheduler = batch_scheduler.FifoScheduler(max_batch_size=2, max_wait_ms=10)
+        scheduler.add(request(0, 5))
+        assert scheduler.next_batch(now=0.0) is None
+        assert scheduler.next_wakeup(now=0.0) == 0.01
+        scheduler.add(request(1, 50))
+        scheduler.add(request(2, 5))
+        assert [r.request_id for r in scheduler.next_batch(now=0.0)] == [0, 1]
+        assert [r.request_id for r in scheduler.next_batch(now=0.01)] == [2]
+        assert len(scheduler) == 0
+
+    def test_deadline_scheduler_buckets_by_length(self):
+        scheduler = batch_scheduler.DeadlineAwareScheduler(
+            bucket_width=8, max_batch_size=2, max_wait_ms=1000
+        )
+        for i, src_length in enumerate([3, 20, 5, 22]):
+            scheduler.add(request(i, src_length, deadline=10.0 + i))
+        batches = [scheduler.next_batch(now=0.0), scheduler.next_batch(now=0.0)]
+        assert [sorted(r.request_id for r in b) for b in batches] == [[0, 2], [1, 3]]
+        assert scheduler.next_batch(now=0.0) is None
+
+    def test_deadline_scheduler_token_budget(self):
+        scheduler = batch_scheduler.DeadlineAwareScheduler(
+            bucket_width=100, max_tokens=100, max_batch_size=64, max_wait_ms=1000
+        )
+        for i in range(5):
+            scheduler.add(request(i, 40, deadline=10.0))
+        batch = scheduler.next_batch(now=0.0)
+        assert len(batch) == 2
+        assert batch_scheduler.padded_tokens(batch) <= 100
+        assert len(scheduler) == 3
+
+    def test_deadline_scheduler_starts_early_for_tight_deadlines(self):
+        scheduler = batch_scheduler.DeadlineAwareScheduler(
+            max_batch_size=64, max_wait_ms=1000, overhead_ms=10, ms_per_token=0
+        )
+        scheduler.add(request(0, 5, arrival_time=0.0, deadline=0.1))
+        # Must start 10 ms before the deadline to make it
+        self.assertAlmostEqual(scheduler.next_wakeup(now=0.0), 0.09)
+        assert scheduler.next_batch(now=0.05) is None
+        assert len(scheduler.next_batch(now=0.095)) == 1
+
+    def test_deadline_scheduler_learns_cost(self):
+        scheduler = batch_scheduler.DeadlineAwareScheduler(
+            overhead_ms=0, ms_per_token=1.0, smoothing=0.5
+        )
+        scheduler.observe([request(0, 10), request(1, 10)], compute_ms=40.0)
+        assert scheduler.ms_per_token == 1.5
+
+    def test_simulate(self):
+        requests = batch_scheduler.synthetic_requests(
+            num_requests=200, qps=500, deadline_ms=100, seed=1
+        )
+        service_time_ms = batch_scheduler.linear_service_time()
+        for scheduler in [
+            batch_scheduler.FifoScheduler(max_batch_size=8, max_wait_ms=10),
+            batch_scheduler.DeadlineAwareScheduler(max_batch_size=8),
+        ]:
+            result = batch_scheduler.simulate(
+                scheduler, requests, service_time_ms, num_workers=2
+            )
+            assert len(result.queue_ms) == len(requests)
+            assert sum(result.batch_sizes) == len(requests)
+            assert max(result.batch_sizes) <= 8
+            summary = result.summary()
+            assert 0 <= summary["deadline_miss_rate"] <= 1
@@ -1,13 +1,16 @@
 #!/usr/bin/env python3
 
+import math
 import unittest
 from typing import Any, List
 
 import numpy as np
 import torch
+from fairseq import utils
 from pytorch_translate import char_source_model  # noqa
+from pytorch_translate import hybrid_transformer_rnn  # noqa
 from pytorch_translate import rnn  # noqa
-from pytorch_translate import beam_decode, generate
+from pytorch_translate import beam_decode, generate, utils as pytorch_translate_utils
 from pytorch_translate.tasks import pytorch_translate_task as tasks
 from pytorch_translate.test import utils as test_utils
 
@@ -50,6 +53,40 @@ class TestBeamDecode(unittest.TestCase):
         }
         translator.generate(encoder_input, maxlen=7)
 
+    def test_hybrid_reorder_reuses_encoder_projections(self):
+        test_args = test_utils.ModelParamsDict(arch="hybrid_transformer_rnn")
+        _, src_dict, tgt_dict = test_utils.prepare_inputs(test_args)
+        task = tasks.DictionaryHolderTask(src_dict, tgt_dict)
+        model = task.build_model(test_args)
+        model.eval()
+        # two hypotheses for each of two source sentences
+        src_tokens = torch.LongTensor([[5, 6, 7], [5, 6, 7], [7, 6, 5], [7, 6, 5]])
+        src_lengths = torch.LongTensor([3, 3, 3, 3])
+        encoder_out = model.encoder(src_tokens, src_lengths)
+        prev_output_tokens = torch.LongTensor([[tgt_dict.eos()]] * 4)
+        incremental_state = {}
+        model.decoder(prev_output_tokens, encoder_out, incremental_state)
+
+        def cached_key():
+            return utils.get_incremental_state(
+                model.decoder, incremental_state, "cached_state"
+            )[-2]
+
+        key = cached_key()
+        # reordering within the beam of a sentence keeps the projections
+        model.decoder.reorder_incremental_state(
+            incremental_state, torch.LongTensor([1, 0, 3, 2])
+        )
+        self.assertIs(cached_key(), key)
+        # dropping a sentence from the batch reorders them
+        model.decoder.reorder_incremental_state(
+            incremental_state, torch.LongTensor([2, 3])
+        )
+        self.assertEqual(cached_key().size(0), 2)
+        np.testing.assert_allclose(
+            cached_key().detach().numpy(), key[2:].detach().numpy()
+        )
+
     def test_gather_probs_with_vr(self):
         """ Tests gather_probs when there is vocab reduction """
         all_translation_tokens: List[Any] = [
@@ -101,6 +138,105 @@ class TestBeamDecode(unittest.TestCase):
             actual=avg_probs[1], desired=np.array(avg_probs_ref), atol=1e-5
         )
 
+    def test_gather_log_probs_matches_gather_probs(self):
+        all_translation_tokens: List[Any] = [
+            torch.LongTensor([3, 7, 8, 9]),
+            torch.LongTensor([0, 3, 5]),
+        ]
+        all_probs: List[Any] = [
+            torch.FloatTensor([[0.25, 0.25, 0.25, 0.25], [0.25, 0.25, 0.25, 0.25]]),
+            torch.FloatTensor([[0.4, 0.5, 0.1], [0.4, 0.5, 0.1]]),
+        ]
+        avg_log_probs, log_tokens = beam_decode.SequenceGenerator.gather_log_probs(
+            all_translation_tokens=all_translation_tokens,
+            all_log_probs=[probs.log() for probs in all_probs],
+        )
+        avg_probs, tokens = beam_decode.SequenceGenerator.gather_probs(
+            all_translation_tokens=all_translation_tokens, all_probs=all_probs
+        )
+        np.testing.assert_array_equal(log_tokens.numpy(), tokens.numpy())
+        np.testing.assert_allclose(
+            actual=avg_log_probs.exp().numpy(), desired=avg_probs.numpy(), atol=1e-5
+        )
+
+    def test_gather_log_probs_does_not_underflow(self):
+        # exp(-200) underflows to 0 in fp32, so the log of the mean would be -inf
+        all_log_probs = [
+            torch.FloatTensor([[-200.0, 0.0]]) + math.log(0.5),
+            torch.FloatTensor([[-201.0, 0.0]]) + math.log(0.5),
+        ]
+        avg_log_probs, _ = beam_decode.SequenceGenerator.gather_log_probs(
+            all_translation_tokens=[None, None], all_log_probs=all_log_probs
+        )
+        assert torch.isfinite(avg_log_probs).all()
+        expected = -200.0 + math.log(0.5 * (1 + math.exp(-1.0)))
+        np.testing.assert_allclose(avg_log_probs[0, 0].item(), expected, rtol=1e-5)
+
+    def test_generate_with_inference_dtype(self):
+        test_args = test_utils.ModelParamsDict()
+        _, src_dict, tgt_dict = test_utils.prepare_inputs(test_args)
+        task = tasks.DictionaryHolderTask(src_dict, tgt_dict)
+        model = task.build_model(test_args)
+        pytorch_translate_utils.cast_model_for_inference(model, "bf16")
+        assert all(p.dtype == torch.bfloat16 for p in model.parameters())
+        translator = beam_decode.SequenceGenerator([model, model], tgt_dict)
+        src_tokens = torch.LongTensor([[4, 5, 6], [6, 5, 4]])
+        src_lengths = torch.LongTensor([3, 3])
+        encoder_input = {"src_tokens": src_tokens, "src_lengths": src_lengths}
+        hypos = translator.generate(encoder_input, maxlen=7)
+        for hypo in hypos:
+            assert hypo[0]["positional_scores"].dtype == torch.float32
+            assert math.isfinite(hypo[0]["score"])
+
+    def test_greedy_sample_matches_beam_size_1(self):
+        test_args = test_utils.ModelParamsDict()
+        _, src_dict, tgt_dict = test_utils.prepare_inputs(test_args)
+        task = tasks.DictionaryHolderTask(src_dict, tgt_dict)
+        model = task.build_model(test_args)
+        translator = beam_decode.SequenceGenerator([model], tgt_dict, beam_size=1)
+        src_tokens = torch.LongTensor([[4, 5, 6], [6, 5, 4], [5, 5, 5]])
+        src_lengths = torch.LongTensor([3, 3, 3])
+        encoder_input = {"src_tokens": src_tokens, "src_lengths": src_lengths}
+        beam_hypos = translator.generate(encoder_input, maxlen=7)
+        greedy_hypos = translator.sample(encoder_input, maxlen=7, greedy=True)
+        top1_hypos = translator.sample(encoder_input, maxlen=7, sampling_topk=1)
+        for beam_hypo, greedy_hypo, top1_hypo in zip(
+            beam_hypos, greedy_hypos, top1_hypos
+        ):
+            assert len(greedy_hypo) == 1
+            self.assertEqual(
+                greedy_hypo[0]["tokens"].tolist(), beam_hypo[0]["tokens"].tolist()
+            )
+            self.assertEqual(
+                top1_hypo[0]["tokens"].tolist(), beam_hypo[0]["tokens"].tolist()
+            )
+            np.testing.assert_allclose(
+                greedy_hypo[0]["positional_scores"].numpy(),
+                beam_hypo[0]["positional_scores"].numpy(),
+                rtol=1e-5,
+            )
+            assert greedy_hypo[0]["tokens"][-1] == tgt_dict.eos()
+
+    def test_sample(self):
+        test_args = test_utils.ModelParamsDict()
+        _, src_dict, tgt_dict = test_utils.prepare_inputs(test_args)
+        task = tasks.DictionaryHolderTask(src_dict, tgt_dict)
+        model = task.build_model(test_args)
+        translator = beam_decode.SequenceGenerator([model], tgt_dict)
+        src_tokens = torch.LongTensor([[4, 5, 6], [6, 5, 4]])
+        src_lengths = torch.LongTensor([3, 3])
+        encoder_input = {"src_tokens": src_tokens, "src_lengths": src_lengths}
+        hypos = translator.sample(
+            encoder_input, maxlen=7, sampling_topk=3, sampling_temperature=0.5
+        )
+        assert len(hypos) == 2
+        for hypo in hypos:
+            tokens = hypo[0]["tokens"]
+            assert 1 < len(tokens) <= 8
+            assert tokens[-1] == tgt_dict.eos()
+            assert tgt_dict.pad() not in tokens.tolist()
+            assert math.isfinite(hypo[0]["score"])
+
     def test_smoothed_sentence_bleu(self):
         """
         Testing calculation of smoothed_sentence_bleu() function.
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+import json
+import unittest
+
+import numpy as np
+from pytorch_translate import benchmark, utils
+from pytorch_translate.benchmarks import suite
+from pytorch_translate.test import utils as test_utils
+
+
+def make_results(timings):
+    return {
+        "metadata": {"num_threads": 1},
+        "results": {
+            name: {"median_ms": ms, "kind": "micro"} for name, ms in timings.items()
+        },
+    }
+
+
+class TestBenchmarkSuite(unittest.TestCase):
+    def test_compare_flags_regressions_above_threshold(self):
+        baseline = make_results({"a": 10.0, "b": 10.0, "c": 10.0, "old": 1.0})
+        current = make_results({"a": 10.5, "b": 12.0, "c": 8.0, "new": 1.0})
+        comparisons = suite.compare_results(baseline, current, threshold=0.1)
+        regressed = {name: flag for name, _, _, _, flag in comparisons}
+        assert regressed == {"a": False, "b": True, "c": False}
+
+    def test_select_benchmarks(self):
+        benchmarks = suite.all_benchmarks()
+        names = [
+            b.name for b in suite.select_benchmarks(benchmarks, r"^generate\.\w+$")
+        ]
+        assert names == [f"generate.{arch}" for arch in suite.ARCHS]
+        assert all(
+            b.kind == "micro" for b in suite.select_benchmarks(benchmarks, kind="micro")
+        )
+
+    def test_run_and_compare(self):
+        output_file = test_utils.make_temp_file()
+        assert (
+            suite.main(
+                [
+                    "run",
+                    "--filter",
+                    "^(parse|collate)",
+                    "--repeats",
+                    "1",
+                    "--warmup",
+                    "0",
+                    "--output-file",
+                    output_file,
+                ]
+            )
+            == 0
+        )
+        with open(output_file, "r") as f:
+            results = json.load(f)
+        assert "parse.in_memory_numpy" in results["results"]
+        assert "collate.char_source" in results["results"]
+        assert suite.main(["compare", output_file, output_file]) == 0
+
+
+class TestExportedModelRunners(unittest.TestCase):
+    def test_best_hypothesis(self):
+        eos = 2
+        all_tokens = np.array([[eos, eos], [5, eos], [eos, 6], [7, 9]])
+        all_prev_indices = np.array([[0, 0], [0, 0], [0, 0], [1, 1]])
+        all_scores = np.array([[0.0, 0.0], [-1.0, -2.5], [-2.0, -1.8], [-1.4, -3.0]])
+        # the best hypothesis ends at the last step
+        assert benchmark.best_hypothesis(
+            all_tokens, all_scores, all_prev_indices, eos
+        ) == ([5, 6, 7], -1.4)
+
+        # the best hypothesis ends with EOS, and hypotheses extending a
+        # finished one are ignored
+        all_tokens[3] = [7, eos]
+        all_prev_indices[3] = [1, 0]
+        all_scores[3] = [-2.1, -0.5]
+        assert benchmark.best_hypothesis(
+            all_tokens, all_scores, all_prev_indices, eos
+        ) == ([5], -2.0)
+
+
+class TestCorpusSampling(unittest.TestCase):
+    def test_bin_sentences_by_length(self):
+        sentences = [" ".join(["w"] * n) for n in range(1, 40)]
+        bins = benchmark.bin_sentences_by_length(sentences, [10, 6, 20])
+        lengths = {
+            length: [len(s.split()) for s in bin_sentences]
+            for length, bin_sentences in bins.items()
+        }
+        assert lengths == {
+            6: list(range(6, 10)),
+            10: list(range(10, 20)),
+            20: list(range(20, 30)),
+        }
+
+
+class TestTiming(unittest.TestCase):
+    def test_timed_run(self):
+        meter = utils.BucketStopwatchMeter(
+            increment=1, max_length=10, sentences_per_batch=1
+        )
+        elapsed = [benchmark.timed_run(meter, 4, lambda: None) for _ in range(3)]
+        elapsed.append(benchmark.timed_run(meter, 20, lambda: None))
+        # Each run goes to the bucket of its number of tokens
+        assert meter.count[4] == 3 and meter.n[4] == 12
+        assert meter.count[10] == 1 and meter.n[10] == 20
+        np.testing.assert_allclose(sum(elapsed[:3]), meter.sum[4])
+        np.testing.assert_allclose(elapsed[3], meter.sum[10])
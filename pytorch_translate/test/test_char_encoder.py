@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import numpy as np
+import torch
+from pytorch_translate import char_encoder
+from pytorch_translate.test import utils as test_utils
+
+
+class TestCharCNNModel(unittest.TestCase):
+    def _random_words(self, char_dict, max_word_len=13, num_words=40):
+        char_inds = torch.LongTensor(max_word_len, num_words).fill_(char_dict.pad())
+        for i in range(num_words):
+            word_len = np.random.randint(0, max_word_len + 1)
+            char_inds[:word_len, i] = torch.LongTensor(
+                np.random.randint(char_dict.nspecial, len(char_dict), size=word_len)
+            )
+        return char_inds
+
+    def test_length_buckets_match_full_padding(self):
+        char_dict = test_utils.dummy_dictionary(dummy_tokens=26)
+        char_inds = self._random_words(char_dict)
+        for pool_type in ["max", "mean", "logsumexp"]:
+            model = char_encoder.CharCNNModel(
+                char_dict,
+                num_chars=len(char_dict),
+                char_embed_dim=8,
+                convolutions_params=[(6, 3), (5, 5)],
+                pool_type=pool_type,
+                num_highway_layers=1,
+            )
+            bucketed_output = model(char_inds)
+            model.length_bucket_size = 0
+            padded_output = model(char_inds)
+            np.testing.assert_allclose(
+                bucketed_output.detach().numpy(),
+                padded_output.detach().numpy(),
+                atol=1e-5,
+            )
+
+    def test_stable_logsumexp_pooling(self):
+        char_dict = test_utils.dummy_dictionary()
+        model = char_encoder.CharCNNModel(
+            char_dict, convolutions_params=[(4, 3)], pool_type="logsumexp"
+        )
+        inputs = torch.FloatTensor([[[1000.0, 1000.0], [-1000.0, -999.0]]])
+        pooled = model.pooling(inputs, dim=2)
+        np.testing.assert_allclose(
+            pooled.numpy(), [[1000.0, -999.0 + np.log((1 + np.exp(-1)) / 2)]]
+        )
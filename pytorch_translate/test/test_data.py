@@ -3,7 +3,8 @@
 import os
 import unittest
 
-from pytorch_translate import data, dictionary
+import numpy as np
+from pytorch_translate import data, data_utils, dictionary
 from pytorch_translate.test import utils as test_utils
 
 
@@ -137,3 +138,15 @@ class TestInMemoryNumpyDataset(unittest.TestCase):
                 self.trg_ref[i] + [lang2],
                 append_dataset[i + self.num_sentences].tolist(),
             )
+
+
+class TestBatchByLang(unittest.TestCase):
+    def test_batch_by_size_and_lang(self):
+        lang_ids = np.array([0, 1, 0, 1, 1, 0])
+        indices = np.array([5, 4, 3, 2, 1, 0])
+        batches = data_utils.batch_by_size_and_lang(
+            indices, lang_ids, num_tokens_fn=lambda i: 1, max_sentences=2
+        )
+        self.assertListEqual(
+            [list(batch) for batch in batches], [[5, 2], [0], [4, 3], [1]]
+        )
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+import os
+import pickle
+import tempfile
+import unittest
+
+import torch
+from pytorch_translate import data as ptt_data, rnn, weighted_data  # noqa
+from pytorch_translate.research.knowledge_distillation import (
+    knowledge_distillation_loss,
+    teacher_cache,
+)
+from pytorch_translate.tasks import pytorch_translate_task as tasks
+from pytorch_translate.test import utils as test_utils
+
+
+def language_pair_dataset(src_dict, tgt_dict, sentences):
+    src = ptt_data.InMemoryNumpyDataset()
+    src.load_from_sequences([s for s, _ in sentences])
+    tgt = ptt_data.InMemoryNumpyDataset()
+    tgt.load_from_sequences([t for _, t in sentences])
+    return weighted_data.WeightedLanguagePairDataset(
+        src=src,
+        src_sizes=src.sizes,
+        src_dict=src_dict,
+        tgt=tgt,
+        tgt_sizes=tgt.sizes,
+        tgt_dict=tgt_dict,
+        left_pad_source=False,
+    )
+
+
+class TestKnowledgeDistillation(unittest.TestCase):
+    def test_sparse_kd_loss(self):
+        torch.manual_seed(0)
+        lprobs = torch.randn(4, 10).log_softmax(dim=-1)
+        topk_probs, topk_ids = torch.rand(4, 10).topk(3, dim=-1)
+        topk_probs[3] = 0
+        dense_probs = torch.zeros(4, 10).scatter(
+            1, topk_ids, topk_probs / topk_probs.sum(dim=-1, keepdim=True)
+        )
+        dense_probs[3] = 0
+        kd_loss = knowledge_distillation_loss.sparse_kd_loss(
+            lprobs, topk_ids, topk_probs
+        )
+        self.assertAlmostEqual(
+            kd_loss.item(), -torch.sum(dense_probs * lprobs).item(), places=5
+        )
+
+    def test_teacher_topk_cache(self):
+        test_args = test_utils.ModelParamsDict()
+        _, src_dict, tgt_dict = test_utils.prepare_inputs(test_args)
+        task = tasks.DictionaryHolderTask(src_dict, tgt_dict)
+        teacher = task.build_model(test_args)
+        teacher.eval()
+        sentences = [
+            ([4, 5, 2], [6, 2]),
+            ([5, 6, 7, 8, 2], [4, 5, 6, 7, 2]),
+            ([6, 2], [5, 4, 6, 2]),
+        ]
+        dataset = language_pair_dataset(src_dict, tgt_dict, sentences)
+
+        prefix = os.path.join(tempfile.mkdtemp(), "teacher")
+        teacher_cache.dump_teacher_topk([teacher], dataset, prefix, 3, batch_size=2)
+        cached_dataset = teacher_cache.TeacherTopKDataset(
+            dataset, teacher_cache.TeacherTopKCache(prefix)
+        )
+        assert len(cached_dataset) == len(dataset)
+
+        sample = cached_dataset.collater([cached_dataset[i] for i in range(3)])
+        bsz, tgt_len = sample["target"].size()
+        assert sample["teacher_topk_ids"].size() == (bsz, tgt_len, 3)
+        with torch.no_grad():
+            probs = teacher.get_normalized_probs(
+                teacher(**sample["net_input"]), log_probs=False
+            )
+        expected_probs, expected_ids = probs.topk(3, dim=-1)
+        for i, index in enumerate(sample["id"].tolist()):
+            length = len(sentences[index][1])
+            assert torch.equal(
+                sample["teacher_topk_ids"][i, :length], expected_ids[i, :length]
+            )
+            assert torch.allclose(
+                sample["teacher_topk_probs"][i, :length],
+                expected_probs[i, :length],
+                atol=1e-3,
+            )
+            assert sample["teacher_topk_probs"][i, length:].eq(0).all()
+
+    def test_teacher_topk_batch_iterator(self):
+        test_args = test_utils.ModelParamsDict()
+        _, src_dict, tgt_dict = test_utils.prepare_inputs(test_args)
+        task = tasks.DictionaryHolderTask(src_dict, tgt_dict)
+        teacher = task.build_model(test_args)
+        sentences = [
+            ([4, 5, 2], [6, 2]),
+            ([5, 6, 7, 8, 2], [4, 5, 6, 7, 2]),
+            ([6, 2], [5, 4, 6, 2]),
+        ]
+        dataset = language_pair_dataset(src_dict, tgt_dict, sentences)
+        prefix = os.path.join(tempfile.mkdtemp(), "teacher")
+        teacher_cache.dump_teacher_topk([teacher], dataset, prefix, 3, batch_size=2)
+        cached_dataset = teacher_cache.TeacherTopKDataset(
+            dataset, teacher_cache.TeacherTopKCache(prefix)
+        )
+        # Data loader workers receive the dataset pickled
+        cached_dataset = pickle.loads(pickle.dumps(cached_dataset))
+
+        samples = list(
+            task.get_batch_iterator(
+                dataset=cached_dataset, max_sentences=2, max_positions=(100, 100)
+            ).next_epoch_itr(shuffle=False)
+        )
+        assert sum(len(sample["id"]) for sample in samples) == len(sentences)
+
+        test_args.teacher_topk_cache_path = prefix
+        test_args.kd_weight = 0.5
+        criterion = knowledge_distillation_loss.KnowledgeDistillationCriterion(
+            test_args, task
+        )
+        student = task.build_model(test_args)
+        sample = samples[0]
+        loss, sample_size, logging_output = criterion(student, sample)
+        assert sample_size == sample["target"].size(0)
+        assert loss.item() > 0
+        loss.backward()
+
+    def test_compute_teacher_kd_loss_normalizes_per_row(self):
+        test_args = test_utils.ModelParamsDict()
+        samples, src_dict, tgt_dict = test_utils.prepare_inputs(test_args)
+        task = tasks.DictionaryHolderTask(src_dict, tgt_dict)
+        teachers = [task.build_model(test_args) for _ in range(2)]
+        for teacher in teachers:
+            teacher.eval()
+        criterion = knowledge_distillation_loss.KnowledgeDistillationCriterion.__new__(
+            knowledge_distillation_loss.KnowledgeDistillationCriterion
+        )
+        criterion.teacher_models = teachers
+        criterion.top_k_teacher_tokens = 3
+        criterion.padding_idx = tgt_dict.pad()
+
+        sample = next(samples)
+        target = sample["target"].view(-1)
+        lprobs = torch.randn(target.numel(), len(tgt_dict)).log_softmax(dim=-1)
+        lprobs.requires_grad_()
+        kd_loss = criterion.compute_teacher_kd_loss(sample, lprobs, target)
+
+        with torch.no_grad():
+            avg_probs = sum(
+                teacher.get_normalized_probs(
+                    teacher(**sample["net_input"]), log_probs=False
+                )
+                for teacher in teachers
+            ).view(-1, len(tgt_dict)) / len(teachers)
+        topk_probs, topk_ids = avg_probs.topk(3, dim=-1)
+        topk_probs = topk_probs / topk_probs.sum(dim=-1, keepdim=True)
+        topk_probs[target.eq(tgt_dict.pad())] = 0
+        expected_probs = torch.zeros_like(avg_probs).scatter(1, topk_ids, topk_probs)
+        expected_loss = -torch.sum(expected_probs * lprobs)
+        self.assertAlmostEqual(kd_loss.item(), expected_loss.item(), places=4)
+        kd_loss.backward()
+        assert lprobs.grad is not None
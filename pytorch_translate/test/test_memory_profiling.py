@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import torch
+from pytorch_translate import memory_profiling
+
+
+class TestMemoryProfiling(unittest.TestCase):
+    def test_disabled_profiler_records_nothing(self):
+        profiler = memory_profiling.MemoryProfiler(enabled=False)
+        profiler.start()
+        assert profiler.stop(key=(8, 10, 5)) == {}
+        assert len(profiler.buckets) == 0
+
+    def test_buckets_keep_maxima(self):
+        profiler = memory_profiling.MemoryProfiler(enabled=True, use_cuda=False)
+        for key in [(8, 10, 5), (8, 10, 5), (16, 20, 5)]:
+            profiler.start()
+            torch.zeros(100, 100)
+            stats = profiler.stop(key=key)
+            assert stats["peak_mem_mb"] > 0
+            assert stats["rss_mb"] > 0
+        assert list(profiler.buckets.keys()) == [(8, 10, 5), (16, 20, 5)]
+        assert profiler.buckets[(8, 10, 5)]["count"] == 2
+        assert profiler.last_stats == stats
+
+    def test_cpu_peak_is_per_region(self):
+        if not memory_profiling.reset_peak_rss():
+            self.skipTest("the RSS high-water mark cannot be reset here")
+        profiler = memory_profiling.MemoryProfiler(enabled=True, use_cuda=False)
+        profiler.start()
+        big = torch.ones(64, 2 ** 20)  # 256 MB
+        del big
+        large_peak_mb = profiler.stop()["peak_mem_mb"]
+
+        profiler.start()
+        torch.zeros(10)
+        stats = profiler.stop()
+        assert stats["peak_mem_mb"] < large_peak_mb - 128
+        assert abs(stats["rss_delta_mb"]) < 128
+
+    def test_largest_tensor_groups(self):
+        big = torch.zeros(512, 512)  # noqa
+        groups = memory_profiling.largest_tensor_groups(top_k=100)
+        assert any(
+            description.endswith("(512, 512)") and total_mb >= 1.0
+            for description, _, total_mb in groups
+        )
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from pytorch_translate import data as pytorch_translate_data, multilingual
+from pytorch_translate.test import utils as test_utils
+
+
+class DummyDecoder(torch.nn.Module):
+    """Decoder whose outputs only depend on the tokens and unpadded encoder
+    states of each row."""
+
+    def __init__(self, vocab_size, hidden_dim):
+        super().__init__()
+        self.embed = torch.nn.Embedding(32, hidden_dim)
+        self.out = torch.nn.Linear(hidden_dim, vocab_size)
+
+    def forward(self, input_tokens, encoder_out, incremental_state=None):
+        encoder_sum = encoder_out[0].sum(dim=0)
+        logits = self.out(self.embed(input_tokens) + encoder_sum.unsqueeze(1))
+        attn_scores = (
+            encoder_out[5][:, :, 0].t().unsqueeze(1).repeat(1, input_tokens.size(1), 1)
+        )
+        return logits, attn_scores, None
+
+
+class DummyEncoder(torch.nn.Module):
+    """Encoder whose outputs for each row only depend on its tokens."""
+
+    def __init__(self, hidden_dim):
+        super().__init__()
+        self.embed = torch.nn.Embedding(32, hidden_dim)
+
+    def forward(self, src_tokens, src_lengths):
+        embedded = self.embed(src_tokens).transpose(0, 1)
+        final = embedded.sum(dim=0, keepdim=True)
+        return embedded, final, final * 2, src_lengths, src_tokens, embedded * 3
+
+
+def multilingual_encoder_out(src_lengths, hidden_dim):
+    """Encoder output of MultilingualEncoder with zeros at padded positions."""
+    bsz, max_len = len(src_lengths), max(src_lengths)
+    mask = (torch.arange(max_len).unsqueeze(1) < torch.LongTensor(src_lengths)).float()
+    return (
+        torch.randn(max_len, bsz, hidden_dim) * mask.unsqueeze(2),
+        torch.randn(1, bsz, hidden_dim),
+        torch.randn(1, bsz, hidden_dim),
+        torch.LongTensor(src_lengths),
+        torch.ones(bsz, max_len).long(),
+        torch.randn(max_len, bsz, hidden_dim) * mask.unsqueeze(2),
+    )
+
+
+class TestMultilingual(unittest.TestCase):
+    def test_sort_by_language(self):
+        lang_ids = torch.LongTensor([2, 0, 2, 1, 0, 2])
+        lang_order, inverse_order, lang_bszs = multilingual.sort_by_language(
+            lang_ids, num_langs=4
+        )
+        # original order is kept within each language
+        np.testing.assert_array_equal(lang_order.numpy(), [1, 4, 3, 0, 2, 5])
+        np.testing.assert_array_equal(
+            lang_ids[lang_order][inverse_order].numpy(), lang_ids.numpy()
+        )
+        self.assertEqual(lang_bszs, [2, 1, 3, 0])
+
+    def test_pad_to_length(self):
+        x = torch.ones(2, 3, 4)
+        padded = multilingual.pad_to_length(x, 5, dim=0)
+        self.assertEqual(padded.size(), (5, 3, 4))
+        np.testing.assert_array_equal(padded[:2].numpy(), x.numpy())
+        np.testing.assert_array_equal(padded[2:].numpy(), np.zeros((3, 3, 4)))
+        self.assertIs(multilingual.pad_to_length(x, 2, dim=0), x)
+
+    def test_decoder_mixed_language_batch(self):
+        torch.manual_seed(0)
+        hidden_dim = 4
+        tgt_dict = test_utils.dummy_dictionary(dummy_tokens=8)
+        # Language 1 has no decoder, and decoders have different vocab sizes
+        decoders = [DummyDecoder(len(tgt_dict) - 2, hidden_dim), None]
+        decoders.append(DummyDecoder(len(tgt_dict), hidden_dim))
+        decoder = multilingual.MultilingualDecoder(tgt_dict, decoders, hidden_dim)
+        decoder.eval()
+
+        lang_ids = [2, 0, 1, 2, 0]
+        src_lengths = [3, 5, 2, 4, 1]
+        encoder_out = multilingual_encoder_out(src_lengths, hidden_dim)
+        input_tokens = torch.randint(4, 10, (len(lang_ids), 4))
+        input_tokens[:, 1] = (
+            torch.LongTensor(lang_ids)
+            + pytorch_translate_data.MULTILING_DIALECT_ID_OFFSET
+        )
+        logits, attn_scores, _ = decoder(input_tokens, encoder_out)
+        self.assertEqual(logits.size(), (5, 4, len(tgt_dict)))
+        self.assertEqual(attn_scores.size(), (5, 3, max(src_lengths)))
+
+        for i, lang_id in enumerate(lang_ids):
+            if decoders[lang_id] is None:
+                # Rows of a language without a decoder get zero outputs
+                self.assertEqual(logits[i].abs().sum().item(), 0)
+                self.assertEqual(attn_scores[i].abs().sum().item(), 0)
+                continue
+            src_len = src_lengths[i]
+            row_encoder_out = (
+                encoder_out[0][:src_len, i : i + 1],
+                encoder_out[1][:, i : i + 1],
+                encoder_out[2][:, i : i + 1],
+                encoder_out[3][i : i + 1],
+                encoder_out[4][i : i + 1, :src_len],
+                encoder_out[5][:src_len, i : i + 1],
+            )
+            row_tokens = torch.cat(
+                [input_tokens[i : i + 1, :1], input_tokens[i : i + 1, 2:]], dim=1
+            )
+            row_logits, row_attn_scores, _ = decoders[lang_id](
+                row_tokens, row_encoder_out
+            )
+            row_logits = F.pad(
+                row_logits, (0, len(tgt_dict) - row_logits.size(2), 1, 0)
+            )
+            np.testing.assert_allclose(
+                logits[i].detach().numpy(), row_logits[0].detach().numpy(), atol=1e-5
+            )
+            np.testing.assert_allclose(
+                attn_scores[i, :, :src_len].detach().numpy(),
+                row_attn_scores[0].detach().numpy(),
+                atol=1e-6,
+            )
+            self.assertEqual(attn_scores[i, :, src_len:].abs().sum().item(), 0)
+
+    def test_encoder_mixed_language_batch(self):
+        torch.manual_seed(0)
+        hidden_dim = 4
+        src_dict = test_utils.dummy_dictionary(dummy_tokens=8)
+        # Language 1 has no encoder
+        encoders = [DummyEncoder(hidden_dim), None, DummyEncoder(hidden_dim)]
+        encoder = multilingual.MultilingualEncoder(
+            src_dict, encoders, hidden_dim, num_layers=1, embed_dim=hidden_dim
+        )
+        encoder.eval()
+
+        lang_ids = [2, 0, 1, 2, 0]
+        src_tokens = torch.randint(4, 10, (len(lang_ids), 5))
+        src_tokens[:, -1] = (
+            torch.LongTensor(lang_ids)
+            + pytorch_translate_data.MULTILING_DIALECT_ID_OFFSET
+        )
+        src_lengths = torch.LongTensor([5, 5, 5, 5, 5])
+        encoder_out = encoder(src_tokens, src_lengths.clone())
+        self.assertEqual(encoder_out[0].size(), (4, 5, hidden_dim))
+        np.testing.assert_array_equal(encoder_out[3].numpy(), [4] * 5)
+        np.testing.assert_array_equal(encoder_out[4].numpy(), src_tokens[:, :-1])
+
+        for i, lang_id in enumerate(lang_ids):
+            if encoders[lang_id] is None:
+                # Rows of a language without an encoder get zero outputs
+                for out in (0, 1, 2, 5):
+                    self.assertEqual(encoder_out[out][:, i].abs().sum().item(), 0)
+                continue
+            row_out = encoders[lang_id](src_tokens[i : i + 1, :-1], None)
+            for out in (0, 1, 2, 5):
+                np.testing.assert_allclose(
+                    encoder_out[out][:, i].detach().numpy(),
+                    row_out[out][:, 0].detach().numpy(),
+                    atol=1e-6,
+                )
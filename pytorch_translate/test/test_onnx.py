@@ -16,12 +16,15 @@ from pytorch_translate import char_source_transformer_model  # noqa
 from pytorch_translate import rnn  # noqa
 from pytorch_translate import transformer  # noqa
 from pytorch_translate.ensemble_export import (
+    BatchBeamSearch,
     BeamSearch,
     CharSourceEncoderEnsemble,
     DecoderBatchedStepEnsemble,
+    EarlyStopBeamSearch,
     EncoderEnsemble,
     ForcedDecoder,
     merge_transpose_and_batchmatmul,
+    quantize_module,
 )
 from pytorch_translate.tasks import pytorch_translate_task as tasks
 from pytorch_translate.test import utils as test_utils
@@ -317,6 +320,122 @@ class TestONNX(unittest.TestCase):
         )
         self._test_full_beam_decoder(test_args)
 
+    def test_full_beam_decoder_early_finish(self):
+        test_args = test_utils.ModelParamsDict()
+        samples, src_dict, tgt_dict = test_utils.prepare_inputs(test_args)
+        task = tasks.DictionaryHolderTask(src_dict, tgt_dict)
+        sample = next(samples)
+        src_tokens = sample["net_input"]["src_tokens"][0:1].t()
+        src_lengths = sample["net_input"]["src_lengths"][0:1].int()
+        model_list = [task.build_model(test_args) for _ in range(2)]
+
+        # a large word penalty makes every hypothesis pick EOS within two steps
+        beam_size = 4
+        bs = BeamSearch(
+            model_list,
+            tgt_dict,
+            src_tokens,
+            src_lengths,
+            beam_size=beam_size,
+            word_reward=-100,
+        )
+        num_steps = 10
+        inputs = (
+            src_tokens,
+            src_lengths,
+            torch.LongTensor([tgt_dict.eos()]),
+            torch.FloatTensor([0.0]),
+            torch.zeros(src_tokens.size(0)),
+            torch.zeros(beam_size, dtype=torch.int64),
+        )
+        outs = bs(*inputs, num_steps)
+        self.assertEqual(outs[0].size(0), num_steps + 1)
+        self.assertTrue(outs[0][1:num_steps].eq(tgt_dict.eos()).any())
+
+        import io
+
+        f = io.BytesIO()
+        torch.onnx._export(
+            bs,
+            inputs + (torch.LongTensor([num_steps]),),
+            f,
+            export_params=True,
+            verbose=False,
+            example_outputs=outs,
+        )
+        f.seek(0)
+        c2_model = caffe2_backend.prepare(onnx.load(f))
+        c2_outs = c2_model.run(
+            tuple(t.numpy() for t in inputs) + (np.array([num_steps]),)
+        )
+        for out, c2_out in zip(outs, c2_outs):
+            np.testing.assert_allclose(
+                out.detach().numpy(), c2_out, rtol=1e-4, atol=1e-5
+            )
+
+        # stopping early only drops the trailing steps
+        early_outs = EarlyStopBeamSearch(bs)(*inputs, num_steps)
+        steps = early_outs[0].size(0)
+        self.assertLess(steps, num_steps + 1)
+        for out, early_out in zip(outs, early_outs):
+            np.testing.assert_allclose(
+                out[:steps].detach().numpy(), early_out.detach().numpy()
+            )
+
+    def _test_batch_beam_search(self, test_args):
+        _, src_dict, tgt_dict = test_utils.prepare_inputs(test_args)
+        task = tasks.DictionaryHolderTask(src_dict, tgt_dict)
+        model_list = [task.build_model(test_args) for _ in range(2)]
+
+        beam_size = 3
+        lengths = [4, 6, 5]
+        src_tokens = torch.LongTensor(max(lengths), len(lengths)).fill_(src_dict.pad())
+        for i, length in enumerate(lengths):
+            src_tokens[:length, i] = torch.randint(
+                src_dict.nspecial, len(src_dict), (length,)
+            )
+        src_lengths = torch.IntTensor(lengths)
+
+        bs = BatchBeamSearch(
+            model_list, tgt_dict, src_tokens, src_lengths, beam_size=beam_size
+        )
+        num_steps = 10
+        tokens, scores, out_lengths, weights = bs(src_tokens, src_lengths, num_steps)
+
+        steps = tokens.size(2)
+        self.assertLessEqual(steps, num_steps)
+        self.assertEqual(tokens.shape, (len(lengths), beam_size, steps))
+        self.assertEqual(scores.shape, (len(lengths), beam_size))
+        self.assertEqual(weights.shape, (len(lengths), beam_size, steps, max(lengths)))
+        # n-best lists are sorted best first
+        self.assertTrue((scores[:, :-1] >= scores[:, 1:]).all())
+
+        # each sentence decodes as it would on its own, padding is ignored
+        for i, length in enumerate(lengths):
+            single_tokens, single_scores, single_lengths, _ = bs(
+                src_tokens[:length, i : i + 1], src_lengths[i : i + 1], num_steps
+            )
+            np.testing.assert_allclose(
+                single_scores[0].numpy(), scores[i].numpy(), rtol=1e-4, atol=1e-5
+            )
+            best_length = int(out_lengths[i, 0])
+            self.assertEqual(int(single_lengths[0, 0]), best_length)
+            self.assertTrue(
+                torch.equal(
+                    single_tokens[0, 0, :best_length], tokens[i, 0, :best_length]
+                )
+            )
+
+    def test_batch_beam_search(self):
+        test_args = test_utils.ModelParamsDict(
+            encoder_bidirectional=True, sequence_lstm=True
+        )
+        self._test_batch_beam_search(test_args)
+
+    def test_batch_beam_search_transformer(self):
+        test_args = test_utils.ModelParamsDict(arch="transformer")
+        self._test_batch_beam_search(test_args)
+
     def _test_forced_decoder_export(self, test_args):
         _, src_dict, tgt_dict = test_utils.prepare_inputs(test_args)
         task = tasks.DictionaryHolderTask(src_dict, tgt_dict)
@@ -551,3 +670,19 @@ class TestONNX(unittest.TestCase):
             test_args, return_caffe2_rep=True
         )
         merge_transpose_and_batchmatmul(caffe2_rep)
+
+    def test_quantize_module(self):
+        module = torch.nn.Sequential(torch.nn.Linear(8, 4))
+        x = torch.randn(3, 8)
+        expected = module(x)
+
+        self.assertIs(quantize_module(module, "none"), module)
+        self.assertIs(quantize_module(module, False), module)
+        with self.assertRaises(ValueError):
+            quantize_module(module, "int4")
+
+        quantized = quantize_module(module, "dynamic-int8")
+        self.assertNotIsInstance(quantized[0], torch.nn.Linear)
+        np.testing.assert_allclose(
+            quantized(x).detach().numpy(), expected.detach().numpy(), atol=0.1
+        )
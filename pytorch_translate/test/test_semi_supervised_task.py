@@ -1,9 +1,61 @@
 #!/usr/bin/env python3
 
+import argparse
+import tempfile
 import unittest
+from collections import OrderedDict
 from itertools import zip_longest
 
-from pytorch_translate.tasks.semi_supervised_task import PytorchTranslateSemiSupervised
+import torch
+from fairseq.data import LanguagePairDataset, RoundRobinZipDatasets
+from pytorch_translate import data as ptt_data
+from pytorch_translate.tasks.semi_supervised_task import (
+    BacktranslationInput,
+    BacktranslationMeter,
+    PytorchTranslateSemiSupervised,
+)
+from pytorch_translate.test import utils as test_utils
+
+
+def backtranslation_task(cache_dir, refresh_epochs=0):
+    # Only the parts of the task used by the back-translation cache
+    task = PytorchTranslateSemiSupervised.__new__(PytorchTranslateSemiSupervised)
+    task.args = argparse.Namespace(
+        backtranslation_cache_dir=cache_dir,
+        backtranslation_refresh_epochs=refresh_epochs,
+        backtranslation_batch_size=2,
+        cpu=True,
+    )
+    task.backtranslation_inputs = {}
+    task.backtranslation_meter = BacktranslationMeter()
+    task.stale_backtranslations = set()
+    task.datasets = {}
+    return task
+
+
+def backtranslation_input(dictionary, sentences):
+    monolingual = ptt_data.InMemoryNumpyDataset()
+    monolingual.load_from_sequences(sentences)
+    monolingual_dataset = LanguagePairDataset(
+        src=monolingual, src_sizes=monolingual.sizes, src_dict=dictionary
+    )
+
+    def generate_fn(net_input):
+        # "Translates" a sentence by reversing it
+        hypos = []
+        for src in net_input["src_tokens"]:
+            tokens = src[src.ne(dictionary.pad())].flip(0)
+            eos = torch.LongTensor([dictionary.eos()])
+            hypos.append([{"tokens": torch.cat([tokens, eos])}])
+        return hypos
+
+    return BacktranslationInput(
+        monolingual_dataset=monolingual_dataset,
+        collater=monolingual_dataset.collater,
+        generate_fn=generate_fn,
+        src_dict=dictionary,
+        tgt_dict=dictionary,
+    )
 
 
 class TestSemiSupervisedTask(unittest.TestCase):
@@ -27,3 +79,84 @@ class TestSemiSupervisedTask(unittest.TestCase):
         ):
             self.assertEquals(parsed_schedule[0], expected_schedule[0])
             self.assertDictEqual(parsed_schedule[1], expected_schedule[1])
+
+    def test_backtranslation_cache(self):
+        dictionary = test_utils.dummy_dictionary(dummy_tokens=5)
+        tokens = [dictionary.index(f"token_{i}") for i in range(5)]
+        sentences = [tokens[:3], tokens[1:2], tokens[:5]]
+        cache_dir = tempfile.mkdtemp()
+        task = backtranslation_task(cache_dir)
+        bt_input = backtranslation_input(dictionary, sentences)
+        task.backtranslation_inputs["train"] = {"tgt-src_mono": bt_input}
+        task.datasets["train"] = RoundRobinZipDatasets(
+            OrderedDict(
+                [
+                    (
+                        "tgt-src_mono",
+                        task.load_cached_backtranslations(
+                            "train", "tgt-src_mono", bt_input
+                        ),
+                    )
+                ]
+            )
+        )
+        # No cache yet, so it has to be generated before the first epoch
+        assert "train" in task.stale_backtranslations
+        extra_state = {"epoch": 1}
+        assert task.maybe_refresh_backtranslations("train", extra_state)
+        assert extra_state["backtranslation_epoch"] == 1
+        dataset = task.datasets["train"].datasets["tgt-src_mono"]
+        for i, sentence in enumerate(sentences):
+            example = dataset[i]
+            assert example["source"].tolist() == sentence[::-1]
+            assert example["target"].tolist() == sentence + [dictionary.eos()]
+        # Back-translate only once
+        extra_state["epoch"] = 5
+        assert not task.maybe_refresh_backtranslations("train", extra_state)
+
+        # A resumed run reuses the cache; a new run regenerates it
+        task = backtranslation_task(cache_dir, refresh_epochs=2)
+        task.backtranslation_inputs["train"] = {"tgt-src_mono": bt_input}
+        dataset = task.load_cached_backtranslations("train", "tgt-src_mono", bt_input)
+        assert dataset[0]["source"].tolist() == sentences[0][::-1]
+        assert not task.stale_backtranslations
+        assert not task.maybe_refresh_backtranslations(
+            "train", {"epoch": 2, "backtranslation_epoch": 1}
+        )
+        task.datasets["train"] = RoundRobinZipDatasets(
+            OrderedDict([("tgt-src_mono", dataset)])
+        )
+        assert task.maybe_refresh_backtranslations(
+            "train", {"epoch": 3, "backtranslation_epoch": 1}
+        )
+        assert task.maybe_refresh_backtranslations("train", {"epoch": 3})
+
+    def test_sharded_backtranslation(self):
+        dictionary = test_utils.dummy_dictionary(dummy_tokens=5)
+        tokens = [dictionary.index(f"token_{i}") for i in range(5)]
+        sentences = [tokens[: n % 5 + 1] for n in range(7)]
+        task = backtranslation_task(tempfile.mkdtemp())
+        bt_input = backtranslation_input(dictionary, sentences)
+        expected = [
+            translation.tolist() for translation in task.backtranslate(bt_input)
+        ]
+        assert expected == [sentence[::-1] for sentence in sentences]
+
+        # The 4 batches of (at most) 2 sentences are dealt to the shards in
+        # turn, so shard 0 gets two of them. Together they cover the dataset.
+        shards = [
+            task.backtranslate(bt_input, num_shards=3, shard_id=shard_id)
+            for shard_id in range(3)
+        ]
+        assert [sum(t is not None for t in shard) for shard in shards] == [3, 2, 2]
+        for i in range(len(sentences)):
+            (translation,) = [shard[i] for shard in shards if shard[i] is not None]
+            assert translation.tolist() == expected[i]
+
+    def test_backtranslation_meter(self):
+        meter = BacktranslationMeter()
+        assert meter.pop_tokens_per_sec() is None
+        meter.update(num_tokens=100, seconds=1.0)
+        meter.update(num_tokens=200, seconds=2.0)
+        assert meter.pop_tokens_per_sec() == 100.0
+        assert meter.pop_tokens_per_sec() is None
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import numpy as np
+import torch
+from fairseq import bleu
+from pytorch_translate import rnn  # noqa
+from pytorch_translate import sequence_criterions
+from pytorch_translate.tasks import pytorch_translate_task as tasks
+from pytorch_translate.test import utils as test_utils
+
+
+class TestSequenceCriterions(unittest.TestCase):
+    def test_sentence_bleu_matches_scorer(self):
+        dictionary = test_utils.dummy_dictionary(dummy_tokens=6)
+        pad, eos, unk = dictionary.pad(), dictionary.eos(), dictionary.unk()
+        rng = np.random.RandomState(0)
+        words = [dictionary.index(f"token_{i}") for i in range(6)] + [unk, eos]
+        hypos = []
+        refs = []
+        for _ in range(50):
+            hypos.append(rng.choice(words, size=rng.randint(1, 10)).tolist() + [eos])
+            refs.append(rng.choice(words, size=rng.randint(1, 10)).tolist() + [eos])
+        hypos_tensor = torch.LongTensor([h + [pad] * (10 - len(h) + 1) for h in hypos])
+        refs_tensor = torch.LongTensor([r + [pad] * (10 - len(r) + 1) for r in refs])
+        bleu_scores = sequence_criterions.sentence_bleu(
+            hypos_tensor, refs_tensor, pad=pad, eos=eos, unk=unk
+        )
+        scorer = bleu.Scorer(pad, eos, unk)
+        for hypo, ref, bleu_score in zip(hypos, refs, bleu_scores.tolist()):
+            scorer.reset()
+            scorer.add(torch.IntTensor(ref), torch.IntTensor(hypo))
+            self.assertAlmostEqual(bleu_score, scorer.score(), places=3)
+
+    def test_sentence_bleu(self):
+        pad, eos, unk = 1, 2, 3
+        hypos = torch.LongTensor([[4, 5, 6, 7, 2], [4, 5, 6, 7, 2], [8, 2, 1, 1, 1]])
+        refs = torch.LongTensor([[4, 5, 6, 7, 2], [4, 5, 6, 8, 2], [4, 5, 2, 1, 1]])
+        bleu_scores = sequence_criterions.sentence_bleu(
+            hypos, refs, pad=pad, eos=eos, unk=unk
+        )
+        self.assertAlmostEqual(bleu_scores[0].item(), 100.0, places=4)
+        # 4-gram precision is 0
+        self.assertEqual(bleu_scores[1].item(), 0.0)
+        self.assertEqual(bleu_scores[2].item(), 0.0)
+
+    def test_compute_nll_reuses_encoder_out(self):
+        test_args = test_utils.ModelParamsDict()
+        _, src_dict, tgt_dict = test_utils.prepare_inputs(test_args)
+        task = tasks.DictionaryHolderTask(src_dict, tgt_dict)
+        model = task.build_model(test_args)
+        model.eval()
+        criterion = sequence_criterions.SequenceNegativeLoglikelihoodCriterion.__new__(
+            sequence_criterions.SequenceNegativeLoglikelihoodCriterion
+        )
+        criterion.padding_idx = tgt_dict.pad()
+        criterion.eos = tgt_dict.eos()
+        bsz, beam_size = 2, 3
+        src_tokens = torch.LongTensor([[4, 5, 6, 2], [6, 5, 4, 2]])
+        src_lengths = torch.LongTensor([4, 4])
+        sample = {"net_input": {"src_tokens": src_tokens, "src_lengths": src_lengths}}
+        translations = torch.LongTensor(bsz, beam_size, 5).random_(4, len(tgt_dict))
+        translations[:, :, -1] = tgt_dict.eos()
+        translations[0, 0, -2:] = torch.LongTensor([tgt_dict.eos(), tgt_dict.pad()])
+
+        # Encodes the tiled source for every translation
+        flat_translations = translations.view(bsz * beam_size, -1)
+        prev_output_tokens = torch.cat(
+            [
+                torch.LongTensor([[tgt_dict.eos()]] * (bsz * beam_size)),
+                flat_translations[:, :-1],
+            ],
+            dim=1,
+        )
+        net_output = model(
+            src_tokens.repeat_interleave(beam_size, dim=0),
+            src_lengths.repeat_interleave(beam_size, dim=0),
+            prev_output_tokens,
+        )
+        lprobs = model.get_normalized_probs(net_output, log_probs=True)
+        nll = -lprobs.gather(dim=-1, index=flat_translations.unsqueeze(2)).squeeze(2)
+        expected = (nll * flat_translations.ne(tgt_dict.pad()).float()).sum(dim=1)
+
+        encoder_out = criterion.encode(model, sample)
+        for nll_loss in [
+            criterion.compute_nll(model, sample, translations),
+            criterion.compute_nll(model, sample, translations, encoder_out),
+        ]:
+            np.testing.assert_allclose(
+                nll_loss.view(-1).detach().numpy(),
+                expected.detach().numpy(),
+                rtol=1e-5,
+            )
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+import argparse
+import io
+import os
+import queue
+import time
+import unittest
+
+from pytorch_translate import batch_scheduler, serve
+from pytorch_translate.tasks import pytorch_translate_task as tasks
+from pytorch_translate.test import utils as test_utils
+
+
+def serving_args(**kwargs):
+    args = argparse.Namespace(
+        beam=2,
+        nbest=1,
+        no_early_stop=False,
+        unnormalized=False,
+        length_penalty=0.0,
+        unk_reward=0.0,
+        word_reward=0.0,
+        model_weights="",
+        diverse_beam_groups=-1,
+        diverse_beam_strength=0.5,
+        diversity_sibling_gamma=0.0,
+        max_len_a=0,
+        max_len_b=8,
+        remove_bpe=None,
+        cpu=True,
+        serve_workers=1,
+        threads_per_worker=1,
+        pin_workers=False,
+        max_batch_size=4,
+        max_wait_ms=5.0,
+        scheduler="micro-batch",
+        deadline_ms=200.0,
+        bucket_width=8,
+        max_tokens_per_batch=2048,
+    )
+    for k, v in kwargs.items():
+        setattr(args, k, v)
+    return args
+
+
+def build_batch_translator(args):
+    test_args = test_utils.ModelParamsDict()
+    _, src_dict, tgt_dict = test_utils.prepare_inputs(test_args)
+    task = tasks.DictionaryHolderTask(src_dict, tgt_dict)
+    model = task.build_model(test_args)
+    model.eval()
+    return serve.BatchTranslator(
+        args, task, [model], append_eos_to_source=True, reverse_source=False
+    )
+
+
+class ExitingTranslator:
+    """Translator whose worker process dies on the first batch."""
+
+    def translate(self, lines):
+        os._exit(1)
+
+
+class TestServe(unittest.TestCase):
+    def test_micro_batcher_respects_max_batch_size(self):
+        request_queue = queue.Queue()
+        for i in range(5):
+            request_queue.put(serve.Request(0, i, "a", time.time()))
+        request_queue.put(None)
+        batcher = serve.MicroBatcher(request_queue, max_batch_size=2, max_wait_ms=0)
+        batch_sizes = []
+        while True:
+            batch = batcher.next_batch()
+            if batch is None:
+                break
+            batch_sizes.append(len(batch))
+        assert batch_sizes == [2, 2, 1]
+
+    def test_micro_batcher_waits_at_most_max_wait(self):
+        request_queue = queue.Queue()
+        request_queue.put(serve.Request(0, 0, "a", time.time()))
+        batcher = serve.MicroBatcher(request_queue, max_batch_size=8, max_wait_ms=20)
+        start = time.time()
+        batch = batcher.next_batch()
+        assert len(batch) == 1
+        assert time.time() - start < 1.0
+
+    def test_scheduling_batcher_flushes_on_close(self):
+        request_queue = queue.Queue()
+        for i, text in enumerate(["a", "a b c d e f g h i j", "a b"]):
+            request_queue.put(serve.Request(0, i, text, time.time()))
+        request_queue.put(None)
+        batcher = serve.SchedulingBatcher(
+            request_queue,
+            batch_scheduler.DeadlineAwareScheduler(bucket_width=4, max_wait_ms=1e6),
+            lambda text: len(text.split()),
+            deadline_ms=1e6,
+        )
+        batches = []
+        while True:
+            batch = batcher.next_batch()
+            if batch is None:
+                break
+            batcher.observe(batch, compute_ms=1.0)
+            batches.append(sorted(r.request_id for r in batch))
+        assert sorted(batches) == [[0, 2], [1]]
+
+    def test_dispatcher_waits_for_idle_workers(self):
+        request_queue = queue.Queue()
+        for i in range(3):
+            request_queue.put(serve.Request(0, i, "a", time.time()))
+        batch_queue = queue.Queue()
+        dispatcher = serve.Dispatcher(
+            serve.MicroBatcher(request_queue, max_batch_size=1, max_wait_ms=0),
+            batch_queue,
+            num_workers=2,
+        )
+        dispatcher.start()
+        first_ids = [batch_queue.get(timeout=5)[0] for _ in range(2)]
+        # Both workers are busy, so the last request waits in the batcher
+        time.sleep(0.05)
+        assert batch_queue.empty()
+        dispatcher.batch_done(first_ids[0], compute_ms=1.0)
+        batch_id, batch = batch_queue.get(timeout=5)
+        assert [r.request_id for r in batch] == [2]
+        request_queue.put(None)
+        for i in [first_ids[1], batch_id]:
+            dispatcher.batch_done(i, compute_ms=1.0)
+        assert [batch_queue.get(timeout=5) for _ in range(2)] == [None, None]
+
+    def test_ordered_writer(self):
+        output = []
+        writer = serve.OrderedWriter(output.append)
+        writer.add(1, "b")
+        assert output == []
+        writer.add(0, "a")
+        writer.add(2, "c")
+        assert output == ["a\n", "b\n", "c\n"]
+
+    def test_batch_translator_keeps_input_order(self):
+        batch_translator = build_batch_translator(serving_args())
+        lines = ["token_0", "token_1 token_2 token_0", "", "token_2 token_2"]
+        translations = batch_translator.translate(lines)
+        assert len(translations) == len(lines)
+        assert translations[2] == ""
+        for i in [0, 1, 3]:
+            assert translations[i] == batch_translator.translate([lines[i]])[0]
+
+    def test_serve_stdin(self):
+        args = serving_args(serve_workers=2)
+        batch_translator = build_batch_translator(args)
+        lines = [" ".join(["token_1"] * (i % 5 + 1)) for i in range(10)]
+        output_file = io.StringIO()
+        stats = serve.serve_stdin(
+            args,
+            batch_translator,
+            input_file=io.StringIO("\n".join(lines) + "\n"),
+            output_file=output_file,
+        )
+        assert output_file.getvalue().splitlines() == [
+            batch_translator.translate([line])[0] for line in lines
+        ]
+        assert len(stats.total_ms) == len(lines)
+        assert max(stats.batch_sizes) <= args.max_batch_size
+
+    def test_serve_stdin_worker_exit(self):
+        args = serving_args(serve_workers=2)
+        with self.assertRaises(RuntimeError):
+            serve.serve_stdin(
+                args,
+                ExitingTranslator(),
+                input_file=io.StringIO("token_1\ntoken_2\n"),
+                output_file=io.StringIO(),
+            )
+
+    def test_serve_stdin_deadline_scheduler(self):
+        args = serving_args(scheduler="deadline", max_batch_size=3)
+        batch_translator = build_batch_translator(args)
+        lines = [" ".join(["token_1"] * (i % 5 + 1)) for i in range(10)]
+        output_file = io.StringIO()
+        stats = serve.serve_stdin(
+            args,
+            batch_translator,
+            input_file=io.StringIO("\n".join(lines) + "\n"),
+            output_file=output_file,
+        )
+        assert len(output_file.getvalue().splitlines()) == len(lines)
+        assert max(stats.batch_sizes) <= args.max_batch_size
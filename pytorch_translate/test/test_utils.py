@@ -58,3 +58,31 @@ class TestMaybeCat(unittest.TestCase):
             pytorch_utils.maybe_cat([None, None], 1)
         with self.assertRaises(RuntimeError):
             pytorch_utils.maybe_cat([], 1)
+
+
+class TestFutureMask(unittest.TestCase):
+    def test_future_mask(self):
+        mask = pytorch_utils.get_future_mask(3, device=torch.device("cpu"))
+        inf = float("inf")
+        npt.assert_array_equal(
+            mask, [[0.0, -inf, -inf], [0.0, 0.0, -inf], [0.0, 0.0, 0.0]]
+        )
+
+    def test_shared_cache_grows(self):
+        small = pytorch_utils.get_future_mask(5, device=torch.device("cpu"))
+        large = pytorch_utils.get_future_mask(17, device=torch.device("cpu"))
+        npt.assert_array_equal(large[:5, :5], small)
+        # Shorter masks are views into the same (grown) buffer.
+        again = pytorch_utils.get_future_mask(5, device=torch.device("cpu"))
+        self.assertEqual(again.data_ptr(), large.data_ptr())
+
+
+class TestCastModelForInference(unittest.TestCase):
+    def test_adaptive_softmax_stays_fp32(self):
+        model = torch.nn.Module()
+        model.decoder = torch.nn.Module()
+        model.decoder.layer = torch.nn.Linear(4, 4)
+        model.decoder.adaptive_softmax = torch.nn.Linear(4, 8)
+        pytorch_utils.cast_model_for_inference(model, "bf16")
+        self.assertEqual(model.decoder.layer.weight.dtype, torch.bfloat16)
+        self.assertEqual(model.decoder.adaptive_softmax.weight.dtype, torch.float32)
@@ -39,6 +39,7 @@ from pytorch_translate import (
     data as pytorch_translate_data,
     dictionary as pytorch_translate_dictionary,
     evals,
+    memory_profiling,
     multi_model,
     options as pytorch_translate_options,
     preprocess,
@@ -381,7 +382,12 @@ def build_trainer(args, task, model, criterion, trainer_class):
         flush=True,
     )
 
-    epoch_itr = task.get_batch_iterator(
+    epoch_itr = build_epoch_itr(args, task, max_positions)
+    return trainer, epoch_itr
+
+
+def build_epoch_itr(args, task, max_positions):
+    return task.get_batch_iterator(
         dataset=task.dataset(args.train_subset),
         max_tokens=args.max_tokens,
         max_sentences=args.max_sentences,
@@ -393,7 +399,6 @@ def build_trainer(args, task, model, criterion, trainer_class):
         shard_id=args.distributed_rank,
         num_workers=args.num_workers,
     )
-    return trainer, epoch_itr
 
 
 def setup_training(args, trainer_class=None):
@@ -482,6 +487,7 @@ def train(
     lr = trainer.get_lr()
     train_meter = StopwatchMeter()
     train_meter.start()
+    memory_profiler = memory_profiling.build_memory_profiler(args)
     stop_training_mid_epoch = False
     stop_training_end_of_epoch = False
 
@@ -493,6 +499,25 @@ def train(
     while lr > args.min_lr and extra_state["epoch"] <= max_epoch:
         """Train the model for one epoch."""
 
+        if (
+            args.task == constants.SEMI_SUPERVISED_TASK
+            and task.maybe_refresh_backtranslations(
+                split=args.train_subset, extra_state=extra_state
+            )
+        ):
+            # The refreshed dataset needs new batches. Position the new iterator
+            # as setup_training_state() does.
+            max_positions = utils.resolve_max_positions(
+                task.max_positions(), trainer.get_model().max_positions()
+            )
+            epoch_itr = build_epoch_itr(args, task, max_positions)
+            epoch = extra_state["epoch"]
+            if extra_state["batch_offset"] == 0:
+                epoch -= 1
+            epoch_itr.load_state_dict(
+                {"epoch": epoch, "iterations_in_epoch": extra_state["batch_offset"]}
+            )
+
         itr, progress, extra_meters = setup_epoch(
             args=args, epoch_itr=epoch_itr, trainer=trainer
         )
@@ -507,6 +532,7 @@ def train(
                 train_step_kwargs["augment_adv"] = (
                     extra_state["num_iterations"] > args.warmup_steps
                 )
+            memory_profiler.start()
             try:
                 log_output = trainer.train_step(samples, **train_step_kwargs)
             # Fairseq's fp16_trainer raises this uncommon error to indicate
@@ -515,6 +541,7 @@ def train(
                 print(f"Stopping training due to: {e}.")
                 stop_training_mid_epoch = True
                 break
+            memory_stats = memory_profiler.stop(name="train step")
 
             if do_prune:
                 apply_prune_masks(prune_masks, trainer)
@@ -548,6 +575,15 @@ def train(
                 # because of OOM or FP16 overflow.
                 continue
 
+            # Memory stats are averaged in extra_meters like any other
+            # non-loss entry of log_output.
+            for k, v in memory_stats.items():
+                log_output[f"train_{k}"] = v
+            if args.task == constants.SEMI_SUPERVISED_TASK:
+                # Reported next to wps when back-translating on the fly
+                backtranslation_wps = task.backtranslation_meter.pop_tokens_per_sec()
+                if backtranslation_wps is not None:
+                    log_output["backtranslation_wps"] = backtranslation_wps
             train_stats = evals.log_mid_epoch_stats(
                 trainer=trainer,
                 progress=progress,
@@ -15,7 +15,7 @@ from fairseq.models import (
     transformer as fairseq_transformer,
 )
 from fairseq.modules import AdaptiveSoftmax, SinusoidalPositionalEmbedding
-from pytorch_translate import vocab_reduction
+from pytorch_translate import utils as pytorch_translate_utils, vocab_reduction
 from pytorch_translate.common_layers import (
     TransformerEmbedding,
     TransformerEncoderGivenEmbeddings,
@@ -477,20 +477,9 @@ class TransformerDecoder(FairseqIncrementalDecoder):
         return self.embed_positions.max_positions()
 
     def buffered_future_mask(self, tensor):
-        dim = tensor.size(0)
-        if (
-            not hasattr(self, "_future_mask")
-            or self._future_mask is None
-            or self._future_mask.device != tensor.device
-        ):
-            self._future_mask = torch.triu(
-                utils.fill_with_neg_inf(tensor.new(dim, dim)), 1
-            )
-        if self._future_mask.size(0) < dim:
-            self._future_mask = torch.triu(
-                utils.fill_with_neg_inf(self._future_mask.resize_(dim, dim)), 1
-            )
-        return self._future_mask[:dim, :dim]
+        return pytorch_translate_utils.get_future_mask(
+            tensor.size(0), device=tensor.device, dtype=tensor.dtype
+        )
 
     def upgrade_state_dict_named(self, state_dict, name):
         if isinstance(self.embed_positions, SinusoidalPositionalEmbedding):
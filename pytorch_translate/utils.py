@@ -76,8 +76,43 @@ class BucketStopwatchMeter(object):
         return result
 
 
+INFERENCE_DTYPES = ["fp32", "fp16", "bf16"]
+
+
+def get_inference_dtype(inference_dtype: str) -> torch.dtype:
+    if inference_dtype == "fp32":
+        return torch.float32
+    elif inference_dtype == "fp16":
+        return torch.float16
+    elif inference_dtype == "bf16":
+        if not hasattr(torch, "bfloat16"):
+            raise ValueError("This version of PyTorch does not support bfloat16.")
+        return torch.bfloat16
+    raise ValueError(
+        f"Unknown inference dtype {inference_dtype}. Expected one of "
+        f"{INFERENCE_DTYPES}."
+    )
+
+
+def cast_model_for_inference(model, inference_dtype: str = "fp32"):
+    """Casts the floating point parameters and buffers of model in place.
+    Integer buffers such as vocab reduction tables are left alone. An adaptive
+    softmax stays in fp32, since it computes the output log-probabilities."""
+    dtype = get_inference_dtype(inference_dtype)
+    if dtype != torch.float32:
+        model.to(dtype=dtype)
+        adaptive_softmax = getattr(
+            getattr(model, "decoder", None), "adaptive_softmax", None
+        )
+        if adaptive_softmax is not None:
+            adaptive_softmax.float()
+    return model
+
+
 def load_diverse_ensemble_for_inference(
-    filenames: List[str], task: Optional[tasks.FairseqTask] = None
+    filenames: List[str],
+    task: Optional[tasks.FairseqTask] = None,
+    inference_dtype: str = "fp32",
 ):
     """Load an ensemble of diverse models for inference.
 
@@ -88,6 +123,8 @@ def load_diverse_ensemble_for_inference(
         filenames: List of file names to checkpoints
         task: Optional[FairseqTask]. If this isn't provided, we setup the task
             using the first checkpoint's model args loaded from the saved state.
+        inference_dtype: One of INFERENCE_DTYPES. Models are cast to it once
+            after loading their weights.
 
     Return:
         models, args: Tuple of lists. models contains the loaded models, args
@@ -116,7 +153,7 @@ def load_diverse_ensemble_for_inference(
     for checkpoint_data in checkpoints_data:
         model = task.build_model(checkpoint_data["args"])
         model.load_state_dict(checkpoint_data["model"])
-        ensemble.append(model)
+        ensemble.append(cast_model_for_inference(model, inference_dtype))
     args_list = [s["args"] for s in checkpoints_data]
     return ensemble, args_list, task
 
@@ -170,6 +207,34 @@ def maybe_cuda(t):
     return t
 
 
+# Future masks shared by all decoders in the process, keyed by (device, dtype).
+# The cached masks only ever grow, so layers and ensemble members decoding
+# sequences of different lengths slice views out of the same buffer instead of
+# rebuilding their own copy.
+_FUTURE_MASK_CACHE = {}
+
+
+def get_future_mask(dim, device, dtype=torch.float):
+    """Returns a [dim, dim] additive mask which hides future positions.
+
+    Entries above the diagonal are -inf and all others are 0, as expected by
+    the attn_mask argument of fairseq's MultiheadAttention. The returned tensor
+    is a view into a process-wide cache and must not be modified in place.
+    """
+    key = (str(device), dtype)
+    mask = _FUTURE_MASK_CACHE.get(key)
+    if mask is None or mask.size(0) < dim:
+        # Round up to the next power of two so that slowly increasing lengths
+        # do not rebuild the mask on every batch.
+        size = 1 << max(dim - 1, 0).bit_length()
+        if mask is not None:
+            size = max(size, 2 * mask.size(0))
+        mask = torch.triu(utils.fill_with_neg_inf(torch.empty(size, size)), 1)
+        mask = mask.to(device=device, dtype=dtype)
+        _FUTURE_MASK_CACHE[key] = mask
+    return mask[:dim, :dim]
+
+
 def average_tensors(tensor_list, norm_fn=None, weights=None):
     """Averages a list of tensors.
 